@@ -64,6 +64,7 @@ setup(
     extras_require={
         'docs': ['Sphinx', 'sphinx-autobuild', 'alabaster'],
         'quality': ['pylama', 'isort', 'eradicate', 'mypy', 'black', 'bandit'],
+        'redis': ['redis'],
     },
     install_requires=[
         "oidcmsg>=0.6.10",
@@ -0,0 +1,146 @@
+"""
+Support for running endpoints under asyncio, e.g. in an ASGI server.
+
+The endpoint pipeline, parse_request/process_request/do_response, is
+synchronous and may block on outbound HTTP requests and on storage. The
+async variants of the pipeline methods run it in a thread pool that
+belongs to the endpoint context so the event loop is never blocked.
+
+Requests are then handled in several threads at once, which requires the
+session, SSO, client and JWT ID databases to be thread safe, like
+ConcurrentInMemoryDataBase or RedisDataBase. If any of them is not, for
+instance the default InMemoryDataBase, the thread pool only gets one
+thread and requests are handled one at a time.
+
+Storage and HTTP clients that are natively async can be used through
+the same interfaces as the adapters here, AsyncDataBase and
+AsyncHTTPClient, which put a synchronous implementation in the thread
+pool.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_thread_safe(db):
+    """
+    :param db: A database, None if there is none
+    :return: True if the database can be used from several threads at once
+    """
+    return db is None or getattr(db, "thread_safe", False)
+
+
+def run_in_executor(executor, func, *args, **kwargs):
+    """
+    Run a blocking function in a thread pool. Must be called from a
+    coroutine or callback running in an event loop.
+
+    :param executor: A concurrent.futures.Executor instance, None means the
+        event loop's default executor
+    :param func: The function
+    :return: An awaitable that gives the function's return value
+    """
+    _loop = asyncio.get_running_loop()
+    return _loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+class ExecutorMixin(object):
+    """
+    A lazily created thread pool. The pool is not created until something
+    has to be run in it.
+    """
+
+    max_workers = None
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def pool_size(self):
+        """
+        :return: The number of threads in the pool, None for the default
+        """
+        return self.max_workers
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.pool_size())
+        return self._executor
+
+    def run(self, func, *args, **kwargs):
+        return run_in_executor(self.executor, func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+class AsyncDataBase(ExecutorMixin):
+    """
+    Async interface to a database implementing the InMemoryDataBase
+    interface. If the database isn't thread safe it's only used from one
+    thread at a time.
+    """
+
+    def __init__(self, db, executor=None, max_workers=None):
+        """
+        :param db: The database
+        :param executor: Thread pool to use, one is created if not given
+        :param max_workers: Size of the thread pool created
+        """
+        self.db = db
+        self._executor = executor
+        self.max_workers = max_workers
+
+    def pool_size(self):
+        if is_thread_safe(self.db):
+            return self.max_workers
+        return 1
+
+    async def get(self, key):
+        return await self.run(self.db.get, key)
+
+    async def set(self, key, value, ttl=None):
+        return await self.run(self.db.set, key, value, ttl=ttl)
+
+    async def delete(self, key):
+        return await self.run(self.db.delete, key)
+
+    async def get_many(self, keys):
+        try:
+            _get_many = self.db.get_many
+        except AttributeError:
+            return await self.run(lambda: [self.db.get(key) for key in keys])
+        return await self.run(_get_many, keys)
+
+    async def keys(self):
+        return await self.run(self.db.keys)
+
+
+class AsyncHTTPClient(ExecutorMixin):
+    """
+    Async interface to a HTTP client with the requests interface, like
+    requests itself or CachingHTTPClient.
+    """
+
+    def __init__(self, httpc, executor=None, max_workers=None):
+        """
+        :param httpc: The HTTP client
+        :param executor: Thread pool to use, one is created if not given
+        :param max_workers: Size of the thread pool created
+        """
+        self.httpc = httpc
+        self._executor = executor
+        self.max_workers = max_workers
+
+    async def get(self, url, **kwargs):
+        return await self.run(self.httpc.get, url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.run(self.httpc.post, url, **kwargs)
+
+    async def request(self, method, url, **kwargs):
+        return await self.run(self.httpc.request, method, url, **kwargs)
@@ -1,5 +1,13 @@
 import base64
+import hashlib
+import hmac
+import json
 import logging
+import os
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
 from urllib.parse import unquote_plus
 
 from cryptojwt.exception import BadSignature
@@ -9,6 +17,7 @@ from cryptojwt.jwt import JWT
 from cryptojwt.jwt import utc_time_sans_frac
 from cryptojwt.utils import as_bytes
 from cryptojwt.utils import as_unicode
+from cryptojwt.utils import b64d
 from oidcmsg.oidc import JsonWebToken
 from oidcmsg.oidc import verified_claim_name
 
@@ -19,6 +28,7 @@ from oidcendpoint.exception import MultipleUsage
 from oidcendpoint.exception import NotForMe
 from oidcendpoint.exception import UnknownClient
 from oidcendpoint.util import importer
+from oidcendpoint.util import key_state
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +51,219 @@ class WrongAuthnMethod(Exception):
     pass
 
 
+# Format of hashed client secrets: algorithm$iterations$salt$hash
+SECRET_HASH_ALG = "pbkdf2_sha256"
+SECRET_HASH_ITERATIONS = 100000
+
+
+def hash_secret(secret, iterations=SECRET_HASH_ITERATIONS, salt=None):
+    """
+    Hash a client secret for storage.
+
+    :param secret: The client secret
+    :param iterations: PBKDF2 iterations
+    :param salt: Salt, random if not given
+    :return: The hash as a string
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    _hash = hashlib.pbkdf2_hmac("sha256", as_bytes(secret), salt, iterations)
+    return "$".join(
+        [
+            SECRET_HASH_ALG,
+            str(iterations),
+            as_unicode(base64.b64encode(salt)),
+            as_unicode(base64.b64encode(_hash)),
+        ]
+    )
+
+
+def check_secret(secret, hashed):
+    """
+    Verify a client secret against a hash made by hash_secret.
+
+    :param secret: The presented client secret
+    :param hashed: The stored hash
+    :return: True/False
+    """
+    try:
+        _alg, _iterations, _salt, _hash = hashed.split("$")
+    except (ValueError, AttributeError):
+        return False
+    if _alg != SECRET_HASH_ALG:
+        return False
+    _other = hash_secret(secret, int(_iterations), base64.b64decode(_salt))
+    return hmac.compare_digest(as_bytes(_other), as_bytes(hashed))
+
+
+class SecretVerifier(object):
+    """
+    Checks presented client secrets against stored hashes. Since hashing is
+    slow, successful verifications are remembered for a short while. The
+    cache is keyed by an HMAC, with a random per process key, over the
+    client ID, the presented secret and the stored hash, so no secrets are
+    kept in clear and a changed secret is never matched.
+    """
+
+    def __init__(self, ttl=60, max_entries=4096):
+        """
+        :param ttl: For how many seconds a successful verification is
+            remembered. 0 means not at all.
+        :param max_entries: Max number of remembered verifications
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = os.urandom(32)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, client_id, secret, hashed):
+        _msg = b"\0".join([as_bytes(client_id), as_bytes(secret), as_bytes(hashed)])
+        return hmac.new(self._key, _msg, hashlib.sha256).digest()
+
+    def verify(self, client_id, secret, hashed):
+        """
+        :param client_id: The client ID
+        :param secret: The presented secret
+        :param hashed: The stored hash
+        :return: True/False
+        """
+        _key = self._cache_key(client_id, secret, hashed)
+        _now = time.time()
+        with self._lock:
+            _exp = self._cache.get(_key)
+            if _exp is not None:
+                if _now < _exp:
+                    return True
+                del self._cache[_key]
+
+        if not check_secret(secret, hashed):
+            return False
+
+        if self.ttl:
+            with self._lock:
+                self._cache[_key] = _now + self.ttl
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return True
+
+
+class AssertionKeyCache(object):
+    """
+    Keys used to verify client assertions, per client. The keys found in
+    the key jar for a client, given the signing algorithm and key ID, are
+    remembered until the client's keys change: keys added, removed or
+    marked inactive.
+    """
+
+    def __init__(self, keyjar):
+        """
+        :param keyjar: A cryptojwt.key_jar.KeyJar instance
+        """
+        self.keyjar = keyjar
+        # client_id -> (key state, {(use, alg, kid): keys})
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _client_keys(self, client_id):
+        _state = key_state(self.keyjar, client_id)
+        with self._lock:
+            try:
+                _old_state, _keys = self._keys[client_id]
+            except KeyError:
+                pass
+            else:
+                if _old_state == _state:
+                    return _keys
+            _keys = {}
+            self._keys[client_id] = (_state, _keys)
+        return _keys
+
+    def verify_keys(self, jwt):
+        """
+        The keys that may have been used to sign a client assertion.
+
+        :param jwt: A cryptojwt.jws.jws.JWSig instance
+        :return: list of keys
+        """
+        _iss = jwt.payload().get("iss", "")
+        _index = ("ver", jwt.headers.get("alg", ""), jwt.headers.get("kid", ""))
+        _keys = self._client_keys(_iss)
+        try:
+            return _keys[_index]
+        except KeyError:
+            pass
+
+        _keys[_index] = _res = self.keyjar.get_jwt_verify_keys(jwt)
+        return _res
+
+    def oct_keys(self, client_id, kid=None):
+        """
+        The symmetric signing keys belonging to a client.
+
+        :param client_id: The client ID
+        :param kid: Key ID
+        :return: list of keys
+        """
+        _index = ("oct", "", kid or "")
+        _keys = self._client_keys(client_id)
+        try:
+            return _keys[_index]
+        except KeyError:
+            pass
+
+        _keys[_index] = _res = self.keyjar.get("sig", "oct", client_id, kid)
+        return _res
+
+    def invalidate(self, client_id=None):
+        """
+        Drop cached keys.
+
+        :param client_id: Only this client's, otherwise everything
+        """
+        with self._lock:
+            if client_id is None:
+                self._keys = {}
+            else:
+                self._keys.pop(client_id, None)
+
+
+class AssertionJWT(JWT):
+    """
+    A JWT that verifies client assertions with keys from an
+    AssertionKeyCache instead of searching the key jar every time.
+    """
+
+    def __init__(self, key_cache, **kwargs):
+        JWT.__init__(self, key_jar=key_cache.keyjar, msg_cls=JsonWebToken, **kwargs)
+        self.key_cache = key_cache
+
+    def _verify(self, rj, token):
+        return rj.verify_compact(token, self.key_cache.verify_keys(rj.jwt))
+
+
+def verify_client_secret(endpoint_context, client_id, secret):
+    """
+    Verify the secret a client presented. The client information contains
+    either a client_secret_hash or, for clients not registered through the
+    registration endpoint, a client_secret in clear.
+
+    :param endpoint_context: An EndpointContext instance
+    :param client_id: The client ID
+    :param secret: The presented secret
+    :return: True/False
+    """
+    _cinfo = endpoint_context.cdb[client_id]
+    _hash = _cinfo.get("client_secret_hash")
+    if _hash:
+        return endpoint_context.client_secret_verifier.verify(client_id, secret, _hash)
+
+    _secret = _cinfo.get("client_secret")
+    if _secret is None:
+        return False
+    return hmac.compare_digest(as_bytes(_secret), as_bytes(secret))
+
+
 class ClientAuthnMethod(object):
     def __init__(self, endpoint_context=None):
         """
@@ -98,7 +321,7 @@ class ClientSecretBasic(ClientAuthnMethod):
     def verify(self, authorization_info, **kwargs):
         client_info = basic_authn(authorization_info)
 
-        if self.endpoint_context.cdb[client_info["id"]]["client_secret"] == client_info["secret"]:
+        if verify_client_secret(self.endpoint_context, client_info["id"], client_info["secret"]):
             return {"client_id": client_info["id"]}
         else:
             raise AuthnFailure()
@@ -121,8 +344,8 @@ class ClientSecretPost(ClientSecretBasic):
         return False
 
     def verify(self, request, **kwargs):
-        if self.endpoint_context.cdb[request["client_id"]]["client_secret"] == request[
-            "client_secret"]:
+        if verify_client_secret(
+                self.endpoint_context, request["client_id"], request["client_secret"]):
             return {"client_id": request["client_id"]}
         else:
             raise AuthnFailure("secrets doesn't match")
@@ -166,6 +389,24 @@ class BearerBody(ClientSecretPost):
 
 
 class JWSAuthnMethod(ClientAuthnMethod):
+    _verifier = None
+
+    @property
+    def verifier(self):
+        """
+        The JWT instance used to unpack client assertions. Rebuilt if the
+        key jar is replaced.
+        """
+        _keys = self.endpoint_context.assertion_keys
+        if _keys.keyjar is not self.endpoint_context.keyjar:
+            _keys = self.endpoint_context.assertion_keys = AssertionKeyCache(
+                self.endpoint_context.keyjar
+            )
+        _verifier = self._verifier
+        if _verifier is None or _verifier.key_cache is not _keys:
+            _verifier = self._verifier = AssertionJWT(_keys)
+        return _verifier
+
     def is_usable(self, request=None, authorization_info=None):
         if request is None:
             return False
@@ -174,7 +415,7 @@ class JWSAuthnMethod(ClientAuthnMethod):
         return False
 
     def verify(self, request, key_type, **kwargs):
-        _jwt = JWT(self.endpoint_context.keyjar, msg_cls=JsonWebToken)
+        _jwt = self.verifier
         try:
             ca_jwt = _jwt.unpack(request["client_assertion"])
         except (Invalid, MissingKey, BadSignature) as err:
@@ -185,11 +426,12 @@ class JWSAuthnMethod(ClientAuthnMethod):
         if _sign_alg and _sign_alg.startswith("HS"):
             if key_type == "private_key":
                 raise AttributeError("Wrong key type")
-            keys = self.endpoint_context.keyjar.get("sig", 'oct', ca_jwt["iss"],
-                                                    ca_jwt.jws_header.get("kid"))
-            _secret = self.endpoint_context.cdb[ca_jwt["iss"]].get('client_secret')
-            if _secret and keys[0].key != as_bytes(_secret):
-                raise AttributeError("Oct key used for signing not client_secret")
+            keys = _jwt.key_cache.oct_keys(ca_jwt["iss"], ca_jwt.jws_header.get("kid"))
+            _cinfo = self.endpoint_context.cdb[ca_jwt["iss"]]
+            if _cinfo.get("client_secret") or _cinfo.get("client_secret_hash"):
+                if not verify_client_secret(self.endpoint_context, ca_jwt["iss"],
+                                            keys[0].key):
+                    raise AttributeError("Oct key used for signing not client_secret")
         else:
             if key_type == "client_secret":
                 raise AttributeError("Wrong key type")
@@ -204,8 +446,8 @@ class JWSAuthnMethod(ClientAuthnMethod):
             else:
                 raise NotForMe("Not for me!")
         else:
-            if set(ca_jwt["aud"]).intersection(
-                    self.endpoint_context.endpoint[_endpoint].allowed_target_uris()):
+            if not self.endpoint_context.endpoint[_endpoint].allowed_target_uris().isdisjoint(
+                    ca_jwt["aud"]):
                 pass
             else:
                 raise NotForMe("Not for me!")
@@ -213,11 +455,14 @@ class JWSAuthnMethod(ClientAuthnMethod):
         # If there is a jti use it to make sure one-time usage is true
         _jti = ca_jwt.get('jti')
         if _jti:
+            _cache = self.endpoint_context.replay_cache
+            _exp = ca_jwt.get("exp")
+            if _exp and _cache.too_long_lived(_exp):
+                # A replay after it has been forgotten would go undetected
+                raise InvalidClient("Client assertion expires too late")
             _key = "{}:{}".format(ca_jwt['iss'], _jti)
-            if _key in self.endpoint_context.jti_db:
+            if _cache.seen(_key, _exp):
                 raise MultipleUsage("Have seen this token once before")
-            else:
-                self.endpoint_context.jti_db.set(_key, utc_time_sans_frac())
 
         request[verified_claim_name("client_assertion")] = ca_jwt
         client_id = kwargs.get("client_id") or ca_jwt["iss"]
@@ -269,6 +514,126 @@ CLIENT_AUTHN_METHOD = {
 TYPE_METHOD = [(JWT_BEARER, JWSAuthnMethod)]
 
 
+def assertion_alg(assertion):
+    """
+    The signing algorithm of a client assertion. Read from the JWS header
+    without verifying anything.
+
+    :param assertion: A signed JWT
+    :return: The value of alg or None
+    """
+    try:
+        _header = json.loads(as_unicode(b64d(as_bytes(assertion.split(".", 1)[0]))))
+        return _header.get("alg")
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def applicable_methods(request=None, authorization_info=None):
+    """
+    Which client authentication methods a request could be using.
+    Corresponds to the is_usable methods of the standard classes.
+
+    :param request: The request
+    :param authorization_info: Other authorization information
+    :return: Set of method tags
+    """
+    _tags = set()
+    if authorization_info:
+        if authorization_info.startswith("Basic "):
+            _tags.add("client_secret_basic")
+        elif authorization_info.startswith("Bearer "):
+            _tags.add("bearer_header")
+
+    if request:
+        if "client_assertion" in request:
+            _alg = assertion_alg(request["client_assertion"])
+            if _alg is None:
+                _tags.update({"client_secret_jwt", "private_key_jwt"})
+            elif _alg.startswith("HS"):
+                _tags.add("client_secret_jwt")
+            else:
+                _tags.add("private_key_jwt")
+        if "client_id" in request and "client_secret" in request:
+            _tags.add("client_secret_post")
+        if "access_token" in request:
+            _tags.add("bearer_body")
+
+    return _tags
+
+
+class ClientAuthnDispatcher(object):
+    """
+    Picks the client authentication method to use for a request based on
+    what the request contains, instead of trying every method an endpoint
+    supports. Methods that are not one of the standard classes are asked
+    through is_usable. Failed verifications are counted per method and
+    error type.
+    """
+
+    def __init__(self, methods):
+        """
+        :param methods: The endpoint's list of ClientAuthnMethod instances,
+            None means no authentication is allowed.
+        """
+        self.methods = methods
+        # What the dispatcher was built from, the list may be changed in place
+        self.snapshot = tuple(methods or [])
+        self.allow_none = None in self.snapshot
+        self.known = {}
+        for _method in methods or []:
+            if _method is None:
+                continue
+            if type(_method) is CLIENT_AUTHN_METHOD.get(_method.tag):
+                self.known[_method] = _method.tag
+        self.failures = Counter()
+
+    def candidates(self, request=None, authorization_info=None):
+        """
+        The methods that should be tried, in the configured order. If the
+        client has registered a token_endpoint_auth_method and that is one
+        of them, it comes first.
+        """
+        _tags = applicable_methods(request, authorization_info)
+        _res = [
+            m for m in self.methods or []
+            if m is not None and (
+                self.known[m] in _tags if m in self.known
+                else m.is_usable(request, authorization_info)
+            )
+        ]
+
+        if len(_res) > 1 and request and "client_id" in request:
+            _cinfo = _res[0].endpoint_context.cdb.get(request["client_id"]) or {}
+            _registered = _cinfo.get("token_endpoint_auth_method")
+            _res.sort(key=lambda m: getattr(m, "tag", None) != _registered)
+
+        return _res
+
+    def verify(self, request, authorization_info=None, endpoint=None):
+        """
+        :return: Authentication information or an empty dictionary if no
+            method could verify the request
+        """
+        for _method in self.candidates(request, authorization_info):
+            try:
+                auth_info = _method.verify(
+                    request=request, authorization_info=authorization_info,
+                    endpoint=endpoint
+                )
+            except Exception as err:
+                self.failures[(_method.tag, err.__class__.__name__)] += 1
+                # Counted, the class name is enough for the log
+                logger.debug(
+                    "Verifying auth using %s failed: %s", _method.tag, err.__class__.__name__
+                )
+            else:
+                if "method" not in auth_info:
+                    auth_info["method"] = _method.tag
+                return auth_info
+        return {}
+
+
 def valid_client_info(cinfo):
     eta = cinfo.get("client_secret_expires_at", 0)
     if eta != 0 and eta < utc_time_sans_frac():
@@ -302,29 +667,18 @@ def verify_client(
         authorization_info = " ".join(strings_parade)
 
     auth_info = {}
-    _methods = []
+    _dispatcher = None
     if endpoint:
         try:
-            _methods = endpoint_context.endpoint[endpoint].client_authn_method
+            _dispatcher = endpoint_context.endpoint[endpoint].client_authn_dispatcher
         except AttributeError:
             pass
 
-    for _method in _methods:
-        if _method is None:
-            continue
-        if _method.is_usable(request, authorization_info):
-            try:
-                auth_info = _method.verify(request=request, authorization_info=authorization_info,
-                                           endpoint=endpoint)
-            except Exception as err:
-                logger.warning("Verifying auth using {} failed: {}".format(_method.tag, err))
-            else:
-                if "method" not in auth_info:
-                    auth_info["method"] = _method.tag
-                break
+    if _dispatcher:
+        auth_info = _dispatcher.verify(request, authorization_info, endpoint)
 
     if not auth_info:
-        if None in _methods:
+        if _dispatcher and _dispatcher.allow_none:
             auth_info = {"method": "none", "client_id": request.get("client_id")}
         else:
             return auth_info
@@ -350,16 +704,15 @@ def verify_client(
             logger.warning("Client registration has timed out")
             raise InvalidClient("Not valid client")
 
-        # store what authn method was used
+        # store what authn method was used, only written when it changes
         if auth_info.get("method"):
             _request_type = request.__class__.__name__
-            _used_authn_method = endpoint_context.cdb[client_id].get("auth_method")
-            if _used_authn_method:
-                endpoint_context.cdb[client_id]["auth_method"][_request_type] = auth_info["method"]
-            else:
-                endpoint_context.cdb[client_id]["auth_method"] = {
-                    _request_type: auth_info["method"]
-                }
+            _used_authn_method = _cinfo.get("auth_method") or {}
+            if _used_authn_method.get(_request_type) != auth_info["method"]:
+                _cinfo["auth_method"] = dict(
+                    _used_authn_method, **{_request_type: auth_info["method"]}
+                )
+                endpoint_context.cdb[client_id] = _cinfo
     elif not client_id and get_client_id_from_token:
         if not _token:
             logger.warning("No token")
@@ -0,0 +1,252 @@
+"""
+The client database. Client information is kept in a key-value backend,
+one of InMemoryDataBase, ShelveDataBase or RedisDataBase, with a read-through
+cache in front of it. Using a shared backend allows several worker processes
+to serve the same dynamically registered clients.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from oidcendpoint.in_memory_db import InMemoryDataBase
+
+# Registration access token index keys
+RAT_KEY = "__rat__{}"
+INDEX_PREFIX = "__rat__"
+
+
+class TokenIndex(object):
+    """
+    Maps registration access tokens to client IDs. Stored in the same
+    backend as the client information.
+    """
+
+    def __init__(self, cdb):
+        self.cdb = cdb
+
+    def __getitem__(self, token):
+        _cid = self.cdb.get_item(RAT_KEY.format(token))
+        if _cid is None:
+            raise KeyError(token)
+        return _cid
+
+    def __setitem__(self, token, client_id):
+        self.cdb.set_item(RAT_KEY.format(token), client_id)
+
+    def __delitem__(self, token):
+        self.cdb.delete_item(RAT_KEY.format(token))
+
+    def __contains__(self, token):
+        return self.cdb.get_item(RAT_KEY.format(token)) is not None
+
+    def get(self, token, default=None):
+        _cid = self.cdb.get_item(RAT_KEY.format(token))
+        if _cid is None:
+            return default
+        return _cid
+
+
+class ClientInfo(dict):
+    """
+    Client information as handed out by ClientDatabase. Setting or removing
+    an attribute writes the client information back to the database.
+    Changes made within an attribute value, like appending to a list, are
+    not noticed and must be written back: cdb[client_id] = cinfo.
+    """
+
+    def __init__(self, cdb, client_id, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._cdb = cdb
+        self._client_id = client_id
+
+    def _write(self):
+        self._cdb.set_item(self._client_id, dict(self))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._write()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._write()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._write()
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, *args):
+        _len = len(self)
+        _val = dict.pop(self, key, *args)
+        if len(self) != _len:
+            self._write()
+        return _val
+
+    def popitem(self):
+        _item = dict.popitem(self)
+        self._write()
+        return _item
+
+    def clear(self):
+        dict.clear(self)
+        self._write()
+
+    def __reduce__(self):
+        # Pickled, e.g. by a ShelveDataBase, as the plain dictionary
+        return dict, (dict(self),)
+
+
+class ClientDatabase(object):
+    """
+    Dictionary like interface to the client information. Reads go through
+    an LRU cache. Entries in the cache are trusted for cache_ttl seconds
+    after which they are read again from the backend, that is how changes
+    made by other workers are picked up.
+
+    Client information is handed out as ClientInfo instances that write
+    changes of attributes through to the backend.
+    """
+
+    def __init__(self, db=None, cache_size=1024, cache_ttl=30):
+        """
+        :param db: The backend. Anything with get, keys and dictionary item
+            access. By default an InMemoryDataBase.
+        :param cache_size: Max number of cached entries, 0 means no cache
+        :param cache_ttl: For how many seconds a cached entry is used
+        """
+        self.db = InMemoryDataBase() if db is None else db
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.registration_access_token = TokenIndex(self)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_get(self, key):
+        with self._lock:
+            try:
+                _val, _exp = self._cache[key]
+            except KeyError:
+                return None
+            if time.time() >= _exp:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return _val
+
+    def _cache_set(self, key, value):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = (value, time.time() + self.cache_ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def get_item(self, key):
+        _val = self._cache_get(key)
+        if _val is None:
+            _val = self.db.get(key)
+            if _val is not None:
+                self._cache_set(key, _val)
+        return _val
+
+    def set_item(self, key, value):
+        if isinstance(value, ClientInfo):
+            value = dict(value)
+        self.db[key] = value
+        self._cache_set(key, value)
+
+    def delete_item(self, key):
+        self._cache_delete(key)
+        try:
+            del self.db[key]
+        except KeyError:
+            pass
+
+    def _view(self, client_id, cinfo):
+        if isinstance(cinfo, dict):
+            return ClientInfo(self, client_id, cinfo)
+        return cinfo
+
+    def __getitem__(self, client_id):
+        _cinfo = self.get_item(client_id)
+        if _cinfo is None:
+            raise KeyError(client_id)
+        return self._view(client_id, _cinfo)
+
+    def __setitem__(self, client_id, cinfo):
+        self.set_item(client_id, cinfo)
+
+    def __delitem__(self, client_id):
+        _cinfo = self.get_item(client_id)
+        if _cinfo is None:
+            raise KeyError(client_id)
+
+        try:
+            _rat = _cinfo["registration_access_token"]
+        except (KeyError, TypeError):
+            pass
+        else:
+            if self.registration_access_token.get(_rat) == client_id:
+                del self.registration_access_token[_rat]
+
+        self.delete_item(client_id)
+
+    def __contains__(self, client_id):
+        return self.get_item(client_id) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, client_id, default=None):
+        _cinfo = self.get_item(client_id)
+        if _cinfo is None:
+            return default
+        return self._view(client_id, _cinfo)
+
+    def keys(self):
+        return [k for k in self.db.keys() if not k.startswith(INDEX_PREFIX)]
+
+    def items(self):
+        for client_id in self.keys():
+            _cinfo = self.get_item(client_id)
+            if _cinfo is not None:
+                yield client_id, self._view(client_id, _cinfo)
+
+    def invalidate(self, client_id=None):
+        """
+        Drop cached information.
+
+        :param client_id: Only this client, otherwise everything
+        """
+        if client_id is None:
+            with self._lock:
+                self._cache.clear()
+        else:
+            self._cache_delete(client_id)
+
+    def sync(self):
+        try:
+            self.db.sync()
+        except AttributeError:
+            pass
+
+    def close(self):
+        try:
+            self.db.close()
+        except AttributeError:
+            pass
+
+    def clear(self):
+        self.db.clear()
+        self.invalidate()
@@ -1,4 +1,6 @@
 import logging
+import threading
+from collections import OrderedDict
 from urllib.parse import parse_qs
 from urllib.parse import unquote
 from urllib.parse import urlencode
@@ -52,6 +54,151 @@ def max_age(request):
     return request.get(verified_request, {}).get("max_age") or request.get("max_age", 0)
 
 
+def normalize_query(query):
+    """
+    Turns a query component into something that can be compared and hashed.
+
+    :param query: A dictionary as returned by parse_qs, a query string or None
+    :return: A frozenset of (key, frozenset of values) tuples
+    """
+    if not query:
+        return frozenset()
+    if isinstance(query, str):
+        query = parse_qs(query)
+
+    _res = []
+    for key, vals in query.items():
+        if isinstance(vals, str):
+            vals = [vals]
+        _res.append((key, frozenset(vals)))
+    return frozenset(_res)
+
+
+class RedirectURIMatcher(object):
+    """
+    The registered redirect URIs of a client compiled into a lookup table
+    keyed on base URI. The registered value set for every query parameter
+    must be exactly the one in the URI. If several URIs with the same base
+    are registered, the URI may match any of them.
+    """
+
+    def __init__(self, uris, max_verified=32):
+        """
+        :param uris: The registered URIs as a list of (base, query) tuples
+        :param max_verified: How many URIs that have passed verification
+            to remember
+        """
+        self.max_verified = max_verified
+        self._index = {}
+        for regbase, rquery in uris:
+            self._index.setdefault(regbase, set()).add(normalize_query(rquery))
+        self._verified = set()
+
+    def match(self, uri):
+        """
+        :param uri: The URI as found in the request
+        :raises: RedirectURIError or ValueError if the URI does not match
+            any of the registered.
+        """
+        if uri in self._verified:
+            return
+
+        (_base, _query) = split_uri(uri)
+        try:
+            _queries = self._index[_base]
+        except KeyError:
+            raise RedirectURIError("Doesn't match any registered uris")
+
+        if normalize_query(_query) not in _queries:
+            if not _query:
+                raise ValueError("Missing query part")
+            if _queries == {frozenset()}:
+                raise ValueError("No registered query part")
+            raise ValueError("Query part doesn't match any registered")
+
+        if len(self._verified) >= self.max_verified:
+            self._verified.clear()
+        self._verified.add(uri)
+
+
+class URIMatcherCache(object):
+    """
+    Compiled redirect URIs per client and URI type. A matcher is used for as
+    long as the client information it was compiled from is the one in the
+    client database, so writing the client information makes a new one be
+    compiled. At most max_size matchers are kept, the least recently used
+    are dropped.
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: Max number of matchers
+        """
+        self.max_size = max_size
+        self._matchers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, source):
+        """
+        :param key: (client_id, uri_type) tuple
+        :param source: The client information as stored
+        :return: A RedirectURIMatcher instance or None
+        """
+        with self._lock:
+            try:
+                _source, _matcher = self._matchers[key]
+            except KeyError:
+                return None
+            if _source is not source:
+                del self._matchers[key]
+                return None
+            self._matchers.move_to_end(key)
+            return _matcher
+
+    def set(self, key, source, matcher):
+        with self._lock:
+            self._matchers[key] = (source, matcher)
+            self._matchers.move_to_end(key)
+            while len(self._matchers) > self.max_size:
+                self._matchers.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._matchers.pop(key, None)
+
+    def __len__(self):
+        return len(self._matchers)
+
+
+def uri_matcher(endpoint_context, client_id, uri_type):
+    """
+    Get the compiled redirect URIs of a specific type for a client.
+    A new matcher is compiled the first time and whenever the client
+    information has been written.
+
+    :param endpoint_context: An EndpointContext instance
+    :param client_id: Client ID
+    :param uri_type: redirect_uri or post_logout_redirect_uri
+    :return: A RedirectURIMatcher instance
+    """
+    _cdb = endpoint_context.cdb
+    # As stored, a ClientDatabase hands out a new view on every lookup
+    _cinfo = getattr(_cdb, "get_item", _cdb.get)(client_id)
+    _key = (client_id, uri_type)
+    redirect_uris = (_cinfo or {}).get("{}s".format(uri_type))
+    if not redirect_uris:
+        endpoint_context.uri_matchers.discard(_key)
+        if _cinfo is None:
+            raise KeyError("No such client")
+        raise ValueError("No registered {}".format(uri_type))
+
+    _matcher = endpoint_context.uri_matchers.get(_key, _cinfo)
+    if _matcher is None:
+        _matcher = RedirectURIMatcher(redirect_uris)
+        endpoint_context.uri_matchers.set(_key, _cinfo, _matcher)
+    return _matcher
+
+
 def verify_uri(endpoint_context, request, uri_type, client_id=None):
     """
     A redirect URI
@@ -69,65 +216,12 @@ def verify_uri(endpoint_context, request, uri_type, client_id=None):
     if not _cid:
         logger.error("No client id found")
         raise UnknownClient("No client_id provided")
-    else:
-        logger.debug('Client ID: {}'.format(_cid))
 
     _redirect_uri = unquote(request[uri_type])
-
-    part = urlparse(_redirect_uri)
-    if part.fragment:
+    if "#" in _redirect_uri and urlparse(_redirect_uri).fragment:
         raise URIError("Contains fragment")
 
-    (_base, _query) = split_uri(_redirect_uri)
-    # if _query:
-    #     _query = parse_qs(_query)
-
-    match = False
-    # Get the clients registered redirect uris
-    logger.debug('Client info: {}'.format(endpoint_context.cdb[_cid]))
-    redirect_uris = endpoint_context.cdb.get(_cid, {}).get("{}s".format(uri_type))
-    if not redirect_uris:
-        if _cid not in endpoint_context.cdb:
-            logger.debug("CIDs: {}".format(list(endpoint_context.cdb.keys())))
-            raise KeyError("No such client")
-        raise ValueError("No registered {}".format(uri_type))
-    else:
-        for regbase, rquery in redirect_uris:
-            # The URI MUST exactly match one of the Redirection URI
-            if _base == regbase:
-                # every registered query component must exist in the uri
-                if rquery:
-                    if not _query:
-                        raise ValueError("Missing query part")
-
-                    for key, vals in rquery.items():
-                        if key not in _query:
-                            raise ValueError('"{}" not in query part'.format(key))
-
-                        for val in vals:
-                            if val not in _query[key]:
-                                raise ValueError(
-                                    "{}={} value not in query part".format(key, val)
-                                )
-
-                # and vice versa, every query component in the uri
-                # must be registered
-                if _query:
-                    if not rquery:
-                        raise ValueError("No registered query part")
-
-                    for key, vals in _query.items():
-                        if key not in rquery:
-                            raise ValueError('"{}" extra in query part'.format(key))
-                        for val in vals:
-                            if val not in rquery[key]:
-                                raise ValueError(
-                                    "Extra {}={} value in query part".format(key, val)
-                                )
-                match = True
-                break
-        if not match:
-            raise RedirectURIError("Doesn't match any registered uris")
+    uri_matcher(endpoint_context, _cid, uri_type).match(_redirect_uri)
 
 
 def join_query(base, query):
@@ -10,6 +10,7 @@ from oidcmsg.message import Message
 from oidcmsg.oauth2 import ResponseMessage
 
 from oidcendpoint import sanitize
+from oidcendpoint.client_authn import ClientAuthnDispatcher
 from oidcendpoint.client_authn import UnknownOrNoAuthnMethod
 from oidcendpoint.client_authn import client_auth_setup
 from oidcendpoint.client_authn import verify_client
@@ -55,6 +56,12 @@ do_response returns a dictionary that can look like this:
 "cookie": MAY be present
 "response_placement": If absent defaults to the endpoints response_placement
     parameter value or if that is also missing 'url'
+
+For use with asyncio there are async_parse_request, async_process_request
+and async_do_response. Unless the endpoint is marked as non blocking they
+run the synchronous methods in the endpoint context's thread pool. Unless
+all the databases are thread safe the pool has one thread, see
+oidcendpoint.aio.
 """
 
 
@@ -156,6 +163,11 @@ class Endpoint(object):
     response_placement = "body"
     client_authn_method = ""
     default_capabilities = None
+    _client_authn_dispatcher = None
+    _allowed_target_uris = None
+    # Whether parse_request/process_request/do_response may block on
+    # outbound requests or storage
+    blocking = True
 
     def __init__(self, endpoint_context, **kwargs):
         self.endpoint_context = endpoint_context
@@ -264,6 +276,22 @@ class Endpoint(object):
     def get_client_id_from_token(self, endpoint_context, token, request=None):
         return ""
 
+    @property
+    def client_authn_dispatcher(self):
+        """
+        Dispatcher over client_authn_method, rebuilt if the list is replaced
+        or changed.
+        """
+        _dispatcher = self._client_authn_dispatcher
+        if (
+            _dispatcher is None
+            or _dispatcher.methods is not self.client_authn_method
+            or _dispatcher.snapshot != tuple(self.client_authn_method or [])
+        ):
+            _dispatcher = ClientAuthnDispatcher(self.client_authn_method)
+            self._client_authn_dispatcher = _dispatcher
+        return _dispatcher
+
     def client_authentication(self, request, auth=None, **kwargs):
         """
         Do client authentication
@@ -324,6 +352,31 @@ class Endpoint(object):
         """
         return {}
 
+    async def _async_call(self, func, *args, **kwargs):
+        if self.blocking:
+            return await self.endpoint_context.run(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    async def async_parse_request(self, request, auth=None, **kwargs):
+        """
+        Async version of parse_request.
+        """
+        return await self._async_call(self.parse_request, request, auth=auth, **kwargs)
+
+    async def async_process_request(self, request=None, **kwargs):
+        """
+        Async version of process_request.
+        """
+        return await self._async_call(self.process_request, request, **kwargs)
+
+    async def async_do_response(self, response_args=None, request=None, **kwargs):
+        """
+        Async version of do_response.
+        """
+        return await self._async_call(
+            self.do_response, response_args, request, **kwargs
+        )
+
     def construct(self, response_args, request, **kwargs):
         """
         Construct the response
@@ -439,10 +492,24 @@ class Endpoint(object):
         return _resp
 
     def allowed_target_uris(self):
+        """
+        The URIs a JWT may have as audience when sent to this endpoint.
+        Computed once and reused until the issuer or the list of allowed
+        targets changes.
+
+        :return: frozenset of URIs
+        """
+        _state = (self.endpoint_context.issuer, tuple(self.allowed_targets))
+        _cached = self._allowed_target_uris
+        if _cached is not None and _cached[0] == _state:
+            return _cached[1]
+
         res = []
         for t in self.allowed_targets:
             if t == "":
                 res.append(self.endpoint_context.issuer)
             else:
                 res.append(self.endpoint_context.endpoint[t].full_path)
-        return set(res)
+        res = frozenset(res)
+        self._allowed_target_uris = (_state, res)
+        return res
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -10,15 +11,27 @@ from oidcmsg.oidc import IdToken
 
 from oidcendpoint import authz
 from oidcendpoint import rndstr
+from oidcendpoint.aio import AsyncHTTPClient
+from oidcendpoint.aio import ExecutorMixin
+from oidcendpoint.aio import is_thread_safe
+from oidcendpoint.client_authn import AssertionKeyCache
 from oidcendpoint.client_authn import CLIENT_AUTHN_METHOD
+from oidcendpoint.client_authn import SecretVerifier
+from oidcendpoint.client_db import ClientDatabase
+from oidcendpoint.common.authorization import URIMatcherCache
+from oidcendpoint.http_cache import CachingHTTPClient
 from oidcendpoint.id_token import IDToken
-from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.in_memory_db import ConcurrentInMemoryDataBase
+from oidcendpoint.replay_cache import ReplayCache
 from oidcendpoint.session import create_session_db
 from oidcendpoint.sso_db import SSODb
 from oidcendpoint.template_handler import Jinja2TemplateHandler
 from oidcendpoint.user_authn.authn_context import populate_authn_broker
 from oidcendpoint.user_info import SCOPE2CLAIMS
 from oidcendpoint.util import build_endpoints
+from oidcendpoint.util import EncodedDocument
+from oidcendpoint.util import conf_fingerprint
+from oidcendpoint.util import key_state
 from oidcendpoint.util import get_http_params
 from oidcendpoint.util import importer
 
@@ -62,6 +75,48 @@ def init_service(conf, endpoint_context=None):
     return conf["class"](**kwargs)
 
 
+def read_provider_info_snapshot(path, fingerprint):
+    """
+    Read provider info saved by write_provider_info_snapshot.
+
+    :param path: The snapshot file
+    :param fingerprint: Fingerprint of the present configuration
+    :return: The provider info or None if there is no snapshot or it was
+        made from another configuration
+    """
+    try:
+        with open(path) as fp:
+            _snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    if _snapshot.get("fingerprint") != fingerprint:
+        logger.debug("Provider info snapshot %s is stale", path)
+        return None
+    return _snapshot.get("provider_info")
+
+
+def write_provider_info_snapshot(path, fingerprint, provider_info):
+    """
+    Save provider info so it doesn't have to be computed on the next start.
+
+    :param path: The snapshot file
+    :param fingerprint: Fingerprint of the configuration
+    :param provider_info: The provider info
+    """
+    _tmp = "{}.tmp".format(path)
+    try:
+        with open(_tmp, "w") as fp:
+            json.dump({"fingerprint": fingerprint, "provider_info": provider_info}, fp)
+        os.replace(_tmp, path)
+    except (OSError, TypeError) as err:
+        logger.warning("Could not write provider info snapshot: %s", err)
+        try:
+            os.remove(_tmp)
+        except OSError:
+            pass
+
+
 def get_token_handlers(conf):
     th_args = conf.get("token_handler_args", None)
     if not th_args:
@@ -84,7 +139,7 @@ def get_token_handlers(conf):
     return th_args
 
 
-class EndpointContext:
+class EndpointContext(ExecutorMixin):
     def __init__(
         self,
         conf,
@@ -98,8 +153,17 @@ class EndpointContext:
         cookie_name=None,
         jwks_uri_path=None,
         jti_db=None,
+        async_httpc=None,
     ):
         self.conf = conf
+        # Before the configuration is touched by anything else
+        if conf.get("provider_info_snapshot"):
+            self.conf_fingerprint = conf_fingerprint(conf)
+        else:
+            self.conf_fingerprint = None
+        # Endpoints and authentication methods are instantiated on first use,
+        # endpoints are then keyed by the name set on their class
+        self.lazy_init = conf.get("lazy_init", False)
         self.keyjar = keyjar or KeyJar()
         self.cwd = cwd
 
@@ -115,7 +179,21 @@ class EndpointContext:
         # Default values, to be changed below depending on configuration
         self.endpoint = {}
         self.issuer = ""
-        self.httpc = httpc or requests
+        # GET responses are only cached if http_cache is configured
+        _cache_conf = conf.get("http_cache")
+        if _cache_conf:
+            if _cache_conf is True:
+                _cache_conf = {}
+            self.httpc = CachingHTTPClient(httpc or requests, **_cache_conf)
+        else:
+            self.httpc = httpc or requests
+        # Size of the thread pool used by the async endpoint methods
+        self.max_workers = conf.get("async_workers")
+        self._async_httpc = async_httpc
+        # The published JWKS, encoded once per key rotation
+        self.jwks_document = EncodedDocument(
+            self._encode_jwks, max_age=conf.get("jwks_max_age", 3600)
+        )
         self.jwks_uri = None
         self.sso_ttl = 14400  # 4h
         self.symkey = rndstr(24)
@@ -123,15 +201,21 @@ class EndpointContext:
         self.idtoken = None
         self.authn_broker = None
         self.authz = None
-        self.endpoint_to_authn_method = {}
+        self._endpoint_to_authn_method = {}
         self.cookie_dealer = cookie_dealer
+        # Remembers recently verified hashed client secrets
+        self.client_secret_verifier = SecretVerifier(**conf.get("client_secret_cache", {}))
+        # Client assertion verification keys per client
+        self.assertion_keys = AssertionKeyCache(self.keyjar)
+        # Compiled redirect URIs per (client_id, uri_type)
+        self.uri_matchers = URIMatcherCache(**conf.get("uri_matcher_cache", {}))
         self.login_hint_lookup = None
         self.login_hint2acrs = None
         self.userinfo = None
         self.scope2claims = SCOPE2CLAIMS
         # arguments for endpoints add-ons
         self.args = {}
-        self.par_db = {}
+        self.par_db = ConcurrentInMemoryDataBase()
         self.dev_auth_db = {}
 
         for param in [
@@ -149,7 +233,7 @@ class EndpointContext:
         self.th_args = get_token_handlers(conf)
 
         # client database
-        self.set_client_db()
+        self.set_client_db(client_db)
 
         # session db
         self._sub_func = {}
@@ -215,14 +299,30 @@ class EndpointContext:
             if _func:
                 _func()
 
-        _cap = self.do_endpoints()
+        # With lazy_init a provider info snapshot means the endpoints don't
+        # have to be instantiated to find out what they support.
+        _snapshot_path = conf.get("provider_info_snapshot")
+        _provider_info = None
+        if self.lazy_init and _snapshot_path:
+            _provider_info = read_provider_info_snapshot(
+                _snapshot_path, self.conf_fingerprint
+            )
+
+        _cap = self.do_endpoints(capabilities=_provider_info is None)
 
         for item in ["userinfo", "login_hint_lookup", "login_hint2acrs", "add_on"]:
             _func = getattr(self, "do_{}".format(item), None)
             if _func:
                 _func()
 
-        self.provider_info = self.create_providerinfo(_cap)
+        if _provider_info is None:
+            self.provider_info = self.create_providerinfo(_cap)
+            if _snapshot_path:
+                write_provider_info_snapshot(
+                    _snapshot_path, self.conf_fingerprint, self.provider_info
+                )
+        else:
+            self.provider_info = _provider_info
 
         # which signing/encryption algorithms to use in what context
         self.jwx_def = {}
@@ -230,8 +330,9 @@ class EndpointContext:
         # special type of logging
         self.events = None
 
-        # client registration access tokens
-        self.registration_access_token = {}
+        # client registration access tokens, used if the client database
+        # isn't a ClientDatabase
+        self._registration_access_token = {}
 
         # The HTTP clients request arguments
         _cnf = conf.get("http_params")
@@ -260,20 +361,118 @@ class EndpointContext:
         logger.debug("Session DB: {}".format(self.sdb.__dict__))
 
     def set_jti_db(self, db=None):
+        """
+        Sets up the replay cache for JWT IDs. If a database is given or
+        configured it is shared with other workers and kept as jti_db,
+        otherwise jti_db is None.
+
+        :param db: Database
+        """
         if db is None and self.conf.get("jti_db"):
             _spec = self.conf.get("jti_db")
             _kwargs = _spec.get("kwargs", {})
-            self.jti_db = importer(_spec["class"])(**_kwargs)
-        else:
-            self.jti_db = db or InMemoryDataBase()
+            db = importer(_spec["class"])(**_kwargs)
+
+        self.jti_db = db
+        self.replay_cache = ReplayCache(db, **self.conf.get("replay_cache", {}))
 
     def set_client_db(self, db=None):
+        """
+        The client database is a ClientDatabase instance. If something else
+        is configured it is used as the backend of one.
+
+        :param db: Client database or backend
+        """
+        _cache = {}
         if db is None and self.conf.get("client_db"):
             _spec = self.conf.get("client_db")
             _kwargs = _spec.get("kwargs", {})
-            self.cdb = importer(_spec["class"])(**_kwargs)
+            db = importer(_spec["class"])(**_kwargs)
+            _cache = _spec.get("cache", {})
+        elif db is None:
+            # Caching in front of an in-memory database is pointless
+            _cache = {"cache_size": 0}
+
+        if isinstance(db, ClientDatabase):
+            self.cdb = db
         else:
-            self.cdb = {}
+            self.cdb = ClientDatabase(db, **_cache)
+
+    @property
+    def endpoint_to_authn_method(self):
+        """
+        Authentication methods by the endpoint they post to. Built on first
+        use, so lazily instantiated methods are left alone until then.
+        """
+        if self._endpoint_to_authn_method is None:
+            _map = {}
+            for method in self.authn_broker or []:
+                try:
+                    _map[method.action] = method
+                except AttributeError:
+                    pass
+            self._endpoint_to_authn_method = _map
+        return self._endpoint_to_authn_method
+
+    @endpoint_to_authn_method.setter
+    def endpoint_to_authn_method(self, value):
+        self._endpoint_to_authn_method = value
+
+    def _encode_jwks(self):
+        return json.dumps(self.keyjar.export_jwks())
+
+    def _databases(self):
+        _sdb = getattr(self, "sdb", None)
+        _dbs = [self.par_db, self.jti_db]
+        for _holder in [getattr(self, "cdb", None), _sdb, getattr(_sdb, "sso_db", None)]:
+            if _holder is not None:
+                _dbs.append(getattr(_holder, "db", _holder))
+        return _dbs
+
+    @property
+    def thread_safe(self):
+        """
+        True if the databases can be used from several threads at once.
+        """
+        return all(is_thread_safe(db) for db in self._databases())
+
+    def pool_size(self):
+        if self.thread_safe:
+            return self.max_workers
+        logger.warning(
+            "Not all databases are thread safe, async requests are handled one "
+            "at a time"
+        )
+        return 1
+
+    @property
+    def async_httpc(self):
+        """
+        HTTP client for use from coroutines. Unless one was given, the
+        HTTP client wrapped to run in the thread pool.
+        """
+        if self._async_httpc is None:
+            self._async_httpc = AsyncHTTPClient(self.httpc, executor=self.executor)
+        return self._async_httpc
+
+    def jwks_response(self, if_none_match=None):
+        """
+        The public keys, to be published at jwks_uri. Served pre-encoded
+        with an ETag, the same way as the provider info.
+
+        :param if_none_match: The value of the requests If-None-Match header
+        :return: dictionary in the form returned by Endpoint.do_response
+        """
+        _state = (self.keyjar, key_state(self.keyjar, ""))
+        return self.jwks_document.response(_state, if_none_match)
+
+    @property
+    def registration_access_token(self):
+        try:
+            return self.cdb.registration_access_token
+        except AttributeError:
+            # cdb has been replaced by a dictionary
+            return self._registration_access_token
 
     def do_add_on(self):
         if self.conf.get("add_on"):
@@ -319,17 +518,12 @@ class EndpointContext:
         _conf = self.conf.get("authentication")
         if _conf:
             self.authn_broker = populate_authn_broker(
-                _conf, self, self.template_handler
+                _conf, self, self.template_handler, lazy=self.lazy_init
             )
         else:
             self.authn_broker = {}
 
-        self.endpoint_to_authn_method = {}
-        for method in self.authn_broker:
-            try:
-                self.endpoint_to_authn_method[method.action] = method
-            except AttributeError:
-                pass
+        self._endpoint_to_authn_method = None
 
     def do_cookie_dealer(self):
         _conf = self.conf.get("cookie_dealer")
@@ -353,13 +547,24 @@ class EndpointContext:
             self, self.th_args, db=db, sso_db=sso_db, sub_func=self._sub_func
         )
 
-    def do_endpoints(self):
+    def do_endpoints(self, capabilities=True):
+        """
+        Set up the endpoints.
+
+        :param capabilities: Whether to collect what the endpoints support.
+            Doing so instantiates every endpoint.
+        :return: The capabilities or None
+        """
         self.endpoint = build_endpoints(
             self.conf["endpoint"],
             endpoint_context=self,
             issuer=self.conf["issuer"],
+            lazy=self.lazy_init,
         )
 
+        if not capabilities:
+            return None
+
         _cap = self.conf.get("capabilities", {})
 
         for endpoint, endpoint_instance in self.endpoint.items():
@@ -0,0 +1,315 @@
+"""
+A caching wrapper around the HTTP client. Used for documents the OP
+fetches from RPs, like request objects referenced by request_uri and
+sector identifier documents, so repeat clients don't cause network I/O on
+the request path.
+"""
+import copy
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# Arguments to get() that don't affect the response
+IGNORED_ARGS = ["timeout", "stream"]
+
+
+def cache_key(url, kwargs):
+    """
+    The key a response is cached under. Requests to the same URL made with
+    different headers, authentication, TLS verification and so on are
+    cached separately.
+
+    :param url: The URL
+    :param kwargs: The other arguments to get()
+    :return: A string
+    """
+    _args = {k: v for k, v in kwargs.items() if k not in IGNORED_ARGS and v is not None}
+    if not _args:
+        return url
+    return json.dumps([url, _args], sort_keys=True, default=repr)
+
+
+def copy_error(err):
+    """
+    A new instance of an exception, so that the same instance is not raised
+    in several threads.
+    """
+    try:
+        return copy.copy(err)
+    except Exception:
+        return requests.RequestException(str(err))
+
+
+class CachedResponse(object):
+    """
+    What is kept of a response. Has the attributes of a requests Response
+    that callers of the HTTP client use.
+    """
+
+    def __init__(self, status_code, content, headers=None, url="", reason="",
+                 encoding=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.url = url
+        self.reason = reason
+        self.encoding = encoding
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(
+            response.status_code,
+            response.content,
+            response.headers,
+            url=getattr(response, "url", ""),
+            reason=getattr(response, "reason", ""),
+            encoding=response.encoding,
+        )
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    @property
+    def status(self):
+        return self.status_code
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(
+                "{} Error: {} for url: {}".format(self.status_code, self.reason, self.url),
+                response=self,
+            )
+
+
+class CacheEntry(object):
+    def __init__(self, response=None, error=None, expires=0):
+        self.response = response
+        self.error = error
+        self.expires = expires
+
+    def is_fresh(self, when):
+        return when < self.expires
+
+    @property
+    def etag(self):
+        if self.response is None:
+            return None
+        return self.response.headers.get("ETag")
+
+    @property
+    def last_modified(self):
+        if self.response is None:
+            return None
+        return self.response.headers.get("Last-Modified")
+
+
+class Flight(object):
+    """A fetch in progress that other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header.
+
+    :param value: The header value
+    :return: dictionary with directives as keys
+    """
+    res = {}
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "=" in part:
+            key, val = part.split("=", 1)
+            res[key.strip().lower()] = val.strip().strip('"')
+        else:
+            res[part.lower()] = None
+    return res
+
+
+class CachingHTTPClient(object):
+    """
+    Wraps an HTTP client, by default requests. GET responses are cached
+    following Cache-Control and Expires, and revalidated using ETag and
+    Last-Modified. Failures are remembered for a short while. Concurrent
+    fetches of the same URL are done once. Responses are cached per URL and
+    the arguments given to get(), apart from the time out. Everything
+    except get() is handed over to the wrapped client.
+    """
+
+    def __init__(self, httpc=None, max_entries=1024, max_body_size=65536,
+                 default_ttl=0, max_ttl=86400, negative_ttl=10):
+        """
+        :param httpc: The HTTP client to wrap
+        :param max_entries: Max number of cached URLs
+        :param max_body_size: Larger responses are not cached
+        :param default_ttl: How long, in seconds, a response without
+            freshness information is used without revalidation
+        :param max_ttl: Upper limit on how long a response is used without
+            revalidation
+        :param negative_ttl: How long error responses and connection
+            errors are remembered. 0 means not at all.
+        """
+        self.httpc = httpc or requests
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+
+        self._cache = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, item):
+        return getattr(self.httpc, item)
+
+    def _lifetime(self, response, when):
+        _cc = parse_cache_control(response.headers.get("Cache-Control", ""))
+        if "no-store" in _cc:
+            return None
+        if "no-cache" in _cc:
+            return 0
+
+        for directive in ["s-maxage", "max-age"]:
+            if directive in _cc:
+                try:
+                    return min(int(_cc[directive]), self.max_ttl)
+                except (TypeError, ValueError):
+                    return 0
+
+        _expires = response.headers.get("Expires")
+        if _expires:
+            try:
+                return min(
+                    max(parsedate_to_datetime(_expires).timestamp() - when, 0),
+                    self.max_ttl,
+                )
+            except (TypeError, ValueError):
+                return 0
+
+        return self.default_ttl
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _fetch(self, key, url, entry, **kwargs):
+        when = time.time()
+        _headers = dict(kwargs.pop("headers", None) or {})
+        if entry and entry.response is not None:
+            if entry.etag:
+                _headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                _headers["If-Modified-Since"] = entry.last_modified
+        if _headers:
+            kwargs["headers"] = _headers
+
+        try:
+            _resp = self.httpc.get(url, **kwargs)
+        except Exception as err:
+            logger.info("Could not fetch {}: {}".format(url, err))
+            _entry = CacheEntry(error=err, expires=when + self.negative_ttl)
+            if self.negative_ttl:
+                self._store(key, _entry)
+            return _entry
+
+        if _resp.status_code == 304 and entry and entry.response is not None:
+            # Still the same, the new headers say for how long
+            _response = entry.response
+            _response.headers.update(
+                {k: v for k, v in _resp.headers.items()
+                 if k.lower() in ("cache-control", "expires", "etag", "last-modified")}
+            )
+        else:
+            _response = CachedResponse.from_response(_resp)
+
+        if _response.status_code >= 400:
+            _entry = CacheEntry(response=_response, expires=when + self.negative_ttl)
+            if self.negative_ttl:
+                self._store(key, _entry)
+            return _entry
+
+        _lifetime = self._lifetime(_response, when)
+        _entry = CacheEntry(response=_response, expires=when + (_lifetime or 0))
+        if (
+            _lifetime is not None
+            and (_lifetime or _entry.etag or _entry.last_modified)
+            and len(_response.content) <= self.max_body_size
+        ):
+            self._store(key, _entry)
+        else:
+            with self._lock:
+                self._cache.pop(key, None)
+        return _entry
+
+    def get(self, url, **kwargs):
+        """
+        Fetch a document, from the cache if possible.
+
+        :param url: The URL
+        :param kwargs: Extra arguments to the wrapped client
+        :return: A response
+        """
+        when = time.time()
+        key = cache_key(url, kwargs)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry.is_fresh(when):
+                self._cache.move_to_end(key)
+            else:
+                # Only one fetch per URL at any time
+                try:
+                    _flight = self._flights[key]
+                except KeyError:
+                    _flight = self._flights[key] = Flight()
+                    _leader = True
+                else:
+                    _leader = False
+
+        if entry is None or not entry.is_fresh(when):
+            if _leader:
+                try:
+                    entry = self._fetch(key, url, entry, **kwargs)
+                finally:
+                    _flight.entry = entry
+                    with self._lock:
+                        del self._flights[key]
+                    _flight.done.set()
+            else:
+                _flight.done.wait()
+                entry = _flight.entry
+                if entry is None:
+                    # The fetch failed badly, try on my own
+                    entry = self._fetch(key, url, None, **kwargs)
+
+        if entry.error is not None:
+            raise copy_error(entry.error)
+        return entry.response
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
@@ -1,7 +1,12 @@
+import json
 import logging
+import uuid
 
+from cryptojwt.jwk.asym import AsymmetricKey
+from cryptojwt.jws.jws import SIGNER_ALGS
 from cryptojwt.jws.utils import left_hash
 from cryptojwt.jwt import JWT
+from cryptojwt.utils import b64encode_item
 
 from oidcendpoint.endpoint import construct_endpoint_info
 from oidcendpoint.userinfo import collect_user_info
@@ -18,6 +23,27 @@ DEF_SIGN_ALG = {
 }
 DEF_LIFETIME = 300
 
+# The client registration parameters a client's ID Token profile depends on
+PROFILE_ATTRIBUTES = [
+    "id_token_signed_response_alg",
+    "id_token_encrypted_response_alg",
+    "id_token_encrypted_response_enc",
+    "id_token_claims",
+    "backchannel_logout_uri",
+    "frontchannel_logout_uri",
+]
+
+# The provider info parameters the ID Token profiles depend on
+PROFILE_PROVIDER_ATTRIBUTES = [
+    "id_token_signing_alg_values_supported",
+    "id_token_encryption_alg_values_supported",
+    "id_token_encryption_enc_values_supported",
+    "backchannel_logout_supported",
+    "backchannel_logout_session_supported",
+    "frontchannel_logout_supported",
+    "frontchannel_logout_session_supported",
+]
+
 
 def include_session_id(endpoint_context, client_id, where):
     """
@@ -102,6 +128,79 @@ def get_sign_and_encrypt_algorithms(
     return args
 
 
+class JWTBatchSigner(object):
+    """
+    Signs many JWTs with the same key. The key is picked from the key jar
+    and the protected header serialized once, after that each token costs
+    one signature. Optionally the signing is spread over a worker pool,
+    the cryptography package releases the GIL while doing RSA/EC
+    operations so threads work.
+    """
+
+    def __init__(self, keyjar, issuer, alg, lifetime=0, kid="", with_jti=False,
+                 executor=None):
+        """
+        :param keyjar: A cryptojwt.key_jar.KeyJar instance
+        :param issuer: Issuer ID, the owner of the signing key
+        :param alg: Signing algorithm
+        :param lifetime: Lifetime of the tokens in seconds
+        :param kid: Key ID, if a specific key should be used
+        :param with_jti: If a jti claim should be added
+        :param executor: A concurrent.futures.Executor instance
+        """
+        self.jwt = JWT(keyjar, iss=issuer, lifetime=lifetime, sign_alg=alg)
+        self.with_jti = with_jti
+        self.executor = executor
+
+        _header = {"alg": alg}
+        if alg == "none":
+            self.key = None
+        else:
+            _key = self.jwt.pack_key(issuer, kid)
+            if _key.kid:
+                _header["kid"] = _key.kid
+            if isinstance(_key, AsymmetricKey):
+                self.key = _key.private_key()
+            else:
+                self.key = _key.key
+            self.signer = SIGNER_ALGS[alg]
+        self.header = b64encode_item(_header).decode("utf-8")
+
+    def sign(self, payload, recv="", aud=None):
+        """
+        Sign one JWT.
+
+        :param payload: Claims
+        :param recv: The intended receiver
+        :param aud: Intended audience
+        :return: A signed JWT
+        """
+        _args = dict(payload)
+        _args.update(self.jwt.pack_init(recv, aud))
+        if self.with_jti:
+            _args["jti"] = uuid.uuid4().hex
+
+        _input = ".".join(
+            [self.header, b64encode_item(json.dumps(_args)).decode("utf-8")]
+        )
+        if self.key is None:
+            return _input + "."
+
+        _sig = self.signer.sign(_input.encode("utf-8"), self.key)
+        return ".".join([_input, b64encode_item(_sig).decode("utf-8")])
+
+    def sign_many(self, items):
+        """
+        Sign many JWTs.
+
+        :param items: List of (payload, recv) tuples
+        :return: List of signed JWTs, in the same order as the items
+        """
+        if self.executor and len(items) > 1:
+            return list(self.executor.map(lambda item: self.sign(*item), items))
+        return [self.sign(*item) for item in items]
+
+
 class IDToken(object):
     default_capabilities = {
         "id_token_signing_alg_values_supported": None,
@@ -119,6 +218,73 @@ class IDToken(object):
         self.provider_info = construct_endpoint_info(
             self.default_capabilities, **kwargs
         )
+        # client_id -> compiled ID Token profile
+        self._profiles = {}
+
+    def client_profile(self, client_id):
+        """
+        What goes into every ID Token issued to a client: claims, whether to
+        add the session ID and the signing/encryption algorithms. Compiled
+        once per client and recompiled if the registration parameters it
+        depends on change.
+
+        :param client_id: Client ID
+        :return: dictionary
+        """
+        _cntx = self.endpoint_context
+        _cinfo = _cntx.cdb[client_id]
+        # Serialized, so that in place updates of nested values are noticed
+        _fingerprint = json.dumps(
+            [
+                [_cinfo.get(attr) for attr in PROFILE_ATTRIBUTES],
+                [_cntx.provider_info.get(attr) for attr in PROFILE_PROVIDER_ATTRIBUTES],
+                _cntx.jwx_def,
+                self.enable_claims_per_client,
+                self.kwargs.get("default_claims"),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+        try:
+            _profile = self._profiles[client_id]
+        except KeyError:
+            pass
+        else:
+            if _profile["fingerprint"] == _fingerprint:
+                return _profile
+
+        _claims = dict(self.kwargs.get("default_claims", {}))
+        if self.enable_claims_per_client:
+            _claims.update(_cinfo.get("id_token_claims", {}))
+
+        _profile = {
+            "fingerprint": _fingerprint,
+            "claims": _claims,
+            "add_sid": (
+                include_session_id(self.endpoint_context, client_id, "back")
+                or include_session_id(self.endpoint_context, client_id, "front")
+            ),
+            # (sign, encrypt, lifetime) -> JWT instance
+            "jwt": {},
+        }
+        self._profiles[client_id] = _profile
+        return _profile
+
+    def _jwt(self, client_id, sign, encrypt, lifetime):
+        _profile = self.client_profile(client_id)
+        try:
+            return _profile["jwt"][(sign, encrypt, lifetime)]
+        except KeyError:
+            pass
+
+        _cntx = self.endpoint_context
+        alg_dict = get_sign_and_encrypt_algorithms(
+            _cntx, _cntx.cdb[client_id], "id_token", sign=sign, encrypt=encrypt
+        )
+        _jwt = JWT(_cntx.keyjar, iss=_cntx.issuer, lifetime=lifetime, **alg_dict)
+        _profile["jwt"][(sign, encrypt, lifetime)] = _jwt
+        return _jwt
 
     def payload(
         self,
@@ -216,19 +382,16 @@ class IDToken(object):
         :return: IDToken as a signed and/or encrypted JWT
         """
 
-        _cntx = self.endpoint_context
-
-        client_info = _cntx.cdb[client_id]
-        alg_dict = get_sign_and_encrypt_algorithms(
-            _cntx, client_info, "id_token", sign=sign, encrypt=encrypt
-        )
+        if lifetime is None:
+            lifetime = DEF_LIFETIME
+        _jwt = self._jwt(client_id, sign, encrypt, lifetime)
 
         _authn_event = session_info["authn_event"]
 
         _idt_info = self.payload(
             session_info,
             acr=_authn_event["authn_info"],
-            alg=alg_dict["sign_alg"],
+            alg=_jwt.alg,
             code=code,
             access_token=access_token,
             user_info=user_info,
@@ -237,13 +400,20 @@ class IDToken(object):
             extra_claims=extra_claims,
         )
 
-        _jwt = JWT(
-            _cntx.keyjar, iss=_cntx.issuer, lifetime=_idt_info["lifetime"], **alg_dict
-        )
-
         return _jwt.pack(_idt_info["payload"], recv=client_id)
 
-    def make(self, req, sess_info, authn_req=None, user_claims=False, **kwargs):
+    def make(self, req, sess_info, authn_req=None, user_claims=False, sid="",
+             **kwargs):
+        """
+        Construct an ID Token.
+
+        :param req: The request
+        :param sess_info: Session information
+        :param authn_req: The authorization request
+        :param user_claims: If user info should be included
+        :param sid: Session ID. If not given and needed it's looked up.
+        :return: IDToken as a signed and/or encrypted JWT
+        """
         _context = self.endpoint_context
 
         if authn_req:
@@ -251,11 +421,8 @@ class IDToken(object):
         else:
             _client_id = req["client_id"]
 
-        _cinfo = _context.cdb[_client_id]
-
-        idtoken_claims = dict(self.kwargs.get("default_claims", {}))
-        if self.enable_claims_per_client:
-            idtoken_claims.update(_cinfo.get("id_token_claims", {}))
+        _profile = self.client_profile(_client_id)
+        idtoken_claims = dict(_profile["claims"])
         lifetime = self.kwargs.get("lifetime")
 
         userinfo = userinfo_in_id_token_claims(
@@ -270,16 +437,12 @@ class IDToken(object):
                 userinfo.update(info)
 
         # Should I add session ID
-        req_sid = include_session_id(
-            _context, _client_id, "back"
-        ) or include_session_id(_context, _client_id, "front")
-
-        if req_sid:
-            xargs = {
-                "sid": _context.sdb.get_sid_by_sub_and_client_id(
+        if _profile["add_sid"]:
+            if not sid:
+                sid = _context.sdb.get_sid_by_sub_and_client_id(
                     sess_info["sub"], _client_id
                 )
-            }
+            xargs = {"sid": sid}
         else:
             xargs = {}
 
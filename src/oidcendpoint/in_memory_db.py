@@ -1,31 +1,73 @@
+import threading
+import weakref
+
+from oidcendpoint.util import ExpiryQueue
+from oidcendpoint.util import MemberSet
+from oidcendpoint.util import add_member
+from oidcendpoint.util import live_members
+from oidcendpoint.util import remove_members
+
+
 class InMemoryDataBase(object):
-    def __init__(self):
+    def __init__(self, sweep_batch=16):
         self.db = {}
+        self.expiry = ExpiryQueue()
+        # Max number of expired items removed per write
+        self.sweep_batch = sweep_batch
 
     def __contains__(self, key):
-        if self.db.get(key):
+        if self.get(key):
             return 1
 
     def __getitem__(self, key):
-        return self.db.get(key, None)
+        return self.get(key)
 
     def __setitem__(self, key, value):
-        self.db[key] = value
+        self.set(key, value)
 
     def __delitem__(self, key):
+        self.expiry.discard(key)
         del self.db[key]
 
-    def set(self, key, value):
+    def set(self, key, value, ttl=None):
+        """
+        Store a value.
+
+        :param key: The key
+        :param value: The value
+        :param ttl: Time to live in seconds, None means for ever
+        """
         self.db[key] = value
+        if ttl:
+            self.expiry.add(key, ttl)
+        else:
+            self.expiry.discard(key)
+        self.sweep(self.sweep_batch)
 
     def get(self, key):
+        if self.expiry.is_expired(key):
+            self.delete(key)
+            return None
         return self.db.get(key, None)
 
     def delete(self, key):
-        if self.db.get(key):
-            del self.db[key]
+        self.expiry.discard(key)
+        self.db.pop(key, None)
+
+    def sweep(self, limit=0):
+        """
+        Remove expired items.
+
+        :param limit: Max number of items to remove, 0 means all
+        :return: Number of removed items
+        """
+        _keys = self.expiry.pop_expired(limit)
+        for key in _keys:
+            self.db.pop(key, None)
+        return len(_keys)
 
     def keys(self):
+        self.sweep()
         return self.db.keys()
 
     def close(self):
@@ -33,3 +75,132 @@ class InMemoryDataBase(object):
 
     def clear(self):
         self.db = {}
+        self.expiry.clear()
+
+
+class ConcurrentInMemoryDataBase(object):
+    """
+    Thread safe version of InMemoryDataBase. Keys are spread over a number of
+    shards, each with its own lock, so threads working on different keys
+    seldom wait for each other.
+
+    Also provides the native set operations used by SSODb, done atomically
+    under the shard lock, and a per key lock for read-modify-write sequences.
+    """
+
+    thread_safe = True
+
+    def __init__(self, shards=16, sweep_batch=16):
+        self.shards = [InMemoryDataBase(sweep_batch) for _ in range(shards)]
+        self.locks = [threading.RLock() for _ in range(shards)]
+        # The per key locks are separate from the shard locks, which are only
+        # held for single operations. Holding a key lock therefore never
+        # keeps other keys from being read or written.
+        self._key_locks = weakref.WeakValueDictionary()
+        self._key_locks_lock = threading.Lock()
+
+    def _index(self, key):
+        return hash(key) % len(self.shards)
+
+    def lock(self, key):
+        """
+        The lock that protects a key. Hold it to make a read-modify-write
+        sequence atomic. The lock is reentrant and exists as long as someone
+        refers to it.
+
+        :param key: The key
+        :return: A lock
+        """
+        with self._key_locks_lock:
+            _lock = self._key_locks.get(key)
+            if _lock is None:
+                _lock = self._key_locks[key] = threading.RLock()
+            return _lock
+
+    def __contains__(self, key):
+        if self.get(key):
+            return 1
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            del self.shards[_idx][key]
+
+    def set(self, key, value, ttl=None):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            self.shards[_idx].set(key, value, ttl=ttl)
+
+    def get(self, key):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            return self.shards[_idx].get(key)
+
+    def delete(self, key):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            self.shards[_idx].delete(key)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def add_member(self, key, value, ttl=None):
+        """
+        Add a member to a set.
+
+        :param key: The key
+        :param value: The member
+        :param ttl: Time to live of the member in seconds, None means for
+            ever. The set expires with its last member.
+        """
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            _values = self.shards[_idx].get(key)
+            if _values is None:
+                _values = MemberSet()
+            _ttl = add_member(_values, value, ttl or 0)
+            self.shards[_idx].set(key, _values, ttl=_ttl or None)
+
+    def remove_member(self, key, value):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            _values = self.shards[_idx].get(key)
+            # Changed in place, the set keeps its time to live
+            if _values and remove_members(_values, [value]) and not _values:
+                self.shards[_idx].delete(key)
+
+    def members(self, key):
+        _idx = self._index(key)
+        with self.locks[_idx]:
+            return live_members(self.shards[_idx].get(key) or {})
+
+    def members_many(self, keys):
+        return [self.members(key) for key in keys]
+
+    def sweep(self, limit=0):
+        _count = 0
+        for _lock, _shard in zip(self.locks, self.shards):
+            with _lock:
+                _count += _shard.sweep(limit)
+        return _count
+
+    def keys(self):
+        _keys = []
+        for _lock, _shard in zip(self.locks, self.shards):
+            with _lock:
+                _keys.extend(_shard.keys())
+        return _keys
+
+    def close(self):
+        pass
+
+    def clear(self):
+        for _lock, _shard in zip(self.locks, self.shards):
+            with _lock:
+                _shard.clear()
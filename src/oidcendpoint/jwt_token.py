@@ -1,3 +1,5 @@
+import threading
+from collections import OrderedDict
 from typing import Any
 from typing import Dict
 from typing import Optional
@@ -10,6 +12,27 @@ from oidcendpoint.token_handler import Token
 from oidcendpoint.token_handler import is_expired
 from oidcendpoint.token_handler import UnknownToken
 from oidcendpoint.user_info import scope2claims
+from oidcendpoint.util import key_state
+
+
+class CachedKeysJWT(JWT):
+    """
+    A JWT that gets its keys from the JWTToken instance it belongs to
+    instead of searching the key jar every time.
+    """
+
+    def __init__(self, token, **kwargs):
+        JWT.__init__(self, key_jar=token.key_jar, **kwargs)
+        self.token = token
+
+    def pack_key(self, owner_id="", kid=""):
+        return self.token.signing_key(self.alg, kid)
+
+    def _verify(self, rj, token):
+        _keys = self.token.verify_keys(rj.jwt)
+        if _keys is None:
+            return JWT._verify(self, rj, token)
+        return rj.verify_compact(token, _keys)
 
 
 class JWTToken(Token):
@@ -51,6 +74,111 @@ class JWTToken(Token):
         for param, default in self.init_args.items():
             setattr(self, param, kwargs.get(param, default))
 
+        # Keys, keyed on (alg, kid), and verified payloads, keyed on token.
+        # Both are dropped when the keys in the key jar change.
+        self.cache_size = kwargs.get("cache_size", 1024)
+        self._keys = {}
+        self._payloads = OrderedDict()
+        self._key_state = None
+        self._lock = threading.Lock()
+
+        self.signer = CachedKeysJWT(
+            self, iss=self.issuer, lifetime=self.lifetime, sign_alg=self.alg
+        )
+        self.verifier = CachedKeysJWT(self, allowed_sign_algs=[self.alg])
+
+    def _owners(self):
+        _owners = {"", self.issuer}
+        if self.issuer.endswith("/"):
+            _owners.add(self.issuer[:-1])
+        else:
+            _owners.add(self.issuer + "/")
+        return _owners
+
+    def _check_keys(self):
+        """
+        Drop cached keys and payloads if the keys belonging to me have been
+        rotated: added, removed or marked as inactive.
+        """
+        _state = tuple(
+            key_state(self.key_jar, _owner) for _owner in sorted(self._owners())
+        )
+        if _state != self._key_state:
+            with self._lock:
+                self._keys = {}
+                self._payloads = OrderedDict()
+                self._key_state = _state
+
+    def signing_key(self, alg, kid=""):
+        """
+        The key to sign with.
+
+        :param alg: Signing algorithm
+        :param kid: Key ID
+        :return: A key
+        """
+        self._check_keys()
+        try:
+            return self._keys[("sig", alg, kid)]
+        except KeyError:
+            pass
+
+        _key = JWT(key_jar=self.key_jar, sign_alg=alg).pack_key(self.issuer, kid)
+        self._keys[("sig", alg, kid)] = _key
+        return _key
+
+    def verify_keys(self, jwt):
+        """
+        The keys that may have been used to sign a token I issued.
+
+        :param jwt: A cryptojwt.jws.jws.JWSig instance
+        :return: list of keys or None if the token wasn't issued by me
+        """
+        if jwt.payload().get("iss") != self.issuer:
+            return None
+
+        self._check_keys()
+        _alg = jwt.headers.get("alg", "")
+        _kid = jwt.headers.get("kid", "")
+        try:
+            return self._keys[("ver", _alg, _kid)]
+        except KeyError:
+            pass
+
+        _keys = self.key_jar.get_jwt_verify_keys(jwt)
+        self._keys[("ver", _alg, _kid)] = _keys
+        return _keys
+
+    def unpack(self, token):
+        """
+        Verify the signature of a token and return the payload. The result
+        is remembered so the same token is only verified once.
+
+        :param token: The token
+        :return: The payload
+        """
+        self._check_keys()
+        with self._lock:
+            try:
+                _payload = self._payloads[token]
+            except KeyError:
+                pass
+            else:
+                self._payloads.move_to_end(token)
+                return _payload
+
+        try:
+            _payload = self.verifier.unpack(token)
+        except JWSException:
+            raise UnknownToken()
+
+        if self.cache_size:
+            with self._lock:
+                self._payloads[token] = _payload
+                while len(self._payloads) > self.cache_size:
+                    self._payloads.popitem(last=False)
+        return _payload
+
     def do_add_claims(self, payload, uinfo, claims):
         for attr in claims:
             if attr == "sub":
@@ -93,12 +221,6 @@ class JWTToken(Token):
                 self.do_add_claims(payload, uinfo, client_claims)
 
         payload.update(kwargs)
-        signer = JWT(
-            key_jar=self.key_jar,
-            iss=self.issuer,
-            lifetime=self.lifetime,
-            sign_alg=self.alg,
-        )
 
         if aud is None:
             _aud = self.def_aud
@@ -106,7 +228,7 @@ class JWTToken(Token):
             _aud = aud if isinstance(aud, list) else [aud]
             _aud.extend(self.def_aud)
 
-        return signer.pack(payload, aud=_aud)
+        return self.signer.pack(payload, aud=_aud)
 
     def info(self, token):
         """
@@ -116,11 +238,7 @@ class JWTToken(Token):
         :param token: A token
         :return: tuple of token type and session id
         """
-        verifier = JWT(key_jar=self.key_jar, allowed_sign_algs=[self.alg])
-        try:
-            _payload = verifier.unpack(token)
-        except JWSException:
-            raise UnknownToken()
+        _payload = self.unpack(token)
 
         if is_expired(_payload["exp"]):
             raise ToOld("Token has expired")
@@ -142,8 +260,7 @@ class JWTToken(Token):
             0 means now.
         :return: True/False
         """
-        verifier = JWT(key_jar=self.key_jar, allowed_sign_algs=[self.alg])
-        _payload = verifier.unpack(token)
+        _payload = self.unpack(token)
         return is_expired(_payload["exp"], when)
 
     def gather_args(self, sid, sdb, udb):
@@ -328,7 +328,11 @@ class Authorization(Endpoint):
                 else:
                     identity = json.loads(as_unicode(_id))
 
-                    session = self.endpoint_context.sdb[identity.get("sid")]
+                    try:
+                        session = self.endpoint_context.sdb[identity.get("sid")]
+                    except KeyError:
+                        # The session has expired
+                        session = None
                     if not session or "revoked" in session:
                         identity = None
 
@@ -517,14 +521,17 @@ class Authorization(Endpoint):
         :param kwargs: possible other parameters
         :return: A redirect to the redirect_uri of the client
         """
-        sid = setup_session(
-            self.endpoint_context, request, user, authn_event=authn_event
-        )
+        # All the session updates done while setting up the session and
+        # creating the response are written in one go.
+        with self.endpoint_context.sdb.transaction():
+            sid = setup_session(
+                self.endpoint_context, request, user, authn_event=authn_event
+            )
 
-        try:
-            resp_info = self.post_authentication(user, request, sid, **kwargs)
-        except Exception as err:
-            return self.error_response({}, "server_error", err)
+            try:
+                resp_info = self.post_authentication(user, request, sid, **kwargs)
+            except Exception as err:
+                return self.error_response({}, "server_error", err)
 
         if "check_session_iframe" in self.endpoint_context.provider_info:
             ec = self.endpoint_context
@@ -5,6 +5,8 @@ from oidcmsg import oauth2
 from oidcmsg.time_util import utc_time_sans_frac
 
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.token_handler import ExpiredToken
+from oidcendpoint.token_handler import UnknownToken
 
 LOGGER = logging.getLogger(__name__)
 
@@ -32,12 +34,50 @@ class Introspection(Endpoint):
         :param request:
         :return: client_id if there was a match
         """
+        try:
+            _tinfo = endpoint_context.sdb.token_info(token)
+        except (UnknownToken, ExpiredToken):
+            _tinfo = None
+        if _tinfo and _tinfo.get("client_id"):
+            return _tinfo["client_id"]
+
         sinfo = endpoint_context.sdb[token]
         return sinfo["authn_req"]["client_id"]
 
+    def _introspect_self_contained(self, token_info):
+        _handler = self.endpoint_context.sdb.handler
+        # Make sure that the token is an access_token or a refresh_token
+        _allowed = [_handler["access_token"]]
+        if "refresh_token" in _handler:
+            _allowed.append(_handler["refresh_token"])
+        if token_info["handler"] not in _allowed:
+            return None
+
+        ret = {
+            "iss": self.endpoint_context.issuer,
+            "scope": " ".join(token_info["scope"]),
+            "token_type": token_info["handler"].token_type,
+        }
+        for attr in ["client_id", "sub"]:
+            if token_info.get(attr):
+                ret[attr] = token_info[attr]
+        if token_info["exp"] != "-1":
+            ret["exp"] = int(token_info["exp"])
+        return ret
+
     def _introspect(self, token):
+        _sdb = self.endpoint_context.sdb
+        try:
+            _tinfo = _sdb.token_info(token)
+        except (UnknownToken, ExpiredToken):
+            return None
+
+        if _tinfo is not None:
+            # Everything that is needed is in the token
+            return self._introspect_self_contained(_tinfo)
+
         try:
-            info = self.endpoint_context.sdb[token]
+            info = _sdb[token]
         except KeyError:
             return None
 
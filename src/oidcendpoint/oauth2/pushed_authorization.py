@@ -30,7 +30,7 @@ class PushedAuthorization(Authorization):
         # create URN
 
         _urn = "urn:uuid:{}".format(uuid.uuid4())
-        self.endpoint_context.par_db[_urn] = request
+        self.endpoint_context.par_db.set(_urn, request, ttl=self.ttl)
 
         return {
             "http_response": {"request_uri": _urn, "expires_in": self.ttl},
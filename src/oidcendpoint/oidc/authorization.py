@@ -106,7 +106,7 @@ def create_authn_response(endpoint, request, sid):
                 kwargs["user_claims"] = True
 
             try:
-                id_token = _context.idtoken.make(request, _sinfo, **kwargs)
+                id_token = _context.idtoken.make(request, _sinfo, sid=sid, **kwargs)
             except (JWEException, NoSuitableSigningKeys) as err:
                 logger.warning(str(err))
                 resp = AuthorizationErrorResponse(
@@ -398,7 +398,11 @@ class Authorization(Endpoint):
                 else:
                     identity = json.loads(as_unicode(_id))
 
-                    session = self.endpoint_context.sdb[identity.get("sid")]
+                    try:
+                        session = self.endpoint_context.sdb[identity.get("sid")]
+                    except KeyError:
+                        # The session has expired
+                        session = None
                     if not session or "revoked" in session:
                         identity = None
 
@@ -407,7 +411,6 @@ class Authorization(Endpoint):
         # To authenticate or Not
         if identity is None:  # No!
             logger.info("No active authentication")
-            logger.debug("Known clients: {}".format(list(self.endpoint_context.cdb.keys())))
 
             if "prompt" in request and "none" in request["prompt"]:
                 # Need to authenticate but not allowed
@@ -539,8 +542,6 @@ class Authorization(Endpoint):
 
         response_info = create_authn_response(self, request, sid)
 
-        logger.debug("Known clients: {}".format(list(self.endpoint_context.cdb.keys())))
-
         try:
             redirect_uri = get_uri(self.endpoint_context, request, "redirect_uri")
         except (RedirectURIError, ParameterError) as err:
@@ -590,14 +591,17 @@ class Authorization(Endpoint):
         :param kwargs: possible other parameters
         :return: A redirect to the redirect_uri of the client
         """
-        sid = setup_session(
-            self.endpoint_context, request, user, authn_event=authn_event
-        )
+        # All the session updates done while setting up the session and
+        # creating the response are written in one go.
+        with self.endpoint_context.sdb.transaction():
+            sid = setup_session(
+                self.endpoint_context, request, user, authn_event=authn_event
+            )
 
-        try:
-            resp_info = self.post_authentication(user, request, sid, **kwargs)
-        except Exception as err:
-            return self.error_response({}, "server_error", err)
+            try:
+                resp_info = self.post_authentication(user, request, sid, **kwargs)
+            except Exception as err:
+                return self.error_response({}, "server_error", err)
 
         if "check_session_iframe" in self.endpoint_context.provider_info:
             ec = self.endpoint_context
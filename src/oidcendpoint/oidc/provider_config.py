@@ -3,6 +3,7 @@ import logging
 from oidcmsg import oidc
 
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.util import EncodedDocument
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +15,35 @@ class ProviderConfiguration(Endpoint):
     response_format = "json"
     name = "provider_config"
     default_capabilities = {"require_request_uri_registration": None}
+    # No outbound requests or storage access
+    blocking = False
 
     def __init__(self, endpoint_context, **kwargs):
         Endpoint.__init__(self, endpoint_context, **kwargs)
         self.pre_construct.append(self.add_endpoints)
+        # The response is encoded once and reused until the provider info
+        # or the construct hooks change.
+        self.document = EncodedDocument(
+            self._encode, max_age=kwargs.get("cache_max_age", 3600)
+        )
+
+    def _encode(self):
+        return Endpoint.do_response(self, self.endpoint_context.provider_info)["response"]
+
+    def _state(self):
+        # The provider info itself, not a copy, so the comparison is cheap
+        # as long as it's the same instance.
+        return (
+            self.endpoint_context.provider_info,
+            tuple(self.pre_construct),
+            tuple(self.post_construct),
+        )
+
+    def invalidate(self):
+        """
+        Has to be called if the provider info is modified in place.
+        """
+        self.document.invalidate()
 
     def add_endpoints(self, request, client_id, endpoint_context, **kwargs):
         for endpoint, endp_instance in self.endpoint_context.endpoint.items():
@@ -33,4 +59,24 @@ class ProviderConfiguration(Endpoint):
         return request
 
     def process_request(self, request=None, **kwargs):
-        return {"response_args": self.endpoint_context.provider_info}
+        _args = {"response_args": self.endpoint_context.provider_info}
+        if kwargs.get("if_none_match"):
+            _args["if_none_match"] = kwargs["if_none_match"]
+        return _args
+
+    def do_response(self, response_args=None, request=None, error="", **kwargs):
+        """
+        The provider info is served pre-encoded with an ETag. If the value
+        of the requests If-None-Match header is given as if_none_match and
+        matches, the response is empty and response_code is 304.
+        """
+        if (
+            error
+            or "response_msg" in kwargs
+            or response_args is not self.endpoint_context.provider_info
+        ):
+            return Endpoint.do_response(
+                self, response_args, request, error=error, **kwargs
+            )
+
+        return self.document.response(self._state(), kwargs.get("if_none_match"))
@@ -18,6 +18,7 @@ from oidcmsg.time_util import utc_time_sans_frac
 
 from oidcendpoint import rndstr
 from oidcendpoint import sanitize
+from oidcendpoint.client_authn import hash_secret
 from oidcendpoint.cookie import new_cookie
 from oidcendpoint.endpoint import Endpoint
 from oidcendpoint.exception import CapabilitiesMisMatch
@@ -221,6 +222,7 @@ class Registration(Endpoint):
         # if it can't load keys because the URL is false it will
         # just silently fail. Waiting for better times.
         _context.keyjar.load_keys(client_id, jwks_uri=t["jwks_uri"], jwks=t["jwks"])
+        _context.assertion_keys.invalidate(client_id)
         n_keys = 0
         for kb in _context.keyjar.get(client_id, []):
             n_keys += len(kb.keys())
@@ -336,8 +338,20 @@ class Registration(Endpoint):
         return utc_time_sans_frac() + _expiration_time
 
     def add_client_secret(self, cinfo, client_id, context):
+        """
+        If the hash_client_secret option is set only a hash of the secret is
+        stored and the secret is not part of read registration responses.
+        Note that client_secret_jwt needs the secret as a symmetric key. It's
+        put in the key jar of this process at registration but can't be
+        recreated from the hash, by other workers or after a restart.
+        """
         client_secret = secret(context.seed, client_id)
-        cinfo["client_secret"] = client_secret
+        if self.kwargs.get("hash_client_secret", False):
+            # Only the hash is kept, the secret is returned to the client
+            cinfo["client_secret_hash"] = hash_secret(client_secret)
+            cinfo.pop("client_secret", None)
+        else:
+            cinfo["client_secret"] = client_secret
         _eat = self.client_secret_expiration_time()
         if _eat:
             cinfo["client_secret_expires_at"] = _eat
@@ -402,12 +416,16 @@ class Registration(Endpoint):
             [(k, v) for k, v in _cinfo.items() if k in RegistrationResponse.c_param]
         )
 
+        if client_secret:
+            args["client_secret"] = client_secret
+
         comb_uri(args)
         response = RegistrationResponse(**args)
 
         # Add the client_secret as a symmetric key to the key jar
         if client_secret:
             _context.keyjar.add_symmetric(client_id, str(client_secret))
+            _context.assertion_keys.invalidate(client_id)
 
         logger.debug("Stored updated client info in CDB under cid={}".format(client_id))
         logger.debug("ClientInfo: {}".format(_cinfo))
@@ -1,5 +1,10 @@
 import json
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from urllib.parse import parse_qs
 from urllib.parse import urlencode
 from urllib.parse import urlparse
@@ -23,9 +28,17 @@ from oidcendpoint.common.authorization import verify_uri
 from oidcendpoint.cookie import append_cookie
 from oidcendpoint.endpoint import Endpoint
 from oidcendpoint.endpoint_context import add_path
+from oidcendpoint.id_token import JWTBatchSigner
+from oidcendpoint.sso_db import KEY_FORMAT
+from oidcendpoint.sso_db import MultiMap
+from oidcendpoint.util import importer
 
 logger = logging.getLogger(__name__)
 
+# The index of the queued back-channel logout deliveries
+QUEUE_KEY = KEY_FORMAT.format("logout", "queue")
+_claim_lock = threading.Lock()
+
 
 def do_front_channel_logout_iframe(cinfo, iss, sid):
     """
@@ -64,6 +77,263 @@ def do_front_channel_logout_iframe(cinfo, iss, sid):
     return _iframe
 
 
+class BackChannelLogoutDispatcher(object):
+    """
+    Delivers logout tokens to RPs in parallel. Every RP gets its own time
+    out and at most max_workers deliveries are done at the same time.
+    Deliveries that fail are put in a retry queue, retry() is meant to be
+    called from a scheduled job. If retry_batch is set, at most that many
+    due retries are also started in the background after each logout, the
+    logout doesn't wait for them. Per RP counters are kept in metrics.
+
+    The retry queue is kept in the database the sessions are stored in,
+    unless another one is configured, so with a shared session database
+    queued deliveries survive restarts and are retried by whichever worker
+    gets to them first. A queued delivery is claimed before it's retried, so
+    it's only made once. close() stops the worker pool.
+    """
+
+    def __init__(self, endpoint_context, max_workers=8, timeout=5, max_attempts=5,
+                 backoff=30, retry_db=None, retry_batch=0):
+        """
+        :param endpoint_context: The endpoint context
+        :param max_workers: Max number of deliveries done at the same time
+        :param timeout: Seconds to wait for an RP to respond
+        :param max_attempts: Max number of times a delivery is tried
+        :param backoff: Seconds to wait before the first retry, doubled for
+            each following attempt.
+        :param retry_db: Configuration of the database the retry queue is
+            kept in. Default is the session database.
+        :param retry_batch: Max number of due retries started in the
+            background after a logout, 0 means retries are only made when
+            retry() is called.
+        """
+        self.endpoint_context = endpoint_context
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.retry_batch = retry_batch
+        if retry_db:
+            self._retry_db = importer(retry_db["class"])(**retry_db.get("kwargs", {}))
+        else:
+            self._retry_db = None
+        self._queue = None
+
+        # client_id -> counters
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def retry_db(self):
+        if self._retry_db is None:
+            self._retry_db = self.endpoint_context.sdb.db
+        return self._retry_db
+
+    @property
+    def queue(self):
+        """
+        The index of the queued deliveries.
+        """
+        if self._queue is None:
+            self._queue = MultiMap(self.retry_db)
+        return self._queue
+
+    def _count(self, client_id, outcome, elapsed=0.0):
+        with self._lock:
+            try:
+                _metrics = self.metrics[client_id]
+            except KeyError:
+                _metrics = self.metrics[client_id] = {
+                    "delivered": 0,
+                    "failed": 0,
+                    "queued": 0,
+                    "dropped": 0,
+                    "time": 0.0,
+                }
+            _metrics[outcome] += 1
+            _metrics["time"] += elapsed
+
+    def post(self, client_id, url, logout_token):
+        """
+        Deliver one logout token.
+
+        :return: True if the RP accepted the logout token
+        """
+        _params = dict(self.endpoint_context.httpc_params)
+        _params.setdefault("timeout", self.timeout)
+
+        _start = time.time()
+        try:
+            res = self.endpoint_context.httpc.post(
+                url, data="logout_token={}".format(logout_token), **_params
+            )
+        except Exception as err:
+            logger.info("failed to logout from {}: {}".format(client_id, err))
+            self._count(client_id, "failed", time.time() - _start)
+            return False
+
+        _elapsed = time.time() - _start
+        if res.status_code < 300:
+            logger.info("Logged out from {}".format(client_id))
+        elif res.status_code in [501, 504]:
+            logger.info("Got a %s which is acceptable", res.status_code)
+        else:
+            logger.info("failed to logout from {}".format(client_id))
+            self._count(client_id, "failed", _elapsed)
+            return False
+
+        self._count(client_id, "delivered", _elapsed)
+        return True
+
+    def _deliver(self, client_id, url, logout_token, attempts=0):
+        if not self.post(client_id, url, logout_token):
+            self.enqueue(client_id, url, logout_token, attempts + 1)
+
+    def enqueue(self, client_id, url, logout_token, attempts=1):
+        if attempts >= self.max_attempts:
+            logger.warning("Giving up logging out from {}".format(client_id))
+            self._count(client_id, "dropped")
+            return
+
+        _key = KEY_FORMAT.format("logout", uuid.uuid4().hex)
+        self.retry_db.set(
+            _key,
+            {
+                "client_id": client_id,
+                "url": url,
+                "logout_token": logout_token,
+                "attempts": attempts,
+                "next_try": time.time() + self.backoff * 2 ** (attempts - 1),
+            },
+        )
+        self.queue.add(QUEUE_KEY, _key)
+        self._count(client_id, "queued")
+
+    def queued(self):
+        """
+        :return: The keys of the queued deliveries
+        """
+        return self.queue.get(QUEUE_KEY) or []
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers or 1)
+            return self._executor
+
+    def _deliver_all(self, items):
+        """
+        :param items: list of (client ID, logout URI, logout token, attempts)
+            tuples
+        """
+        if len(items) == 1 or not self.max_workers:
+            for item in items:
+                self._deliver(*item)
+            return
+
+        _executor = self._pool()
+        _futures = [_executor.submit(self._deliver, *item) for item in items]
+        # Deliveries that haven't finished keep on going in the background
+        wait(_futures, timeout=self.timeout)
+
+    def deliver(self, specs):
+        """
+        Deliver logout tokens to a number of RPs. Returns when all RPs have
+        answered or the time out has passed.
+
+        :param specs: dictionary with client IDs as keys and tuples with
+            logout URI and logout token as values
+        """
+        self._deliver_all(
+            [
+                (client_id, url, logout_token, 0)
+                for client_id, (url, logout_token) in specs.items()
+            ]
+        )
+
+    def _claim(self, key):
+        """
+        Take a queued delivery off the queue. If the database can store a
+        value only if there is none, a claim is stored first so that two
+        workers sharing the queue never both get the delivery.
+
+        :param key: The key of the queued delivery
+        :return: The delivery or None if someone else got it
+        """
+        try:
+            _add = self.retry_db.add
+        except AttributeError:
+            # A database without add is not shared between processes
+            with _claim_lock:
+                _item = self.retry_db.get(key)
+                self.retry_db.delete(key)
+        else:
+            if not _add("{}_claim".format(key), True, ttl=max(60, 2 * self.timeout)):
+                return None
+            _item = self.retry_db.get(key)
+            self.retry_db.delete(key)
+
+        self.queue.remove(QUEUE_KEY, key)
+        return _item
+
+    def retry(self, when=0, limit=0):
+        """
+        Try again to deliver the logout tokens that are due.
+
+        :param when: Point in time to use as now
+        :param limit: Max number of deliveries, 0 means no limit
+        :return: Number of deliveries attempted
+        """
+        if not when:
+            when = time.time()
+
+        _keys = self.queued()
+        try:
+            _get_many = self.retry_db.get_many
+        except AttributeError:
+            _queued = [self.retry_db.get(key) for key in _keys]
+        else:
+            _queued = _get_many(_keys) if _keys else []
+        _due = [
+            key
+            for key, _item in zip(_keys, _queued)
+            if _item is None or _item["next_try"] <= when
+        ]
+
+        _items = []
+        for key in _due:
+            _item = self._claim(key)
+            # Items that are gone have been retried by someone else or expired
+            if _item:
+                _items.append(
+                    (_item["client_id"], _item["url"], _item["logout_token"],
+                     _item["attempts"])
+                )
+                if limit and len(_items) >= limit:
+                    break
+
+        if _items:
+            self._deliver_all(_items)
+        return len(_items)
+
+    def retry_in_background(self, limit=0):
+        """
+        Start retry() in the worker pool and return at once.
+
+        :param limit: Max number of deliveries, 0 means no limit
+        :return: A concurrent.futures.Future
+        """
+        return self._pool().submit(self.retry, limit=limit)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
 class Session(Endpoint):
     request_cls = EndSessionRequest
     response_cls = Message
@@ -85,6 +355,35 @@ class Session(Endpoint):
         if _csi and not _csi.startswith("http"):
             kwargs['check_session_iframe'] = add_path(endpoint_context.issuer, _csi)
         Endpoint.__init__(self, endpoint_context, **kwargs)
+        # If > 0 logout tokens for many RPs are signed in parallel
+        self.signing_workers = kwargs.get("logout_signing_workers", 0)
+        self._executor = None
+        self.logout_dispatcher = BackChannelLogoutDispatcher(
+            endpoint_context, **kwargs.get("back_channel_logout", {})
+        )
+
+    def _logout_token_alg(self, cinfo):
+        try:
+            return cinfo["id_token_signed_response_alg"]
+        except KeyError:
+            return self.endpoint_context.provider_info[
+                "id_token_signing_alg_values_supported"
+            ][0]
+
+    def _logout_signer(self, alg):
+        _cntx = self.endpoint_context
+        if self.signing_workers and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.signing_workers)
+        return JWTBatchSigner(
+            _cntx.keyjar, _cntx.issuer, alg, lifetime=86400, with_jti=True,
+            executor=self._executor
+        )
+
+    @staticmethod
+    def _logout_payload(sub, sid):
+        # always include sub and sid so I don't check for
+        # backchannel_logout_session_required
+        return {"sub": sub, "sid": sid, "events": {BACK_CHANNEL_LOGOUT_EVENT: {}}}
 
     def do_back_channel_logout(self, cinfo, sub, sid):
         """
@@ -94,39 +393,48 @@ class Session(Endpoint):
         :param sid: The Issuer ID
         :return: Tuple with logout URI and signed logout token
         """
-
-        _cntx = self.endpoint_context
-
         try:
             back_channel_logout_uri = cinfo["backchannel_logout_uri"]
         except KeyError:
             return None
 
-        # always include sub and sid so I don't check for
-        # backchannel_logout_session_required
+        _signer = self._logout_signer(self._logout_token_alg(cinfo))
+        sjwt = _signer.sign(self._logout_payload(sub, sid), recv=cinfo["client_id"])
 
-        payload = {"sub": sub, "sid": sid, "events": {BACK_CHANNEL_LOGOUT_EVENT: {}}}
+        return back_channel_logout_uri, sjwt
 
-        try:
-            alg = cinfo["id_token_signed_response_alg"]
-        except KeyError:
-            alg = _cntx.provider_info["id_token_signing_alg_values_supported"][0]
+    def do_back_channel_logouts(self, specs):
+        """
+        Construct logout tokens for many RPs. Tokens that are signed using
+        the same algorithm are signed as one batch.
 
-        _jws = JWT(_cntx.keyjar, iss=_cntx.issuer, lifetime=86400, sign_alg=alg)
-        _jws.with_jti = True
-        sjwt = _jws.pack(payload=payload, recv=cinfo["client_id"])
+        :param specs: list of (client info, subject identifier, session ID)
+            tuples
+        :return: dictionary with client IDs as keys and tuples with logout URI
+            and signed logout token as values
+        """
+        _by_alg = {}
+        for cinfo, sub, sid in specs:
+            if "backchannel_logout_uri" in cinfo:
+                _by_alg.setdefault(self._logout_token_alg(cinfo), []).append(
+                    (cinfo, sub, sid)
+                )
 
-        return back_channel_logout_uri, sjwt
+        res = {}
+        for alg, _specs in _by_alg.items():
+            _tokens = self._logout_signer(alg).sign_many(
+                [
+                    (self._logout_payload(sub, sid), cinfo["client_id"])
+                    for cinfo, sub, sid in _specs
+                ]
+            )
+            for (cinfo, sub, sid), sjwt in zip(_specs, _tokens):
+                res[cinfo["client_id"]] = (cinfo["backchannel_logout_uri"], sjwt)
+        return res
 
     def clean_sessions(self, usids):
-        # Clean out all sessions
-        _sdb = self.endpoint_context.sdb
-        _sso_db = self.endpoint_context.sdb.sso_db
-        for sid in usids:
-            _state = _sdb[sid]["authn_req"]["state"]
-            del _sdb[sid]
-            _sdb.delete_kv2sid("state", _state)
-            _sso_db.remove_session_id(sid)
+        # Clean out all sessions, sessions that have expired are skipped
+        self.endpoint_context.sdb.delete_sessions(usids)
 
     def logout_all_clients(self, sid, client_id):
         _sdb = self.endpoint_context.sdb
@@ -144,26 +452,26 @@ class Session(Endpoint):
             logger.debug("No sessions found for uid: %s", uid)
             return {}
 
-        for usid in usids:
-            _client_sid[_sdb[usid]["authn_req"]["client_id"]] = usid
+        for usid, _sinfo in _sdb.iter_sessions(usids):
+            _client_sid[_sinfo["authn_req"]["client_id"]] = usid
 
         # Front-/Backchannel logout ?
         _cdb = self.endpoint_context.cdb
         _iss = self.endpoint_context.issuer
-        bc_logouts = {}
+        bc_specs = []
         fc_iframes = {}
         for _cid, _csid in _client_sid.items():
             if "backchannel_logout_uri" in _cdb[_cid]:
                 _sub = _sso_db.get_sub_by_sid(_csid)
-                _spec = self.do_back_channel_logout(_cdb[_cid], _sub, _csid)
-                if _spec:
-                    bc_logouts[_cid] = _spec
+                bc_specs.append((_cdb[_cid], _sub, _csid))
             elif "frontchannel_logout_uri" in _cdb[_cid]:
                 # Construct an IFrame
                 _spec = do_front_channel_logout_iframe(_cdb[_cid], _iss, _csid)
                 if _spec:
                     fc_iframes[_cid] = _spec
 
+        bc_logouts = self.do_back_channel_logouts(bc_specs)
+
         self.clean_sessions(usids)
 
         res = {}
@@ -265,8 +573,8 @@ class Session(Endpoint):
             if _sids is None:
                 raise ValueError("Unknown subject identifier")
 
-            for _isid in _sids:
-                if _sdb[_isid]["authn_req"]["client_id"] in auds:
+            for _isid, _sinfo in _sdb.iter_sessions(_sids):
+                if _sinfo["authn_req"]["client_id"] in auds:
                     _ith_sid = _isid
                     break
 
@@ -399,25 +707,23 @@ class Session(Endpoint):
         bcl = _res.get("blu")
         if bcl:
             # take care of Back channel logout first
-            for _cid, spec in bcl.items():
-                _url, sjwt = spec
-                logger.info("logging out from {} at {}".format(_cid, _url))
-
-                res = self.endpoint_context.httpc.post(
-                    _url,
-                    data="logout_token={}".format(sjwt),
-                    **self.endpoint_context.httpc_params
-                )
-
-                if res.status_code < 300:
-                    logger.info("Logged out from {}".format(_cid))
-                elif res.status_code in [501, 504]:
-                    logger.info("Got a %s which is acceptable", res.status_code)
-                elif res.status_code >= 400:
-                    logger.info("failed to logout from {}".format(_cid))
+            self.logout_dispatcher.deliver(bcl)
+        if self.logout_dispatcher.retry_batch:
+            self.logout_dispatcher.retry_in_background(
+                limit=self.logout_dispatcher.retry_batch
+            )
 
         return _res["flu"].values() if _res.get("flu") else []
 
+    def close(self):
+        """
+        Stops the worker pools used for signing and delivering logout tokens.
+        """
+        self.logout_dispatcher.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
     def kill_cookies(self):
         _ec = self.endpoint_context
         _dealer = _ec.cookie_dealer
@@ -104,6 +104,7 @@ class TokenCoop(Endpoint):
         if "offline_access" in _authn_req["scope"] and "offline_access" in permissions:
             issue_refresh = True
 
+        _sid = _sdb.get_sid_by_token(_access_code)
         try:
             _info = _sdb.upgrade_to_token(_access_code, issue_refresh=issue_refresh)
         except AccessCodeUsed as err:
@@ -116,7 +117,7 @@ class TokenCoop(Endpoint):
 
         if "openid" in _authn_req["scope"]:
             try:
-                _idtoken = _context.idtoken.make(req, _info, _authn_req)
+                _idtoken = _context.idtoken.make(req, _info, _authn_req, sid=_sid)
             except (JWEException, NoSuitableSigningKeys) as err:
                 logger.warning(str(err))
                 resp = TokenErrorResponse(
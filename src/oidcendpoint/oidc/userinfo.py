@@ -9,6 +9,8 @@ from oidcmsg.oauth2 import ResponseMessage
 from oidcmsg.time_util import time_sans_frac
 
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.token_handler import ExpiredToken
+from oidcendpoint.token_handler import UnknownToken
 from oidcendpoint.userinfo import collect_user_info
 from oidcendpoint.util import OAUTH2_NOCACHE_HEADERS
 
@@ -38,6 +40,13 @@ class UserInfo(Endpoint):
         self.allowed_targets.append("")
 
     def get_client_id_from_token(self, endpoint_context, token, request=None):
+        try:
+            _tinfo = self.endpoint_context.sdb.token_info(token)
+        except (UnknownToken, ExpiredToken):
+            _tinfo = None
+        if _tinfo and _tinfo.get("client_id"):
+            return _tinfo["client_id"]
+
         sinfo = self.endpoint_context.sdb[token]
         return sinfo["authn_req"]["client_id"]
 
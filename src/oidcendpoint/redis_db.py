@@ -0,0 +1,208 @@
+"""
+Storage backed by a Redis compatible key-value server. This allows the session,
+SSO, JTI and client databases to be shared between worker processes.
+
+Needs the redis package (pip install oidcendpoint[redis]).
+"""
+import json
+import logging
+import math
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Score offset of set members that never expire, about 100 years
+NO_EXPIRY = 100 * 365 * 24 * 3600
+
+
+class RedisDataBase(object):
+    """
+    Implements the InMemoryDataBase interface on top of a Redis server.
+    Values are stored JSON encoded. Connections are taken from a connection
+    pool and multi key operations are pipelined. Also implements the native
+    set operations used by SSODb.
+    """
+
+    thread_safe = True
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="", ttl=0,
+                 max_connections=None, client=None, **kwargs):
+        """
+        :param url: Where the server can be found
+        :param prefix: Prepended to every key, allows several databases to
+            share one server
+        :param ttl: Default time to live, in seconds, for stored values.
+            0 means values never expire.
+        :param max_connections: Size of the connection pool
+        :param client: An already configured Redis client instance. If given
+            url, max_connections and kwargs are ignored.
+        :param kwargs: Extra arguments to the connection pool
+        """
+        if client is None:
+            if redis is None:
+                raise ImportError("The redis package is needed for RedisDataBase")
+            pool = redis.ConnectionPool.from_url(
+                url, max_connections=max_connections, **kwargs
+            )
+            client = redis.Redis(connection_pool=pool)
+
+        self.db = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        return "{}{}".format(self.prefix, key)
+
+    def __contains__(self, key):
+        return self.db.exists(self._key(key)) > 0
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value.
+
+        :param key: The key
+        :param value: Any JSON serializable value
+        :param ttl: Time to live in seconds, overrides the default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self.db.set(self._key(key), json.dumps(value), ex=ttl or None)
+
+    def add(self, key, value, ttl=None):
+        """
+        Store a value if there is none under the key. Atomic.
+
+        :param key: The key
+        :param value: Any JSON serializable value
+        :param ttl: Time to live in seconds, overrides the default.
+        :return: True if the value was stored
+        """
+        if ttl is None:
+            ttl = self.ttl
+        return bool(self.db.set(self._key(key), json.dumps(value), ex=ttl or None, nx=True))
+
+    def get(self, key, default=None):
+        _val = self.db.get(self._key(key))
+        if _val is None:
+            return default
+        return json.loads(_val)
+
+    def delete(self, key):
+        self.db.delete(self._key(key))
+
+    def get_many(self, keys):
+        """
+        Fetch several values in one round trip.
+
+        :param keys: List of keys
+        :return: List of values, None for missing keys
+        """
+        if not keys:
+            return []
+        return [
+            None if _val is None else json.loads(_val)
+            for _val in self.db.mget([self._key(k) for k in keys])
+        ]
+
+    def set_many(self, items, ttl=None):
+        """
+        Store several values in one round trip.
+
+        :param items: Dictionary of keys and values
+        :param ttl: Time to live in seconds, overrides the default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        pipe = self.db.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(self._key(key), json.dumps(value), ex=ttl or None)
+        pipe.execute()
+
+    def delete_many(self, keys):
+        if keys:
+            self.db.delete(*[self._key(k) for k in keys])
+
+    # Native sets, used by SSODb. Kept as sorted sets with the expiration
+    # time of the member as score, so members come back in the order they
+    # were added and expired members can be dropped by score. Members that
+    # never expire are scored far enough into the future.
+
+    def add_member(self, key, value, ttl=None):
+        """
+        Add a member to a set.
+
+        :param key: The key
+        :param value: The member
+        :param ttl: Time to live of the member in seconds, None means for
+            ever. The set expires with its last member, its time to live is
+            only ever extended.
+        """
+        _key = self._key(key)
+        _member = json.dumps(value)
+
+        def _add(pipe):
+            # The set's time to live is read and updated atomically, the key
+            # is watched and this is retried if someone else changes it.
+            _pttl = pipe.pttl(_key)
+            _now = time.time()
+            pipe.multi()
+            pipe.zremrangebyscore(_key, "-inf", _now)
+            if ttl:
+                pipe.zadd(_key, {_member: _now + ttl})
+                # -1 means the set never expires, -2 that there is no set
+                if _pttl == -2 or 0 <= _pttl < ttl * 1000:
+                    pipe.pexpire(_key, int(math.ceil(ttl * 1000)))
+            else:
+                pipe.zadd(_key, {_member: _now + NO_EXPIRY}, nx=True)
+                pipe.persist(_key)
+
+        self.db.transaction(_add, _key)
+
+    def remove_member(self, key, value):
+        self.db.zrem(self._key(key), json.dumps(value))
+
+    def remove_members(self, key, values):
+        if values:
+            self.db.zrem(self._key(key), *[json.dumps(_val) for _val in values])
+
+    def members(self, key):
+        return [
+            json.loads(_val)
+            for _val in self.db.zrangebyscore(self._key(key), time.time(), "+inf")
+        ]
+
+    def members_many(self, keys):
+        _now = time.time()
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrangebyscore(self._key(key), _now, "+inf")
+        return [[json.loads(_val) for _val in _vals] for _vals in pipe.execute()]
+
+    def keys(self):
+        _len = len(self.prefix)
+        return [
+            k.decode("utf-8")[_len:] if isinstance(k, bytes) else k[_len:]
+            for k in self.db.scan_iter(match="{}*".format(self.prefix))
+        ]
+
+    def close(self):
+        self.db.close()
+
+    def clear(self):
+        _keys = list(self.db.scan_iter(match="{}*".format(self.prefix)))
+        if _keys:
+            self.db.delete(*_keys)
@@ -0,0 +1,137 @@
+"""
+Detection of replayed JWTs, like client assertions, based on their jti.
+"""
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayCache(object):
+    """
+    Remembers JWT IDs until the JWT has expired, plus allowed clock skew.
+
+    Locally entries are kept in time buckets, the bucket being given by the
+    expiration time, so that when a bucket has expired all its entries are
+    dropped at once. How long an entry is kept is capped by max_lifetime and
+    the number of entries by max_entries, if there are more entries the ones
+    that expire first are dropped.
+
+    If a shared backend is given, entries are also stored there so that
+    replays are detected across workers. A backend with an atomic add, like
+    RedisDataBase, needs one round trip per new JWT ID.
+    """
+
+    def __init__(self, db=None, skew=60, default_ttl=600, bucket_size=60,
+                 max_lifetime=3600, max_entries=100000):
+        """
+        :param db: Shared backend, None if only local
+        :param skew: Allowed clock skew in seconds
+        :param default_ttl: For how long, in seconds, a JWT ID without an
+            expiration time is remembered
+        :param bucket_size: The time span of a bucket in seconds
+        :param max_lifetime: The longest time, in seconds, a JWT ID is
+            remembered. JWTs that expire later should be refused, see
+            :py:meth:`too_long_lived`.
+        :param max_entries: The maximum number of locally remembered JWT IDs
+        """
+        self.db = db
+        self.skew = skew
+        self.default_ttl = default_ttl
+        self.bucket_size = bucket_size
+        self.max_lifetime = max_lifetime
+        self.max_entries = max_entries
+
+        # bucket number -> set of keys
+        self._buckets = {}
+        # key -> bucket number
+        self._entries = {}
+        self._queue = []
+        self._lock = threading.Lock()
+
+    def _drop_bucket(self, bucket):
+        for _key in self._buckets.pop(bucket, ()):
+            del self._entries[_key]
+
+    def _evict(self, now):
+        _current = int(now // self.bucket_size)
+        while self._queue and self._queue[0] < _current:
+            self._drop_bucket(heapq.heappop(self._queue))
+
+    def _shrink(self):
+        while self._queue and len(self._entries) >= self.max_entries:
+            self._drop_bucket(heapq.heappop(self._queue))
+            logger.warning("Replay cache full, dropped entries before expiry")
+
+    def _add_shared(self, key, until, ttl):
+        try:
+            _add = self.db.add
+        except AttributeError:
+            if self.db.get(key) is not None:
+                return False
+            self.db.set(key, until, ttl=ttl)
+            return True
+        return _add(key, until, ttl=ttl)
+
+    def too_long_lived(self, exp, now=0):
+        """
+        Check if a JWT expires later than it can be remembered.
+
+        :param exp: The expiration time of the JWT
+        :param now: The present time, by default the current time
+        :return: True if replays of the JWT could go undetected
+        """
+        return exp - (now or time.time()) > self.max_lifetime
+
+    def seen(self, key, exp=None):
+        """
+        Check if a JWT ID has been seen before and remember it if not.
+
+        :param key: The JWT ID, preferably combined with the issuer
+        :param exp: The expiration time of the JWT
+        :return: True if this is a replay
+        """
+        now = time.time()
+        if exp:
+            until = min(exp, now + self.max_lifetime) + self.skew
+        else:
+            until = now + self.default_ttl
+
+        if until <= now:
+            # Expired, will be refused anyway. Nothing to remember.
+            return False
+
+        with self._lock:
+            self._evict(now)
+            if key in self._entries:
+                return True
+
+        if self.db is not None:
+            if not self._add_shared(key, until, max(int(until - now), 1)):
+                return True
+
+        _bucket = int(until // self.bucket_size)
+        with self._lock:
+            if key in self._entries:
+                return True
+            self._shrink()
+            try:
+                _keys = self._buckets[_bucket]
+            except KeyError:
+                _keys = self._buckets[_bucket] = set()
+                heapq.heappush(self._queue, _bucket)
+            _keys.add(key)
+            self._entries[key] = _bucket
+        return False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._buckets = {}
+            self._entries = {}
+            self._queue = []
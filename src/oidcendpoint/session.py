@@ -1,6 +1,11 @@
 import hashlib
 import json
+import threading
 import time
+from itertools import islice
+from collections import OrderedDict
+from contextlib import ExitStack
+from contextlib import contextmanager
 
 from oidcmsg.exception import MissingParameter
 from oidcmsg.message import Message
@@ -70,15 +75,20 @@ def setup_session(
     if not client_id:
         client_id = areq["client_id"]
 
-    sid = endpoint_context.sdb.create_authz_session(
-        authn_event, areq, client_id=client_id, uid=uid
-    )
-
     client_salt = endpoint_context.cdb.get(client_id, {}).get("client_salt", salt)
-    endpoint_context.sdb.do_sub(sid, uid, client_salt)
+    with endpoint_context.sdb.transaction():
+        sid = endpoint_context.sdb.create_authz_session(
+            authn_event, areq, client_id=client_id, uid=uid
+        )
+        endpoint_context.sdb.do_sub(sid, uid, client_salt)
     return sid
 
 
+@contextmanager
+def no_lock():
+    yield
+
+
 SINGLE_REQUIRED_AUTHN_EVENT = (Message, True, msg_ser, authn_event_deser, False)
 
 
@@ -103,6 +113,29 @@ def public_id(uid, salt="", **kwargs):
     return hashlib.sha256("{}{}".format(uid, salt).encode("utf-8")).hexdigest()
 
 
+def copy_message(msg):
+    """
+    Cheap copy of a message. Nested messages and lists are copied one level
+    down, everything else is shared. Much faster than the deepcopy done by
+    Message.copy().
+
+    :param msg: A Message instance
+    :return: A copy of the message
+    """
+    _msg = msg.__class__.__new__(msg.__class__)
+    _msg.__dict__.update(msg.__dict__)
+    _dict = {}
+    for key, val in msg._dict.items():
+        if isinstance(val, Message):
+            _dict[key] = copy_message(val)
+        elif isinstance(val, list):
+            _dict[key] = list(val)
+        else:
+            _dict[key] = val
+    _msg._dict = _dict
+    return _msg
+
+
 def dict_match(a, b):
     """
     Check if all attribute/value pairs in a also appears in b
@@ -121,7 +154,8 @@ def dict_match(a, b):
 
 
 class SessionDB(object):
-    def __init__(self, db, handler, sso_db=SSODb(), userinfo=None, sub_func=None):
+    def __init__(self, db, handler, sso_db=SSODb(), userinfo=None, sub_func=None,
+                 cache_size=256, session_ttl=None, batch_size=100):
         # db must implement the InMemoryDataBase interface
         self._db = db
         self.handler = handler
@@ -139,35 +173,285 @@ class SessionDB(object):
             if "pairwise" not in sub_func:
                 self.sub_func["pairwise"] = pairwise_id
 
-    def __getitem__(self, item):
-        _info = self._db.get(item)
+        # Decoded session information, least recently used first.
+        # sid -> (serialized session info, SessionInfo instance)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_size = cache_size
+
+        # How long a session is kept after it was last written.
+        # Default is the lifetime of the longest lived token.
+        if session_ttl is None:
+            session_ttl = self._max_token_lifetime()
+        self.session_ttl = session_ttl
+
+        # Max number of sessions fetched with one multi key read
+        self.batch_size = batch_size
+
+        # Per thread buffer of session updates, only used within a transaction
+        self._local = threading.local()
+
+        # If any of the tokens can be verified without reading the session,
+        # revoked tokens must be remembered.
+        self.self_contained = any(
+            getattr(self.handler[typ], "self_contained", False)
+            for typ in self.handler.keys()
+        )
+
+    def _decode(self, sid, info):
+        """
+        Turn the stored JSON document into a SessionInfo instance.
+        Decoded instances are cached and only reused if the stored document
+        is still the same, so changes made by others to a shared backend are
+        picked up.
+
+        :param sid: Session ID
+        :param info: The JSON document as stored in the database
+        :return: A SessionInfo instance the caller is free to modify
+        """
+        with self._cache_lock:
+            try:
+                _json, _si = self._cache[sid]
+            except KeyError:
+                pass
+            else:
+                if _json == info:
+                    self._cache.move_to_end(sid)
+                    return copy_message(_si)
+
+        _si = SessionInfo().from_json(info)
+        if self.cache_size:
+            with self._cache_lock:
+                self._cache[sid] = (info, _si)
+                self._cache.move_to_end(sid)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return copy_message(_si)
+
+        return _si
+
+    @property
+    def db(self):
+        """
+        The database the sessions are stored in.
+        """
+        return self._db
+
+    def _uncache(self, sid):
+        with self._cache_lock:
+            self._cache.pop(sid, None)
+
+    def _max_token_lifetime(self):
+        _lifetimes = [
+            getattr(self.handler[typ], "lifetime", -1) for typ in self.handler.keys()
+            if self.handler[typ] is not None
+        ]
+        if not _lifetimes or min(_lifetimes) < 0:
+            # At least one type of token lives for ever
+            return 0
+        return max(_lifetimes)
+
+    def lock(self, sid):
+        """
+        A lock that protects a session against concurrent read-modify-write
+        sequences. Only databases with per key locks support this, for other
+        databases it's a no-op.
+
+        :param sid: Session ID
+        :return: A context manager
+        """
+        try:
+            return self._db.lock(sid)
+        except AttributeError:
+            return no_lock()
+
+    def _pending(self):
+        return getattr(self._local, "pending", None)
+
+    def _pending_index(self):
+        return getattr(self._local, "index", None)
+
+    def _locks(self, sids):
+        """
+        The locks protecting a number of sessions, in a fixed order so that
+        two threads acquiring them for overlapping sets of sessions can't
+        deadlock.
+        """
+        _locks = {}
+        for sid in sids:
+            _lock = self.lock(sid)
+            _locks[id(_lock)] = _lock
+        return [_locks[k] for k in sorted(_locks)]
 
+    def _load(self, sid):
+        """
+        Get the session information for a session ID, buffered updates made
+        in an ongoing transaction take precedence over the database.
+
+        :param sid: Session ID
+        :return: A SessionInfo instance or None if there is no such session
+        """
+        _pending = self._pending()
+        if _pending is not None and sid in _pending:
+            _si = _pending[sid]
+            if _si is None:
+                return None
+            return copy_message(_si)
+
+        _info = self._db.get(sid)
         if _info is None:
-            sid = self.handler.sid(item)
-            _info = self._db.get(sid)
-            if _info:
-                _si = SessionInfo().from_json(_info)
+            return None
+        return self._decode(sid, _info)
+
+    def get_many(self, sids):
+        """
+        Get the session information for several session IDs, with one
+        multi key fetch if the database supports it.
+
+        :param sids: List of session IDs
+        :return: List of SessionInfo instances, None for missing sessions
+        """
+        _pending = self._pending() or {}
+        _fetch = [sid for sid in sids if sid not in _pending]
+        _infos = dict(zip(_fetch, self._get_many(_fetch))) if _fetch else {}
+
+        res = []
+        for sid in sids:
+            if sid in _pending:
+                _si = _pending[sid]
+                res.append(None if _si is None else copy_message(_si))
+            else:
+                _info = _infos.get(sid)
+                res.append(None if _info is None else self._decode(sid, _info))
+        return res
+
+    def __getitem__(self, item):
+        _si = self._load(item)
+
+        if _si is None:
+            sid = self.get_sid_by_token(item)
+            _si = self._load(sid)
+            if _si:
                 if any(item == val for val in _si.values()):
                     _si['sid'] = sid
                     return _si
         else:
-            _si = SessionInfo().from_json(_info)
             _si['sid'] = item
             return _si
         raise KeyError
 
     def __setitem__(self, sid, instance):
+        _pending = self._pending()
+        if _pending is not None:
+            _pending[sid] = copy_message(instance)
+            return
+
+        self._uncache(sid)
+        self._set(sid, self._serialize(instance))
+
+    @staticmethod
+    def _serialize(instance):
         try:
-            _info = instance.to_json()
+            return instance.to_json()
         except ValueError:
-            _info = json.dumps(instance)
-        self._db.set(sid, _info)
+            return json.dumps(instance)
 
     def __delitem__(self, key):
+        _si = self._load(key)
+        if _si is not None:
+            self.unmap_tokens(_si)
+
+        _pending = self._pending()
+        if _pending is not None:
+            _pending[key] = None
+            return
+
+        self._uncache(key)
         self._db.delete(key)
 
     def keys(self):
-        return self._db.keys()
+        # The token index and the queued back-channel logouts are internal
+        # book keeping, not session information
+        _prefixes = tuple(
+            KEY_FORMAT.format(label, "") for label in ["token", "revoked", "logout"]
+        )
+        _keys = [k for k in self._db.keys() if not k.startswith(_prefixes)]
+
+        _pending = self._pending()
+        if _pending:
+            _keys = [k for k in _keys if _pending.get(k, True) is not None]
+            _keys.extend(
+                k for k, v in _pending.items() if v is not None and k not in _keys
+            )
+        return _keys
+
+    @contextmanager
+    def transaction(self):
+        """
+        Coalesce the writes made to sessions. Within the block session
+        updates, and the token and state index entries that go with them,
+        are buffered and each modified session is written to the database
+        once, when the block is left. The write is done holding the locks of
+        the modified sessions. If the block is left because of an exception,
+        the buffered updates are dropped. The SSO links are written at once,
+        so they are visible within the block, and the links of sessions that
+        because of this never were stored are removed.
+        Transactions are per thread and nested ones join the outermost.
+        """
+        if self._pending() is not None:
+            yield self
+            return
+
+        self._local.pending = {}
+        self._local.index = {}
+        self._local.linked = set()
+        try:
+            yield self
+        except Exception:
+            _linked = self._local.linked
+            self._local.pending = None
+            self._local.index = None
+            self._local.linked = None
+            _dangling = [sid for sid in _linked if not self._exists(sid)]
+            if _dangling:
+                self.sso_db.remove_session_ids(_dangling)
+            raise
+
+        _pending = self._local.pending
+        _index = self._local.index
+        self._local.pending = None
+        self._local.index = None
+        self._local.linked = None
+
+        # Sessions and index entries with the session TTL are written
+        # together, other index entries grouped by TTL.
+        _items = {}
+        _other = {}
+        _deleted = []
+        for key, _entry in _index.items():
+            if _entry is None:
+                _deleted.append(key)
+            elif _entry[1] == self.session_ttl:
+                _items[key] = _entry[0]
+            else:
+                _other.setdefault(_entry[1], {})[key] = _entry[0]
+
+        with ExitStack() as _stack:
+            for _lock in self._locks(_pending):
+                _stack.enter_context(_lock)
+
+            for sid, _si in _pending.items():
+                self._uncache(sid)
+                if _si is None:
+                    _deleted.append(sid)
+                else:
+                    _items[sid] = self._serialize(_si)
+            if _items:
+                self._set_many(_items)
+            for _ttl, _values in _other.items():
+                self._set_many(_values, ttl=_ttl)
+            if _deleted:
+                self._delete_many(_deleted)
 
     def create_authz_session(self, authn_event, areq, client_id="", uid="", **kwargs):
         """
@@ -189,9 +473,7 @@ class SessionDB(object):
 
         sid = self.handler["code"].key(user=_uid, areq=areq)
 
-        access_grant = self.handler["code"](sid=sid)
-
-        _info = SessionInfo(code=access_grant, oauth_state="authz")
+        _info = SessionInfo(oauth_state="authz")
 
         if client_id:
             _info["client_id"] = client_id
@@ -205,9 +487,32 @@ class SessionDB(object):
         if kwargs:
             _info.update(kwargs)
 
+        access_grant = self.handler["code"](sid=sid, sinfo=_info)
+        _info["code"] = access_grant
+        self.map_token2sid(access_grant, sid)
+
         self[sid] = _info
         return sid
 
+    def patch(self, sid, remove=None, **kwargs):
+        """
+        Field level update of a session. Sets and removes attributes
+        with one read and one write of the session.
+
+        :param sid: Session ID
+        :param remove: Names of attributes to remove
+        :param kwargs: Attributes to set
+        :return: The updated session info
+        """
+        with self.lock(sid):
+            item = self[sid]
+            for attribute in remove or []:
+                item.pop(attribute, None)
+            for attribute, value in kwargs.items():
+                item[attribute] = value
+            self[sid] = item
+            return item
+
     def update(self, sid, **kwargs):
         """
         Add attribute value assertion to a special session
@@ -215,10 +520,7 @@ class SessionDB(object):
         :param sid: Session ID
         :param kwargs:
         """
-        item = self[sid]
-        for attribute, value in kwargs.items():
-            item[attribute] = value
-        self[sid] = item
+        self.patch(sid, **kwargs)
 
     def update_by_token(self, token, **kwargs):
         """
@@ -227,19 +529,188 @@ class SessionDB(object):
         :param token: code/access token/refresh token/...
         :param kwargs: Key word arguements
         """
-        _sid = self.handler.sid(token)
+        _sid = self.get_sid_by_token(token)
         return self.update(_sid, **kwargs)
 
+    def _set(self, key, value):
+        if self.session_ttl:
+            self._db.set(key, value, ttl=self.session_ttl)
+        else:
+            self._db.set(key, value)
+
+    def _set_many(self, items, ttl=None):
+        if ttl is None:
+            ttl = self.session_ttl
+
+        try:
+            _set_many = self._db.set_many
+        except AttributeError:
+            for key, value in items.items():
+                if ttl:
+                    self._db.set(key, value, ttl=ttl)
+                else:
+                    self._db.set(key, value)
+            return
+
+        if ttl:
+            _set_many(items, ttl=ttl)
+        else:
+            _set_many(items)
+
+    def _get_many(self, keys):
+        try:
+            _get_many = self._db.get_many
+        except AttributeError:
+            return [self._db.get(key) for key in keys]
+        return _get_many(keys)
+
+    def _delete_many(self, keys):
+        try:
+            _delete_many = self._db.delete_many
+        except AttributeError:
+            for key in keys:
+                self._db.delete(key)
+        else:
+            _delete_many(keys)
+
+    def _set_index(self, key, value, ttl=None):
+        """
+        Write an index entry. Within a transaction the write is buffered
+        together with the session updates.
+
+        :param key: Database key
+        :param value: The value
+        :param ttl: Time to live, None means the session TTL and 0 for ever
+        """
+        if ttl is None:
+            ttl = self.session_ttl
+
+        _index = self._pending_index()
+        if _index is not None:
+            _index[key] = (value, ttl)
+        elif ttl:
+            self._db.set(key, value, ttl=ttl)
+        else:
+            self._db.set(key, value)
+
+    def _delete_index(self, keys):
+        _index = self._pending_index()
+        if _index is not None:
+            for key in keys:
+                _index[key] = None
+        else:
+            self._delete_many(keys)
+
+    def _get_index(self, key):
+        _index = self._pending_index()
+        if _index is not None and key in _index:
+            _entry = _index[key]
+            return None if _entry is None else _entry[0]
+        return self._db.get(key)
+
     def map_kv2sid(self, key, value, sid):
         """ KEY_FORMAT = "__{}__{}" """
-        self._db.set(KEY_FORMAT.format(key, value), sid)
+        self._set_index(KEY_FORMAT.format(key, value), sid)
 
     def delete_kv2sid(self, key, value):
-        self._db.delete(KEY_FORMAT.format(key, value))
+        self._delete_index([KEY_FORMAT.format(key, value)])
 
     def get_sid_by_kv(self, key, value):
         """ KEY_FORMAT = "__{}__{}" """
-        return self._db.get(KEY_FORMAT.format(key, value))
+        return self._get_index(KEY_FORMAT.format(key, value))
+
+    def map_token2sid(self, token, sid):
+        """
+        Index a token so the session it belongs to can be found without
+        having to unpack the token.
+
+        :param token: code/access token/refresh token
+        :param sid: Session ID
+        """
+        if token:
+            self.map_kv2sid("token", token, sid)
+
+    def delete_token2sid(self, token):
+        if token:
+            self.delete_kv2sid("token", token)
+            if self.self_contained:
+                self.deny_token(token)
+
+    def deny_token(self, token):
+        """
+        Put a self-contained token on the deny list. The entry is kept until
+        the token would have expired anyway.
+
+        :param token: code/access token/refresh token
+        """
+        try:
+            _tinfo = self.handler.info(token)
+        except KeyError:
+            return
+
+        if not _tinfo["handler"].self_contained:
+            return
+
+        _exp = int(_tinfo["exp"])
+        if _exp < 0:
+            self._set_index(KEY_FORMAT.format("revoked", _tinfo["_id"]), True, ttl=0)
+        else:
+            _ttl = _exp - utc_time_sans_frac()
+            if _ttl > 0:
+                self._set_index(
+                    KEY_FORMAT.format("revoked", _tinfo["_id"]), True, ttl=_ttl
+                )
+
+    def is_token_denied(self, token_info):
+        return self._get_index(KEY_FORMAT.format("revoked", token_info["_id"])) is not None
+
+    def token_info(self, token):
+        """
+        Verify a self-contained token without reading the session.
+
+        :param token: A token
+        :return: The information carried by the token or None if the token
+            isn't self-contained.
+        :raises: UnknownToken if the token is unknown or has been revoked,
+            ExpiredToken if it has expired.
+        """
+        if not self.self_contained:
+            return None
+
+        try:
+            _tinfo = self.handler.info(token)
+        except KeyError:
+            raise UnknownToken(token)
+
+        if not _tinfo["handler"].self_contained:
+            return None
+        if is_expired(int(_tinfo["exp"])):
+            raise ExpiredToken()
+        if self.is_token_denied(_tinfo):
+            raise UnknownToken(token)
+        return _tinfo
+
+    def unmap_tokens(self, session_info):
+        """
+        Remove the index entries for all the tokens in a session.
+
+        :param session_info: A SessionInfo instance
+        """
+        for token_type in self.handler.keys():
+            self.delete_token2sid(session_info.get(token_type))
+
+    def get_sid_by_token(self, token):
+        """
+        Find the session a token belongs to. The token index is tried first,
+        only tokens that are not indexed are unpacked by the token handler.
+
+        :param token: code/access token/refresh token
+        :return: Session ID
+        """
+        sid = self.get_sid_by_kv("token", token)
+        if sid is None:
+            sid = self.handler.sid(token)
+        return sid
 
     def get_token(self, sid):
         _sess_info = self[sid]
@@ -267,9 +738,18 @@ class SessionDB(object):
             uid, salt=client_salt or user_salt, sector_identifier=sector_id
         )
 
-        self.sso_db.map_sid2uid(sid, uid)
-        self.update(sid, sub=sub)
-        self.sso_db.map_sid2sub(sid, sub)
+        # The SSO links expire together with the session
+        _ttl = self.session_ttl
+        _linked = getattr(self._local, "linked", None)
+        if _linked is not None:
+            _linked.add(sid)
+        self.sso_db.map_sid2uid(sid, uid, ttl=_ttl)
+        _info = self.patch(sid, sub=sub)
+        self.sso_db.map_sid2sub(sid, sub, ttl=_ttl)
+        if _info.get("client_id"):
+            self.sso_db.map_sid2client(
+                sid, _info["client_id"], uid=uid, sub=sub, ttl=_ttl
+            )
 
         return sub
 
@@ -282,12 +762,108 @@ class SessionDB(object):
     def get_sids_by_sub(self, sub):
         return self.sso_db.get_sids_by_sub(sub)
 
-    def get_sid_by_sub_and_client_id(self, sub, client_id):
-        for sid in self.sso_db.get_sids_by_sub(sub):
-            if self[sid]["authn_req"]["client_id"] == client_id:
+    def iter_sessions(self, sids, batch_size=None):
+        """
+        Iterate over sessions. Sessions that have expired or been removed are
+        skipped. Sessions are fetched batch_size at a time, so a user with
+        very many sessions is neither read one round trip per session nor
+        all at once.
+
+        :param sids: Session IDs, any iterable
+        :param batch_size: Number of sessions per fetch, default self.batch_size
+        :return: iterator over (session ID, session info) tuples
+        """
+        _batch_size = batch_size or self.batch_size
+        _sids = iter(sids or [])
+        while True:
+            _batch = list(islice(_sids, _batch_size))
+            if not _batch:
+                return
+            for sid, _si in zip(_batch, self.get_many(_batch)):
+                if _si is not None:
+                    _si["sid"] = sid
+                    yield sid, _si
+
+    def delete_sessions(self, sids):
+        """
+        Remove several sessions together with their token index entries,
+        state mappings and SSO links. Sessions are read with multi key
+        fetches and the index entries removed with one bulk delete.
+
+        :param sids: Session IDs, any iterable
+        """
+        sids = list(sids)
+        _pending = self._pending()
+        _keys = []
+        for sid, _si in self.iter_sessions(sids):
+            for token_type in self.handler.keys():
+                _token = _si.get(token_type)
+                if _token:
+                    _keys.append(KEY_FORMAT.format("token", _token))
+                    if self.self_contained:
+                        self.deny_token(_token)
+            try:
+                _keys.append(KEY_FORMAT.format("state", _si["authn_req"]["state"]))
+            except KeyError:
+                pass
+
+            self._uncache(sid)
+            if _pending is not None:
+                _pending[sid] = None
+            else:
+                _keys.append(sid)
+
+        if _keys:
+            self._delete_index(_keys)
+        self.sso_db.remove_session_ids(sids)
+
+    def _exists(self, sid):
+        _pending = self._pending()
+        if _pending is not None and sid in _pending:
+            return _pending[sid] is not None
+        return self._db.get(sid) is not None
+
+    def _unindexed_sids(self, sids):
+        """
+        The sessions that are not in the client index of the SSO database.
+        Those are the ones set up without do_sub.
+
+        :param sids: Session IDs
+        :return: list of Session IDs
+        """
+        sids = sids or []
+        return [
+            sid
+            for sid, client_id in zip(sids, self.sso_db.get_client_ids_by_sids(sids))
+            if client_id is None
+        ]
+
+    def _client_session(self, indexed, sids, match):
+        """
+        Find a user's, or subject's, session with a client. The client index
+        is used, only sessions that are not indexed are read and compared.
+
+        :param indexed: The indexed Session IDs for the client
+        :param sids: All the Session IDs of the user or subject
+        :param match: Function that given session info tells if it matches
+        :return: Session ID or None
+        """
+        for sid in indexed or []:
+            if self._exists(sid):
+                return sid
+
+        for sid, session_info in self.iter_sessions(self._unindexed_sids(sids)):
+            if match(session_info):
                 return sid
         return None
 
+    def get_sid_by_sub_and_client_id(self, sub, client_id):
+        return self._client_session(
+            self.sso_db.get_sids_by_sub_and_client_id(sub, client_id),
+            self.sso_db.get_sids_by_sub(sub),
+            lambda session_info: session_info["authn_req"]["client_id"] == client_id,
+        )
+
     def replace_refresh_token(self, sid, sinfo):
         """
         Replace an old refresh_token with a new one
@@ -297,7 +873,9 @@ class SessionDB(object):
         :return: Updated session info
         """
         refresh_token = self.handler["refresh_token"](sid, sinfo=sinfo)
+        self.delete_token2sid(sinfo.get("refresh_token"))
         sinfo["refresh_token"] = refresh_token
+        self.map_token2sid(refresh_token, sid)
         return sinfo
 
     def _make_at(self, sid, session_info, aud=None, client_id_aud=True):
@@ -334,25 +912,31 @@ class SessionDB(object):
         if grant:
             # The caller is responsible for checking if the access code exists.
             _tinfo = self.handler["code"].info(grant)
-
             key = _tinfo["sid"]
-            session_info = self[key]
 
-            # mint a new access token
-            _at = self._make_at(_tinfo["sid"], session_info)
+        with self.lock(key):
+            return self._upgrade_to_token(
+                key, grant, issue_refresh, id_token, oidreq, scope
+            )
+
+    def _upgrade_to_token(self, key, grant, issue_refresh, id_token, oidreq, scope):
+        session_info = self[key]
+        if scope:
+            session_info["access_token_scope"] = scope
+
+        # mint a new access token
+        _at = self._make_at(key, session_info)
 
+        if grant:
             # make sure the code can't be used again
             self.revoke_token(key, "code", session_info)
-        else:
-            session_info = self[key]
-            _at = self._make_at(key, session_info)
 
+        self.delete_token2sid(session_info.get("access_token"))
         session_info["access_token"] = _at
+        self.map_token2sid(_at, key)
         session_info["oauth_state"] = "token"
         session_info["token_type"] = self.handler["access_token"].token_type
 
-        if scope:
-            session_info["access_token_scope"] = scope
         if id_token:
             session_info["id_token"] = id_token
         if oidreq:
@@ -367,8 +951,17 @@ class SessionDB(object):
             session_info = self.replace_refresh_token(key, session_info)
 
         self[key] = session_info
+        self._touch_links(key)
         return session_info
 
+    def _touch_links(self, sid):
+        """
+        Writing a session renews its time to live, the SSO links are renewed
+        when tokens are issued so they don't expire before the session.
+        """
+        if self.session_ttl:
+            self.sso_db.touch(sid, self.session_ttl)
+
     def refresh_token(self, token, new_refresh=False):
         """
         Issue a new access token using a valid refresh token
@@ -385,19 +978,26 @@ class SessionDB(object):
             return False
 
         _sid = _tinfo["sid"]
+        with self.lock(_sid):
+            return self._refresh_token(_sid, _tinfo, token, new_refresh)
+
+    def _refresh_token(self, _sid, _tinfo, token, new_refresh):
         session_info = self[_sid]
         if token != session_info.get("refresh_token"):
             raise UnknownToken()
         if is_expired(int(_tinfo["exp"])):
             raise ExpiredToken()
 
+        self.delete_token2sid(session_info.get("access_token"))
         session_info["access_token"] = self._make_at(_sid, session_info)
+        self.map_token2sid(session_info["access_token"], _sid)
         session_info["token_type"] = self.handler["access_token"].token_type
 
         if new_refresh:
             session_info = self.replace_refresh_token(_sid, session_info)
 
         self[_sid] = session_info
+        self._touch_links(_sid)
         return session_info
 
     def is_token_valid(self, token):
@@ -412,6 +1012,15 @@ class SessionDB(object):
         except KeyError:
             return False
 
+        if _tinfo["handler"].self_contained:
+            # A token is removed from the session when it's replaced or
+            # revoked and is then put on the deny list.
+            if is_expired(int(_tinfo["exp"])) or self.is_token_denied(_tinfo):
+                return False
+            return _tinfo["handler"] in (
+                self.handler["code"], self.handler["access_token"]
+            )
+
         # Dependent on what state the session is in.
         session_info = self[_tinfo["sid"]]
         if is_expired(int(_tinfo["exp"])):
@@ -434,17 +1043,19 @@ class SessionDB(object):
         :param token_type: token type, one of "code", "access_token" or
             "refresh_token"
         """
-        if not session_info:
-            session_info = self[sid]
-        session_info.pop(token_type, None)
-        self[sid] = session_info
+        with self.lock(sid):
+            if not session_info:
+                session_info = self[sid]
+            self.delete_token2sid(session_info.pop(token_type, None))
+            self[sid] = session_info
 
     def revoke_all_tokens(self, token):
-        sid = self.handler.sid(token)
-        _sinfo = self[sid]
-        for token_type in self.handler.keys():
-            _sinfo.pop(token_type, None)
-        self[sid] = _sinfo
+        sid = self.get_sid_by_token(token)
+        with self.lock(sid):
+            _sinfo = self[sid]
+            for token_type in self.handler.keys():
+                self.delete_token2sid(_sinfo.pop(token_type, None))
+            self[sid] = _sinfo
 
     def revoke_session(self, sid="", token=""):
         """
@@ -455,30 +1066,30 @@ class SessionDB(object):
         """
         if not sid:
             if token:
-                sid = self.handler.sid(token)
+                sid = self.get_sid_by_token(token)
             else:
                 raise ValueError('Need one of "sid" or "token"')
 
-        _sinfo = self[sid]
-        for token_type in self.handler.keys():
-            _sinfo.pop(token_type, None)
-        _sinfo["revoked"] = True
-        self[sid] = _sinfo
+        with self.lock(sid):
+            _sinfo = self[sid]
+            for token_type in self.handler.keys():
+                self.delete_token2sid(_sinfo.pop(token_type, None))
+            _sinfo["revoked"] = True
+            self[sid] = _sinfo
 
     def get_client_id_for_session(self, sid):
         return self[sid]["client_id"]
 
     def get_active_client_ids_for_uid(self, uid):
         res = []
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            if "revoked" not in self[sid]:
-                res.append(self[sid]["client_id"])
+        for sid, session_info in self.iter_sessions(self.sso_db.get_sids_by_uid(uid)):
+            if "revoked" not in session_info:
+                res.append(session_info["client_id"])
         return res
 
     def get_verified_logout(self, uid):
         res = {}
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            session_info = self[sid]
+        for sid, session_info in self.iter_sessions(self.sso_db.get_sids_by_uid(uid)):
             try:
                 res[session_info["client_id"]] = session_info["verified_logout"]
             except KeyError:
@@ -486,8 +1097,14 @@ class SessionDB(object):
         return res
 
     def match_session(self, uid, **kwargs):
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            session_info = self[sid]
+        if list(kwargs.keys()) == ["client_id"]:
+            return self._client_session(
+                self.sso_db.get_sids_by_uid_and_client_id(uid, kwargs["client_id"]),
+                self.sso_db.get_sids_by_uid(uid),
+                lambda session_info: dict_match(kwargs, session_info),
+            )
+
+        for sid, session_info in self.iter_sessions(self.sso_db.get_sids_by_uid(uid)):
             if dict_match(kwargs, session_info):
                 return sid
         return None
@@ -512,9 +1129,15 @@ class SessionDB(object):
             return False
 
     def revoke_uid(self, uid):
-        # Revoke all sessions
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            self.update(sid, revoked=True)
+        # Revoke all sessions, written back in one batch
+        with self.transaction():
+            for sid, session_info in self.iter_sessions(self.sso_db.get_sids_by_uid(uid)):
+                session_info["revoked"] = True
+                self[sid] = session_info
+                if self.self_contained:
+                    for token_type in self.handler.keys():
+                        if session_info.get(token_type):
+                            self.deny_token(session_info[token_type])
 
         # Remove the uid from the SSO db
         self.sso_db.remove_uid(uid)
@@ -1,18 +1,28 @@
 import shelve
+import time
+
+from oidcendpoint.util import ExpiryQueue
+
+# Values with a time to live are stored as (EXPIRING, value, expiration time)
+EXPIRING = "__expiring__"
 
 
 class ShelveDataBase(object):
-    def __init__(self, filename, flag='c', protocol=None, writeback=False):
+    def __init__(self, filename, flag='c', protocol=None, writeback=False, sweep_batch=16):
         self.db = shelve.open(filename=filename, flag=flag, protocol=protocol, writeback=writeback)
+        # Only knows about items written by this instance, items written by
+        # others are removed when they are found to have expired.
+        self.expiry = ExpiryQueue()
+        self.sweep_batch = sweep_batch
 
     def __contains__(self, key):
-        if key in self.db:
+        if self.get(key) is not None:
             return True
         else:
             return False
 
     def __setitem__(self, key, value):
-        self.db[key] = value
+        self.set(key, value)
 
     def __getitem__(self, key):
         return self.get(key, None)
@@ -20,26 +30,64 @@ class ShelveDataBase(object):
     def __delitem__(self, key):
         return self.delete(key)
 
-    def set(self, key, value):
-        self.db[key] = value
+    def set(self, key, value, ttl=None):
+        """
+        Store a value.
+
+        :param key: The key
+        :param value: The value
+        :param ttl: Time to live in seconds, None means for ever
+        """
+        if ttl:
+            _exp = self.expiry.add(key, ttl)
+            self.db[key] = (EXPIRING, value, _exp)
+        else:
+            self.expiry.discard(key)
+            self.db[key] = value
+        self.sweep(self.sweep_batch)
 
     def get(self, key, default=None):
         try:
-            return self.db[key]
+            _val = self.db[key]
         except KeyError:
             return default
 
+        if isinstance(_val, tuple) and len(_val) == 3 and _val[0] == EXPIRING:
+            if time.time() >= _val[2]:
+                self.delete(key)
+                return default
+            return _val[1]
+        return _val
+
     def delete(self, key):
+        self.expiry.discard(key)
         try:
             del self.db[key]
         except KeyError:
             return
 
+    def sweep(self, limit=0):
+        """
+        Remove expired items.
+
+        :param limit: Max number of items to remove, 0 means all
+        :return: Number of removed items
+        """
+        _keys = self.expiry.pop_expired(limit)
+        for key in _keys:
+            try:
+                del self.db[key]
+            except KeyError:
+                pass
+        return len(_keys)
+
     def keys(self):
+        self.sweep()
         return self.db.keys()
 
     def clear(self):
         self.db.clear()
+        self.expiry.clear()
 
     def close(self):
         self.db.close()
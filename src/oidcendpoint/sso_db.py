@@ -1,5 +1,11 @@
+import json
 import logging
+
 from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.util import MemberSet
+from oidcendpoint.util import add_member
+from oidcendpoint.util import live_members
+from oidcendpoint.util import remove_members
 
 KEY_FORMAT = "__{}__{}"
 
@@ -7,6 +13,147 @@ KEY_FORMAT = "__{}__{}"
 logger = logging.getLogger(__name__)
 
 
+def client_key(key, client_id):
+    """
+    The key under which the sessions a user, or subject, has with a client
+    are indexed.
+
+    :param key: User ID or subject ID
+    :param client_id: Client ID
+    :return: A string
+    """
+    return json.dumps([key, client_id])
+
+
+class MultiMap(object):
+    """
+    Maps a key to a set of values, on top of a database implementing the
+    InMemoryDataBase interface.
+    Members are kept in the order they were first added. Members may be
+    given a time to live, a set expires together with its last member.
+
+    If the database has native support for sets, that is it has the methods
+    add_member, remove_member, members and members_many, those are used.
+    Otherwise each set is stored as a MemberSet, a dictionary with the
+    members as keys and their expiration times as values.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.native = all(
+            hasattr(db, attr)
+            for attr in ["add_member", "remove_member", "members", "members_many"]
+        )
+
+    @staticmethod
+    def _as_set(value):
+        if value is None:
+            return MemberSet()
+        if isinstance(value, MemberSet):
+            return value
+        if isinstance(value, list):  # stored by older versions
+            return MemberSet(dict.fromkeys(value))
+        return MemberSet(value)
+
+    def _store(self, key, values, ttl):
+        if not values:
+            self._db.delete(key)
+        elif ttl:
+            self._db.set(key, values, ttl=ttl)
+        else:
+            self._db.set(key, values)
+
+    def add(self, key, value, ttl=0):
+        """
+        :param key: The key
+        :param value: The member
+        :param ttl: Time to live of the member in seconds, 0 means for ever
+        """
+        if self.native:
+            if ttl:
+                return self._db.add_member(key, value, ttl=ttl)
+            return self._db.add_member(key, value)
+
+        _values = self._as_set(self._db.get(key))
+        if not ttl and value in _values and _values[value] is None:
+            return
+
+        self._store(key, _values, add_member(_values, value, ttl))
+
+    def remove(self, key, value):
+        if self.native:
+            return self._db.remove_member(key, value)
+
+        _values = self._as_set(self._db.get(key))
+        if remove_members(_values, [value]):
+            # The set keeps its time to live
+            self._store(key, _values, _values.ttl())
+
+    def remove_many(self, key, values):
+        """
+        Remove several members from one set.
+
+        :param key: The key
+        :param values: The members to remove
+        """
+        if self.native:
+            try:
+                _remove_members = self._db.remove_members
+            except AttributeError:
+                for value in values:
+                    self._db.remove_member(key, value)
+            else:
+                _remove_members(key, values)
+            return
+
+        _values = self._as_set(self._db.get(key))
+        if remove_members(_values, values):
+            self._store(key, _values, _values.ttl())
+
+    def get(self, key):
+        """
+        :param key: The key
+        :return: List of members or None if there are none
+        """
+        if self.native:
+            _values = self._db.members(key)
+        else:
+            _values = live_members(self._as_set(self._db.get(key)))
+        return list(_values) if _values else None
+
+    def get_many(self, keys):
+        """
+        Get the members of several sets, in one round trip if the database
+        supports it.
+
+        :param keys: List of keys
+        :return: List of lists of members, None for empty sets
+        """
+        if self.native:
+            _all = self._db.members_many(keys)
+        else:
+            try:
+                _get_many = self._db.get_many
+            except AttributeError:
+                _all = [self._db.get(key) for key in keys]
+            else:
+                _all = _get_many(keys)
+            _all = [live_members(self._as_set(_values)) for _values in _all]
+        return [list(_values) if _values else None for _values in _all]
+
+    def delete(self, key):
+        return self._db.delete(key)
+
+    def delete_many(self, keys):
+        try:
+            _delete_many = self._db.delete_many
+        except AttributeError:
+            for key in keys:
+                self._db.delete(key)
+        else:
+            _delete_many(keys)
+
+
 class SSODb(object):
     """
     Keeps the connection between an user, one or more sub claims and
@@ -17,64 +164,144 @@ class SSODb(object):
 
         session id->subject id->user id
 
+    The links can be given a time to live, normally the one of the session,
+    so that they go away when the session expires.
     """
 
     def __init__(self, db=None):
         self._db = db or InMemoryDataBase()
+        self._map = MultiMap(self._db)
+
+    @property
+    def db(self):
+        """
+        The database the links are kept in.
+        """
+        return self._db
 
-    def set(self, label, key, value):
+    def set(self, label, key, value, ttl=0):
         logger.debug("SSODb set {} - {}: {}".format(label, key, value))
-        _key = KEY_FORMAT.format(label, key)
-        _values = self._db.get(_key)
-        if not _values:
-            self._db.set(_key, [value])
-        else:
-            _values.append(value)
-            self._db.set(_key, _values)
+        self._map.add(KEY_FORMAT.format(label, key), value, ttl=ttl)
 
     def get(self, label, key):
-        _key = KEY_FORMAT.format(label, key)
-        value = self._db.get(_key)
+        value = self._map.get(KEY_FORMAT.format(label, key))
         logger.debug("SSODb get {} - {}: {}".format(label, key, value))
         return value
 
+    def get_many(self, label, keys):
+        """
+        Get the values for several keys with the same label. Uses the
+        backends multi key fetch if there is one.
+
+        :param label: The label
+        :param keys: List of keys
+        :return: List of values
+        """
+        return self._map.get_many([KEY_FORMAT.format(label, key) for key in keys])
+
     def delete(self, label, key):
-        _key = KEY_FORMAT.format(label, key)
-        return self._db.delete(_key)
+        return self._map.delete(KEY_FORMAT.format(label, key))
 
     def remove(self, label, key, value):
-        _key = KEY_FORMAT.format(label, key)
-        _values = self._db.get(_key)
-        vcount = len(_values)
-        # full clean up
-        while value in _values:
-            _values.remove(value)
-        # if changes have been made -> update them
-        if vcount != len(_values):
-            if _values:
-                self._db.set(_key, _values)
-            else:
-                self._db.delete(_key)
+        self._map.remove(KEY_FORMAT.format(label, key), value)
 
-    def map_sid2uid(self, sid, uid):
+    def map_sid2uid(self, sid, uid, ttl=0):
         """
         Store the connection between a Session ID and a User ID
 
         :param sid: Session ID
         :param uid: User ID
+        :param ttl: Time to live in seconds, 0 means for ever
         """
-        self.set("sid2uid", sid, uid)
-        self.set("uid2sid", uid, sid)
+        self.set("sid2uid", sid, uid, ttl)
+        self.set("uid2sid", uid, sid, ttl)
 
-    def map_sid2sub(self, sid, sub):
+    def map_sid2sub(self, sid, sub, ttl=0):
         """
         Store the connection between a Session ID and a subject ID.
 
         :param sid: Session ID
         :param sub: subject ID
+        :param ttl: Time to live in seconds, 0 means for ever
+        """
+        self.set("sid2sub", sid, sub, ttl)
+        self.set("sub2sid", sub, sid, ttl)
+
+    def map_sid2client(self, sid, client_id, uid="", sub="", ttl=0):
         """
-        self.set("sid2sub", sid, sub)
-        self.set("sub2sid", sub, sid)
+        Index a session by the client it belongs to, so that the sessions a
+        user, or subject, has with a specific client can be found without
+        reading the sessions.
+
+        :param sid: Session ID
+        :param client_id: Client ID
+        :param uid: User ID
+        :param sub: subject ID
+        :param ttl: Time to live in seconds, 0 means for ever
+        """
+        self.set("sid2client", sid, client_id, ttl)
+        if uid:
+            self.set("uidclient2sid", client_key(uid, client_id), sid, ttl)
+        if sub:
+            self.set("subclient2sid", client_key(sub, client_id), sid, ttl)
+
+    def touch(self, sid, ttl):
+        """
+        Renew the time to live of all the links of a session.
+
+        :param sid: Session ID
+        :param ttl: Time to live in seconds
+        """
+        _uids = self.get("sid2uid", sid) or []
+        _subs = self.get("sid2sub", sid) or []
+        for uid in _uids:
+            self.map_sid2uid(sid, uid, ttl)
+        for sub in _subs:
+            self.map_sid2sub(sid, sub, ttl)
+        for client_id in self.get("sid2client", sid) or []:
+            self.set("sid2client", sid, client_id, ttl)
+            for uid in _uids:
+                self.set("uidclient2sid", client_key(uid, client_id), sid, ttl)
+            for sub in _subs:
+                self.set("subclient2sid", client_key(sub, client_id), sid, ttl)
+
+    def get_sids_by_uid_and_client_id(self, uid, client_id):
+        return self.get("uidclient2sid", client_key(uid, client_id))
+
+    def get_sids_by_sub_and_client_id(self, sub, client_id):
+        return self.get("subclient2sid", client_key(sub, client_id))
+
+    def get_client_ids_by_sids(self, sids):
+        """
+        The clients a number of sessions belong to.
+
+        :param sids: List of Session IDs
+        :return: List of client IDs, None for sessions that are not indexed
+        """
+        return [
+            _clients[0] if _clients else None
+            for _clients in self.get_many("sid2client", sids)
+        ]
+
+    def _unmap_client(self, label, key, sids, clients=None):
+        """
+        Remove sessions from the client index of a user or subject ID.
+
+        :param label: "uidclient2sid" or "subclient2sid"
+        :param key: User ID or subject ID
+        :param sids: Session IDs
+        :param clients: The client IDs of the sessions, looked up if not given
+        """
+        if clients is None:
+            clients = self.get_client_ids_by_sids(sids)
+        _by_client = {}
+        for sid, client_id in zip(sids, clients):
+            if client_id is not None:
+                _by_client.setdefault(client_id, []).append(sid)
+        for client_id, _sids in _by_client.items():
+            self._map.remove_many(
+                KEY_FORMAT.format(label, client_key(key, client_id)), _sids
+            )
 
     def get_sids_by_uid(self, uid):
         """
@@ -116,8 +343,9 @@ class SSODb(object):
         :return: A set of subject identifiers
         """
         res = set()
-        for sid in self.get("uid2sid", uid):
-            res |= set(self.get("sid2sub", sid))
+        for _subs in self.get_many("sid2sub", self.get("uid2sid", uid) or []):
+            if _subs:
+                res |= set(_subs)
         return res
 
     def remove_sid2sub(self, sid, sub):
@@ -129,6 +357,7 @@ class SSODb(object):
 ´       """
         self.remove("sub2sid", sub, sid)
         self.remove("sid2sub", sid, sub)
+        self._unmap_client("subclient2sid", sub, [sid])
 
     def remove_sid2uid(self, sid, uid):
         """
@@ -139,6 +368,7 @@ class SSODb(object):
 ´       """
         self.remove("uid2sid", uid, sid)
         self.remove("sid2uid", sid, uid)
+        self._unmap_client("uidclient2sid", uid, [sid])
 
     def remove_session_id(self, sid):
         """
@@ -146,13 +376,34 @@ class SSODb(object):
 
         :param sid: A Session ID
         """
-        for uid in self.get("sid2uid", sid):
-            self.remove("uid2sid", uid, sid)
-        self.delete("sid2uid", sid)
+        self.remove_session_ids([sid])
+
+    def remove_session_ids(self, sids):
+        """
+        Remove all references to several Session IDs. The links are read
+        with one multi key fetch per label and each user or subject ID is
+        updated once, however many of the sessions it is connected to.
 
-        for sub in self.get("sid2sub", sid):
-            self.remove("sub2sid", sub, sid)
-        self.delete("sid2sub", sid)
+        :param sids: List of Session IDs
+        """
+        sids = list(sids)
+        if not sids:
+            return
+
+        _clients = dict(zip(sids, self.get_client_ids_by_sids(sids)))
+        for label, reverse, index in [
+            ("sid2uid", "uid2sid", "uidclient2sid"),
+            ("sid2sub", "sub2sid", "subclient2sid"),
+        ]:
+            _linked = {}
+            for sid, _values in zip(sids, self.get_many(label, sids)):
+                for _value in _values or []:
+                    _linked.setdefault(_value, []).append(sid)
+            for _value, _sids in _linked.items():
+                self._map.remove_many(KEY_FORMAT.format(reverse, _value), _sids)
+                self._unmap_client(index, _value, _sids, [_clients[sid] for sid in _sids])
+            self._map.delete_many([KEY_FORMAT.format(label, sid) for sid in sids])
+        self._map.delete_many([KEY_FORMAT.format("sid2client", sid) for sid in sids])
 
     def remove_uid(self, uid):
         """
@@ -160,8 +411,10 @@ class SSODb(object):
 
         :param uid: A User ID
         """
-        for sid in self.get("uid2sid", uid):
+        _sids = self.get("uid2sid", uid) or []
+        for sid in _sids:
             self.remove("sid2uid", sid, uid)
+        self._unmap_client("uidclient2sid", uid, _sids)
         self.delete("uid2sid", uid)
 
     def remove_sub(self, sub):
@@ -170,8 +423,10 @@ class SSODb(object):
 
         :param sub: A Subject ID
         """
-        for _sid in self.get("sub2sid", sub):
+        _sids = self.get("sub2sid", sub) or []
+        for _sid in _sids:
             self.remove("sid2sub", _sid, sub)
+        self._unmap_client("subclient2sid", sub, _sids)
         self.delete("sub2sid", sub)
 
     def close(self):
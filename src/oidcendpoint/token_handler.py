@@ -1,10 +1,15 @@
 import base64
+import binascii
 import hashlib
 import logging
+import os
+import struct
 import warnings
 
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
 from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptojwt.key_jar import init_key_jar
 from cryptojwt.utils import as_bytes
 from cryptojwt.utils import as_unicode
@@ -13,7 +18,6 @@ from oidcmsg.time_util import time_sans_frac
 
 from oidcendpoint import rndstr
 from oidcendpoint.util import importer
-from oidcendpoint.util import lv_pack
 from oidcendpoint.util import lv_unpack
 
 __author__ = "Roland Hedberg"
@@ -70,7 +74,81 @@ class Crypt(object):
         return as_unicode(dec_text)
 
 
+class AEADCrypt(object):
+    """
+    Authenticated encryption with AES-GCM. The output is the format version,
+    a random nonce and the ciphertext including the authentication tag.
+    """
+
+    version = b"\x01"
+    nonce_size = 12
+
+    def __init__(self, password):
+        self.core = AESGCM(hashlib.sha256(password.encode("utf-8")).digest())
+
+    def encrypt(self, plain):
+        _nonce = os.urandom(self.nonce_size)
+        return b"".join(
+            [self.version, _nonce, self.core.encrypt(_nonce, plain, self.version)]
+        )
+
+    def decrypt(self, ciphertext):
+        if ciphertext[:1] != self.version:
+            raise InvalidTag()
+        _nonce = ciphertext[1:1 + self.nonce_size]
+        return self.core.decrypt(
+            _nonce, ciphertext[1 + self.nonce_size:], self.version
+        )
+
+
+def pack_fields(*args):
+    """
+    Serializes strings as a sequence of 2 byte length prefixed UTF-8 values.
+
+    :param args: values
+    :return: bytes
+    """
+    _res = []
+    for arg in args:
+        _val = arg.encode("utf-8")
+        _res.append(struct.pack("!H", len(_val)))
+        _res.append(_val)
+    return b"".join(_res)
+
+
+def unpack_fields(data):
+    """
+    Deserializes what pack_fields produced.
+
+    :param data: bytes
+    :return: list of strings
+    """
+    res = []
+    pos = 0
+    while pos < len(data):
+        (_len,) = struct.unpack_from("!H", data, pos)
+        pos += 2
+        if pos + _len > len(data):
+            raise ValueError("Truncated value")
+        res.append(data[pos:pos + _len].decode("utf-8"))
+        pos += _len
+    return res
+
+
+def b64e(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64d(text):
+    text = as_bytes(text)
+    return base64.urlsafe_b64decode(text + b"=" * (-len(text) % 4))
+
+
 class Token(object):
+    # Whether the token carries enough information to be verified without
+    # reading the session.
+    self_contained = False
+
     def __init__(self, typ, lifetime=300, **kwargs):
         self.type = typ
         self.lifetime = lifetime
@@ -116,11 +194,16 @@ class Token(object):
 
 
 class DefaultToken(Token):
+    # What is packed into the token, in order
+    fields = ["_id", "type", "sid", "exp"]
+
     def __init__(
         self, password, typ="", token_type="Bearer", **kwargs
     ):
         Token.__init__(self, typ, **kwargs)
-        self.crypt = Crypt(password)
+        self.crypt = AEADCrypt(password)
+        # Tokens minted before the switch to AES-GCM can still be read
+        self.legacy_crypt = Crypt(password)
         self.token_type = token_type
 
     def __call__(self, sid="", ttype="", **kwargs):
@@ -142,14 +225,21 @@ class DefaultToken(Token):
         else:
             exp = "-1"  # Live for ever
 
-        tmp = ""
-        rnd = ""
-        while rnd == tmp:  # Don't use the same random value again
-            rnd = rndstr(32)  # Ultimate length multiple of 16
+        rnd = rndstr(16)
+
+        return b64e(
+            self.crypt.encrypt(
+                pack_fields(rnd, ttype, sid, exp, *self.claims(**kwargs))
+            )
+        )
+
+    def claims(self, **kwargs):
+        """
+        Extra values to pack into the token, after the ones every token has.
 
-        return base64.b64encode(
-            self.crypt.encrypt(lv_pack(rnd, ttype, sid, exp).encode())
-        ).decode("utf-8")
+        :return: list of strings
+        """
+        return []
 
     def key(self, user="", areq=None):
         """
@@ -165,7 +255,12 @@ class DefaultToken(Token):
 
     def split_token(self, token):
         try:
-            plain = self.crypt.decrypt(base64.b64decode(token))
+            return unpack_fields(self.crypt.decrypt(b64d(token)))
+        except (InvalidTag, binascii.Error, ValueError, struct.error, TypeError):
+            pass
+
+        try:
+            plain = self.legacy_crypt.decrypt(base64.b64decode(token))
         except Exception:
             raise UnknownToken(token)
         # order: rnd, type, sid
@@ -178,7 +273,7 @@ class DefaultToken(Token):
         :param token: A token
         :return: dictionary with info about the token
         """
-        _res = dict(zip(["_id", "type", "sid", "exp"], self.split_token(token)))
+        _res = dict(zip(self.fields, self.split_token(token)))
         if _res["type"] != self.type:
             raise WrongTokenType(_res["type"])
         else:
@@ -194,6 +289,40 @@ class DefaultToken(Token):
         return is_expired(exp, when)
 
 
+class SelfContainedToken(DefaultToken):
+    """
+    A token that besides the session ID also carries the client ID, the
+    scope, the subject and the expiration time. Introspection and token
+    validation can then be done without reading the session. Revoked tokens
+    are put on a deny list by the session database.
+    """
+
+    self_contained = True
+    fields = DefaultToken.fields + ["client_id", "scope", "sub"]
+
+    def claims(self, sinfo=None, client_id="", **kwargs):
+        if not sinfo:
+            return [client_id or "", "", ""]
+
+        if not client_id:
+            client_id = sinfo.get("client_id", "")
+        try:
+            _scope = sinfo["access_token_scope"]
+        except KeyError:
+            try:
+                _scope = sinfo["authn_req"]["scope"]
+            except KeyError:
+                _scope = []
+        if isinstance(_scope, str):
+            _scope = _scope.split(" ")
+        return [client_id, " ".join(_scope), sinfo.get("sub", "")]
+
+    def info(self, token):
+        _res = DefaultToken.info(self, token)
+        _res["scope"] = _res["scope"].split(" ") if _res.get("scope") else []
+        return _res
+
+
 class TokenHandler(object):
     def __init__(
         self, access_token_handler=None, code_handler=None, refresh_token_handler=None
@@ -207,6 +336,13 @@ class TokenHandler(object):
             self.handler["refresh_token"] = refresh_token_handler
             self.handler_order.append("refresh_token")
 
+        # token type tag (A/T/R) -> handler name
+        self.type2handler = {}
+        for name, _handler in self.handler.items():
+            _tag = getattr(_handler, "type", None)
+            if _tag:
+                self.type2handler.setdefault(_tag, name)
+
     def __getitem__(self, typ):
         return self.handler[typ]
 
@@ -217,11 +353,26 @@ class TokenHandler(object):
         if order is None:
             order = self.handler_order
 
+        tried = set()
         for typ in order:
+            if typ in tried:
+                continue
+            tried.add(typ)
             try:
                 return self.handler[typ].info(item)
-            except (KeyError, WrongTokenType, InvalidToken, UnknownToken,
-                    BadSyntax):
+            except WrongTokenType as err:
+                # The token could be unpacked and carries its type tag,
+                # go straight to the handler that minted it.
+                _typ = self.type2handler.get(err.args[0]) if err.args else None
+                if _typ is None or _typ in tried or _typ not in order:
+                    continue
+                tried.add(_typ)
+                try:
+                    return self.handler[_typ].info(item)
+                except (KeyError, WrongTokenType, InvalidToken, UnknownToken,
+                        BadSyntax):
+                    pass
+            except (KeyError, InvalidToken, UnknownToken, BadSyntax):
                 pass
 
         logger.info("Unknown token format")
@@ -1,4 +1,6 @@
+import functools
 import logging
+import threading
 
 from oidcmsg.oidc import verified_claim_name
 
@@ -20,6 +22,41 @@ TIMESYNCTOKEN = "{}:TimeSyncToken".format(SAML_AC)
 CMP_TYPE = ["exact", "minimum", "maximum", "better"]
 
 
+class LazyAuthnInfo(dict):
+    """
+    Information about an authentication method, where the method isn't
+    instantiated until it's used.
+    """
+
+    def __init__(self, factory, **kwargs):
+        """
+        :param factory: Function that returns the method instance
+        :param kwargs: The rest of the information
+        """
+        dict.__init__(self, **kwargs)
+        self._factory = factory
+        self._lock = threading.Lock()
+
+    def _method(self):
+        with self._lock:
+            if not dict.__contains__(self, "method"):
+                dict.__setitem__(self, "method", self._factory())
+        return dict.__getitem__(self, "method")
+
+    def __missing__(self, key):
+        if key == "method":
+            return self._method()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == "method" or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key == "method":
+            return self._method()
+        return dict.get(self, key, default)
+
+
 class AuthnBroker(object):
     def __init__(self):
         self.db = {}
@@ -164,7 +201,7 @@ def pick_auth(endpoint_context, areq, all=False):
     return None
 
 
-def init_method(authn_spec, endpoint_context, template_handler=None):
+def init_method(authn_spec, endpoint_context, template_handler=None, lazy=False):
     try:
         _args = authn_spec["kwargs"]
     except KeyError:
@@ -175,23 +212,30 @@ def init_method(authn_spec, endpoint_context, template_handler=None):
 
     _args["endpoint_context"] = endpoint_context
 
+    _info = {k: v for k, v in authn_spec.items() if k not in ["class", "kwargs"]}
+    if lazy:
+        return LazyAuthnInfo(
+            functools.partial(instantiate, authn_spec["class"], **_args), **_info
+        )
+
     args = {"method": instantiate(authn_spec["class"], **_args)}
-    args.update({k: v for k, v in authn_spec.items() if k not in ["class", "kwargs"]})
+    args.update(_info)
     return args
 
 
-def populate_authn_broker(methods, endpoint_context, template_handler=None):
+def populate_authn_broker(methods, endpoint_context, template_handler=None, lazy=False):
     """
 
     :param methods: Authentication method specifications
     :param endpoint_context:
     :param template_handler: A class used to render templates
+    :param lazy: If True the methods are instantiated on first use
     :return:
     """
     authn_broker = AuthnBroker()
 
     for id, authn_spec in methods.items():
-        args = init_method(authn_spec, endpoint_context, template_handler)
+        args = init_method(authn_spec, endpoint_context, template_handler, lazy)
         authn_broker[id] = args
 
     return authn_broker
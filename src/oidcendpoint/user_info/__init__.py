@@ -1,5 +1,6 @@
 import copy
 import json
+import threading
 
 __author__ = "rolandh"
 
@@ -31,12 +32,26 @@ class UserInfo(object):
     """ Read only interface to a user info store """
 
     def __init__(self, db=None, db_file=""):
-        if db is not None:
-            self.db = db
-        elif db_file:
-            self.db = json.loads(open(db_file).read())
-        else:
-            self.db = {}
+        # A db_file isn't read until the information is needed
+        self._db = db
+        self.db_file = db_file
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    if self.db_file:
+                        with open(self.db_file) as fp:
+                            self._db = json.load(fp)
+                    else:
+                        self._db = {}
+        return self._db
+
+    @db.setter
+    def db(self, value):
+        self._db = value
 
     def filter(self, userinfo, user_info_claims=None):
         """
@@ -1,6 +1,13 @@
+import functools
+import hashlib
+import heapq
 import importlib
 import json
 import logging
+import math
+import threading
+import time
+from collections.abc import MutableMapping
 from urllib.parse import parse_qs
 from urllib.parse import urlsplit
 from urllib.parse import urlunsplit
@@ -31,7 +38,93 @@ def importer(name):
     return getattr(module, c2)
 
 
-def build_endpoints(conf, endpoint_context, issuer):
+class LazyEndpoints(MutableMapping):
+    """
+    Endpoint instances keyed by name. An endpoint is not instantiated until
+    it is looked up. Checking if an endpoint exists and listing the names
+    doesn't instantiate anything, while items() and values() instantiate
+    every endpoint.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        # Reentrant, since an endpoint may look up other endpoints while it's
+        # being instantiated.
+        self._lock = threading.RLock()
+
+    def add(self, name, factory):
+        """
+        :param name: Endpoint name
+        :param factory: Function that returns the endpoint instance
+        """
+        self._factories[name] = factory
+
+    def is_instantiated(self, name):
+        return name in self._instances
+
+    def __getitem__(self, name):
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name not in self._instances:
+                self._instances[name] = self._factories[name]()
+            return self._instances[name]
+
+    def __setitem__(self, name, instance):
+        self._factories.pop(name, None)
+        self._instances[name] = instance
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._factories.pop(name, None)
+        self._instances.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._instances or name in self._factories
+
+    def __iter__(self):
+        return iter(list(dict.fromkeys(list(self._factories) + list(self._instances))))
+
+    def __len__(self):
+        return len(set(self._factories) | set(self._instances))
+
+
+def build_endpoint(cls, spec, endpoint_context, url):
+    """
+    Instantiate one endpoint.
+
+    :param cls: The endpoint class
+    :param spec: The endpoint configuration
+    :param endpoint_context: The endpoint context
+    :param url: The issuer ID without trailing slash
+    :return: The endpoint instance
+    """
+    try:
+        kwargs = spec["kwargs"]
+    except KeyError:
+        kwargs = {}
+
+    _instance = cls(endpoint_context=endpoint_context, **kwargs)
+
+    _path = spec["path"]
+    _instance.endpoint_path = _path
+    _instance.full_path = "{}/{}".format(url, _path)
+
+    if _instance.endpoint_name:
+        try:
+            _instance.endpoint_info[_instance.endpoint_name] = _instance.full_path
+        except TypeError:
+            _instance.endpoint_info = {_instance.endpoint_name: _instance.full_path}
+
+    return _instance
+
+
+def build_endpoints(conf, endpoint_context, issuer, lazy=False):
     """
     conf typically contains::
 
@@ -44,7 +137,10 @@ def build_endpoints(conf, endpoint_context, issuer):
     :param conf:
     :param endpoint_context:
     :param issuer:
-    :return:
+    :param lazy: If True the endpoints are instantiated on first use. They
+        are then keyed by the name set on the class, so endpoints that set
+        their name when instantiated can't be lazily instantiated.
+    :return: dictionary, or a LazyEndpoints instance, with the endpoints
     """
 
     if issuer.endswith("/"):
@@ -52,38 +148,128 @@ def build_endpoints(conf, endpoint_context, issuer):
     else:
         _url = issuer
 
-    endpoint = {}
+    endpoint = LazyEndpoints() if lazy else {}
     for name, spec in conf.items():
-        try:
-            kwargs = spec["kwargs"]
-        except KeyError:
-            kwargs = {}
+        if "path" not in spec:
+            # Should there be a default ?
+            raise KeyError("path")
 
         if isinstance(spec["class"], str):
-            _instance = importer(spec["class"])(
-                endpoint_context=endpoint_context, **kwargs
-            )
+            _cls = importer(spec["class"])
         else:
-            _instance = spec["class"](endpoint_context=endpoint_context, **kwargs)
+            _cls = spec["class"]
 
-        try:
-            _path = spec["path"]
-        except KeyError:
-            # Should there be a default ?
-            raise
+        _factory = functools.partial(build_endpoint, _cls, spec, endpoint_context, _url)
+        if lazy:
+            # Not instantiated yet, so the class' name is used
+            endpoint.add(_cls.name, _factory)
+        else:
+            _instance = _factory()
+            endpoint[_instance.name] = _instance
 
-        _instance.endpoint_path = _path
-        _instance.full_path = "{}/{}".format(_url, _path)
+    return endpoint
 
-        if _instance.endpoint_name:
-            try:
-                _instance.endpoint_info[_instance.endpoint_name] = _instance.full_path
-            except TypeError:
-                _instance.endpoint_info = {_instance.endpoint_name: _instance.full_path}
 
-        endpoint[_instance.name] = _instance
+def conf_fingerprint(conf):
+    """
+    A hash over a configuration. Classes and functions are represented by
+    their qualified names and other objects by the name of their class.
 
-    return endpoint
+    :param conf: The configuration, a dictionary
+    :return: A hex string
+    """
+
+    def _default(obj):
+        if not isinstance(obj, type) and not hasattr(obj, "__qualname__"):
+            obj = type(obj)
+        return "{}.{}".format(getattr(obj, "__module__", ""), obj.__qualname__)
+
+    _json = json.dumps(conf, sort_keys=True, default=_default)
+    return hashlib.sha256(_json.encode("utf-8")).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header value against an ETag. Weak comparison,
+    as is used for If-None-Match.
+
+    :param if_none_match: The header value
+    :param etag: The ETag of the present representation
+    :return: True/False
+    """
+    if not if_none_match or not etag:
+        return False
+    _etag = etag[2:] if etag.startswith("W/") else etag
+    for _tag in if_none_match.split(","):
+        _tag = _tag.strip()
+        if _tag == "*":
+            return True
+        if _tag.startswith("W/"):
+            _tag = _tag[2:]
+        if _tag == _etag:
+            return True
+    return False
+
+
+class EncodedDocument(object):
+    """
+    A JSON document that is encoded once and then served as is, with a
+    strong ETag. The document is made anew when the state it was made from
+    changes.
+    """
+
+    def __init__(self, make, max_age=3600):
+        """
+        :param make: Function that returns the document as a JSON string
+        :param max_age: How long, in seconds, clients may cache the document
+        """
+        self.make = make
+        self.max_age = max_age
+        self._state = None
+        # (body, etag)
+        self._document = None
+        self._lock = threading.Lock()
+
+    def get(self, state):
+        """
+        :param state: Anything comparable that changes when the document does
+        :return: Tuple of body and ETag
+        """
+        _document = self._document
+        if _document is not None and self._state == state:
+            return _document
+
+        _body = self.make()
+        _etag = '"{}"'.format(hashlib.sha256(_body.encode("utf-8")).hexdigest())
+        with self._lock:
+            self._document = (_body, _etag)
+            self._state = state
+        return self._document
+
+    def invalidate(self):
+        with self._lock:
+            self._document = None
+            self._state = None
+
+    def response(self, state, if_none_match=None):
+        """
+        The document in the form returned by Endpoint.do_response. If the
+        client already has this version, the response is empty and
+        response_code is 304.
+
+        :param state: Anything comparable that changes when the document does
+        :param if_none_match: The value of the requests If-None-Match header
+        :return: dictionary
+        """
+        _body, _etag = self.get(state)
+        http_headers = [
+            ("Content-type", "application/json"),
+            ("ETag", _etag),
+            ("Cache-Control", "public, max-age={}".format(self.max_age)),
+        ]
+        if etag_matches(if_none_match, _etag):
+            return {"response": "", "http_headers": http_headers, "response_code": 304}
+        return {"response": _body, "http_headers": http_headers}
 
 
 class JSONDictDB(object):
@@ -98,6 +284,22 @@ class JSONDictDB(object):
         return item in self._db
 
 
+def key_state(keyjar, owner):
+    """
+    A fingerprint of the keys belonging to an owner. Changes when keys are
+    added, removed or marked as inactive.
+
+    :param keyjar: A cryptojwt.key_jar.KeyJar instance
+    :param owner: The owner of the keys, "" for my own keys
+    :return: A tuple
+    """
+    try:
+        _keys = keyjar.get_issuer_keys(owner)
+    except KeyError:
+        _keys = []
+    return tuple((id(_key), _key.inactive_since) for _key in _keys or [])
+
+
 def instantiate(cls, **kwargs):
     if isinstance(cls, str):
         return importer(cls)(**kwargs)
@@ -170,3 +372,160 @@ def split_uri(uri):
         return base, ''
 
 
+class ExpiryQueue(object):
+    """
+    Keeps track of when keys expire and hands them out in expiration order.
+    Used by the databases to get rid of expired items incrementally.
+    """
+
+    def __init__(self):
+        # key -> expiration time
+        self.expires = {}
+        # (expiration time, key) heap, may hold outdated entries
+        self._queue = []
+
+    def add(self, key, ttl, when=0):
+        """
+        Set when a key expires.
+
+        :param key: The key
+        :param ttl: Time to live in seconds
+        :param when: Time from which the ttl is counted, 0 means now
+        :return: Expiration time
+        """
+        exp = (when or time.time()) + ttl
+        self.expires[key] = exp
+        heapq.heappush(self._queue, (exp, key))
+        # Keys that are set again leave outdated entries behind
+        if len(self._queue) > 2 * len(self.expires) + 64:
+            self._queue = [(e, k) for k, e in self.expires.items()]
+            heapq.heapify(self._queue)
+        return exp
+
+    def discard(self, key):
+        self.expires.pop(key, None)
+
+    def is_expired(self, key, when=0):
+        exp = self.expires.get(key)
+        if exp is None:
+            return False
+        return (when or time.time()) >= exp
+
+    def pop_expired(self, limit=0, when=0):
+        """
+        Remove and return keys that have expired.
+
+        :param limit: Max number of keys to return, 0 means no limit
+        :param when: The time against which to check the expiration
+        :return: List of keys
+        """
+        when = when or time.time()
+        res = []
+        while self._queue and self._queue[0][0] <= when:
+            exp, key = heapq.heappop(self._queue)
+            if self.expires.get(key) == exp:
+                del self.expires[key]
+                res.append(key)
+                if limit and len(res) >= limit:
+                    break
+        return res
+
+    def clear(self):
+        self.expires = {}
+        self._queue = []
+
+    def __len__(self):
+        return len(self.expires)
+
+
+class MemberSet(dict):
+    """
+    A set kept as a dictionary of members and their expiration times, None
+    for members that never expire. When the set as a whole expires is kept
+    track of, so adding a member doesn't have to look at the others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        _exps = [_exp for _exp in self.values() if _exp is not None]
+        # The number of members that never expire
+        self.forever = len(self) - len(_exps)
+        # The latest expiration time of the other members, an upper bound
+        # once members have been removed
+        self.expires = max(_exps) if _exps else 0
+        # The size of the set when expired members were last dropped
+        self.swept = len(self)
+
+    def ttl(self, when=0):
+        """
+        :param when: Time from which the ttl is counted, 0 means now
+        :return: Time to live of the whole set, 0 if it never expires and
+            negative if it has expired
+        """
+        if self.forever:
+            return 0
+        _ttl = int(math.ceil(self.expires - (when or time.time())))
+        return _ttl if _ttl > 0 else -1
+
+
+def add_member(members, value, ttl=0, when=0):
+    """
+    Add a member to a set. Expired members are dropped when the set has
+    doubled in size since that was last done, so the cost of adding a
+    member doesn't grow with the size of the set.
+
+    :param members: A MemberSet, modified in place
+    :param value: The member
+    :param ttl: Time to live of the member in seconds, 0 means for ever
+    :param when: Time from which the ttl is counted, 0 means now
+    :return: Time to live of the whole set, 0 if it never expires
+    """
+    when = when or time.time()
+    if len(members) >= 2 * max(members.swept, 8):
+        for _value, _exp in list(members.items()):
+            if _exp is not None and _exp <= when:
+                del members[_value]
+        members.swept = len(members)
+
+    if value in members and members[value] is None:
+        members.forever -= 1
+    _exp = when + ttl if ttl else None
+    members[value] = _exp
+    if _exp is None:
+        members.forever += 1
+    else:
+        members.expires = max(members.expires, _exp)
+    return members.ttl(when)
+
+
+def remove_members(members, values):
+    """
+    Remove members from a set.
+
+    :param members: A MemberSet, modified in place
+    :param values: The members to remove
+    :return: True if any member was removed
+    """
+    _removed = False
+    for value in values:
+        try:
+            _exp = members.pop(value)
+        except KeyError:
+            continue
+        _removed = True
+        if _exp is None:
+            members.forever -= 1
+    return _removed
+
+
+def live_members(members, when=0):
+    """
+    :param members: A MemberSet, or a dictionary of members and their
+        expiration times
+    :param when: The time against which to check the expiration
+    :return: List of the members that have not expired
+    """
+    when = when or time.time()
+    return [
+        _value for _value, _exp in members.items() if _exp is None or _exp > when
+    ]
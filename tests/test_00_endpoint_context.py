@@ -1,9 +1,11 @@
 import io
 from copy import copy
+from copy import deepcopy
 
 import pytest
 import yaml
 from cryptojwt.key_jar import build_keyjar
+from oidcendpoint.endpoint import Endpoint
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.id_token import IDToken
 from oidcendpoint.oidc.add_on.pkce import add_pkce_support
@@ -14,6 +16,7 @@ from oidcendpoint.oidc.session import Session
 from oidcendpoint.oidc.token import AccessToken
 from oidcendpoint.oidc.userinfo import UserInfo
 from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
+from oidcendpoint.util import build_endpoints
 
 KEYDEFS = [
     {"type": "RSA", "key": "", "use": ["sig"]},
@@ -93,6 +96,9 @@ oidc_clients:
       - code
 """
 
+# Before any test has had a chance to modify conf
+LAZY_CONF = deepcopy(conf)
+
 
 def test_capabilities_default():
     endpoint_context = EndpointContext(conf)
@@ -152,3 +158,52 @@ def test_cdb():
     endpoint_context.cdb = _clients["oidc_clients"]
 
     assert set(endpoint_context.cdb.keys()) == {"client1", "client2", "client3"}
+
+
+def test_lazy_init(tmp_path):
+    _snapshot = str(tmp_path / "provider_info.json")
+    _cnf = deepcopy(LAZY_CONF)
+    _cnf.update({"lazy_init": True, "provider_info_snapshot": _snapshot})
+    endpoint_context = EndpointContext(_cnf)
+    _provider_info = endpoint_context.provider_info
+
+    # Started from the snapshot, nothing instantiated that isn't used
+    _cnf = deepcopy(LAZY_CONF)
+    _cnf.update({"lazy_init": True, "provider_info_snapshot": _snapshot})
+    endpoint_context = EndpointContext(_cnf)
+    assert set(endpoint_context.provider_info) == set(_provider_info)
+    assert "registration" in endpoint_context.endpoint
+    assert not endpoint_context.endpoint.is_instantiated("registration")
+    assert not dict.__contains__(endpoint_context.authn_broker["anon"], "method")
+
+    _endpoint = endpoint_context.endpoint["registration"]
+    assert _endpoint.full_path == "https://example.com/registration"
+    assert endpoint_context.endpoint.is_instantiated("registration")
+    assert endpoint_context.authn_broker["anon"]["method"].user == "diana"
+
+    # A changed configuration makes the snapshot stale
+    _cnf = deepcopy(LAZY_CONF)
+    _cnf.update({"lazy_init": True, "provider_info_snapshot": _snapshot})
+    _cnf["endpoint"]["authorization_endpoint"]["kwargs"] = {
+        "response_types_supported": ["code"]
+    }
+    endpoint_context = EndpointContext(_cnf)
+    assert endpoint_context.provider_info["response_types_supported"] == ["code"]
+
+
+class Renamed(Endpoint):
+    name = "renamed"
+
+    def __init__(self, endpoint_context, **kwargs):
+        Endpoint.__init__(self, endpoint_context, **kwargs)
+        self.name = "per_instance"
+
+
+@pytest.mark.parametrize("lazy,key", [(False, "per_instance"), (True, "renamed")])
+def test_endpoint_key(lazy, key):
+    endpoint_context = EndpointContext(conf)
+    _conf = {"renamed": {"path": "renamed", "class": Renamed, "kwargs": {}}}
+    _endpoints = build_endpoints(_conf, endpoint_context, "https://example.com/", lazy=lazy)
+    # Lazily instantiated endpoints are keyed by the class' name
+    assert list(_endpoints.keys()) == [key]
+    assert _endpoints[key].name == "per_instance"
@@ -1,9 +1,18 @@
+import time
+
+from oidcendpoint.in_memory_db import ConcurrentInMemoryDataBase
+from oidcendpoint.in_memory_db import InMemoryDataBase
 from oidcendpoint.oidc.authorization import Authorization
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
 from oidcendpoint.oidc.registration import Registration
 from oidcendpoint.oidc.token import AccessToken
 from oidcendpoint.oidc.userinfo import UserInfo
 from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
+from oidcendpoint.util import ExpiryQueue
+from oidcendpoint.util import MemberSet
+from oidcendpoint.util import add_member
+from oidcendpoint.util import live_members
+from oidcendpoint.util import remove_members
 
 KEYDEFS = [
     {"type": "RSA", "key": "", "use": ["sig"]},
@@ -56,3 +65,96 @@ conf = {
     },
     "template_dir": "template",
 }
+
+
+def test_expiry_queue():
+    eq = ExpiryQueue()
+    now = time.time()
+    eq.add("a", 10, when=now)
+    eq.add("b", 20, when=now)
+    eq.add("c", 30, when=now)
+    # Setting a new time to live replaces the old one
+    eq.add("a", 40, when=now)
+
+    assert eq.is_expired("b", when=now + 25)
+    assert not eq.is_expired("a", when=now + 25)
+    assert not eq.is_expired("x", when=now + 25)
+
+    assert eq.pop_expired(when=now + 25) == ["b"]
+    assert eq.pop_expired(limit=1, when=now + 50) == ["c"]
+    assert eq.pop_expired(when=now + 50) == ["a"]
+    assert len(eq) == 0
+
+
+def test_add_member():
+    now = time.time()
+    members = MemberSet()
+    assert add_member(members, "a", 10, when=now) == 10
+    assert add_member(members, "b", 20, when=now) == 20
+    assert live_members(members, when=now + 15) == ["b"]
+    assert add_member(members, "c", when=now + 15) == 0
+    assert live_members(members, when=now + 50) == ["c"]
+
+    # The set keeps its time to live when members are removed
+    assert remove_members(members, ["c", "x"])
+    assert not remove_members(members, ["x"])
+    assert members.ttl(when=now) == 20
+
+
+def test_add_member_drops_expired():
+    now = time.time()
+    members = MemberSet()
+    for i in range(16):
+        add_member(members, i, 10, when=now)
+    # Expired members are dropped once the set has doubled in size
+    add_member(members, "a", 10, when=now + 15)
+    assert list(members) == ["a"]
+    assert members.swept == 0
+
+
+def test_in_memory_db_ttl():
+    db = InMemoryDataBase()
+    db.set("foo", "bar", ttl=60)
+    db.set("xyz", "abc")
+    assert db.get("foo") == "bar"
+    assert "foo" in db
+
+    # Pretend time has passed
+    db.expiry.add("foo", -1)
+    assert db.get("foo") is None
+    assert "foo" not in db
+    assert list(db.keys()) == ["xyz"]
+
+    db.set("foo", "bar", ttl=60)
+    db.expiry.add("foo", -1)
+    db.set("other", "value")
+    # Expired items are removed when something new is stored
+    assert "foo" not in db.db
+
+
+def test_concurrent_in_memory_db():
+    db = ConcurrentInMemoryDataBase(shards=4)
+    for i in range(20):
+        db.set("key{}".format(i), i)
+    db.set("foo", "bar", ttl=60)
+    assert db.get_many(["key1", "key7", "xyz"]) == [1, 7, None]
+    assert "foo" in db
+    assert len(db.keys()) == 21
+
+    db.delete("key1")
+    assert "key1" not in db
+    with db.lock("foo"):
+        # The lock is reentrant
+        db.set("foo", db.get("foo") + "baz")
+    assert db["foo"] == "barbaz"
+
+    db.add_member("set", "a")
+    db.add_member("set", "b")
+    db.add_member("set", "a")
+    assert db.members("set") == ["a", "b"]
+    db.remove_member("set", "a")
+    db.remove_member("set", "b")
+    assert db.members_many(["set"]) == [[]]
+
+    db.clear()
+    assert db.keys() == []
@@ -1,4 +1,5 @@
 import base64
+import logging
 
 import pytest
 from cryptojwt.jws.exception import NoSuitableSigningKeys
@@ -9,6 +10,7 @@ from cryptojwt.utils import as_bytes
 from cryptojwt.utils import as_unicode
 
 from oidcendpoint import JWT_BEARER
+from oidcendpoint.client_authn import AssertionKeyCache
 from oidcendpoint.client_authn import AuthnFailure
 from oidcendpoint.client_authn import BearerBody
 from oidcendpoint.client_authn import BearerHeader
@@ -17,7 +19,11 @@ from oidcendpoint.client_authn import ClientSecretJWT
 from oidcendpoint.client_authn import ClientSecretPost
 from oidcendpoint.client_authn import JWSAuthnMethod
 from oidcendpoint.client_authn import PrivateKeyJWT
+from oidcendpoint.client_authn import SecretVerifier
+from oidcendpoint.client_authn import applicable_methods
 from oidcendpoint.client_authn import basic_authn
+from oidcendpoint.client_authn import check_secret
+from oidcendpoint.client_authn import hash_secret
 from oidcendpoint.client_authn import verify_client
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.exception import MultipleUsage
@@ -145,6 +151,17 @@ class TestClientSecretPost():
         with pytest.raises(AuthnFailure):
             self.method.verify(request)
 
+    def test_client_secret_post_hashed(self):
+        _context = EndpointContext(CONF, keyjar=KEYJAR)
+        _context.cdb["client_2"] = {"client_secret_hash": hash_secret("hemligt", 1000)}
+        _method = ClientSecretPost(_context)
+
+        request = {"client_id": "client_2", "client_secret": "hemligt"}
+        assert _method.verify(request)["client_id"] == "client_2"
+        request = {"client_id": "client_2", "client_secret": "pillow"}
+        with pytest.raises(AuthnFailure):
+            _method.verify(request)
+
 
 class TestClientSecretJWT():
     @pytest.fixture(autouse=True)
@@ -360,6 +377,64 @@ class TestJWSAuthnMethod():
         assert self.method.verify(request=request, endpoint="userinfo", key_type='client_secret')
 
 
+def test_hash_secret():
+    _hash = hash_secret("hemligt", 1000)
+    assert _hash.startswith("pbkdf2_sha256$1000$")
+    assert "hemligt" not in _hash
+    assert check_secret("hemligt", _hash)
+    assert not check_secret("pillow", _hash)
+    assert not check_secret("hemligt", "garbage")
+
+
+def test_secret_verifier(monkeypatch):
+    _hash = hash_secret("hemligt", 1000)
+    _verifier = SecretVerifier(ttl=60)
+    assert _verifier.verify("client_1", "hemligt", _hash)
+
+    _calls = []
+    monkeypatch.setattr(
+        "oidcendpoint.client_authn.check_secret", lambda *args: _calls.append(args)
+    )
+    assert _verifier.verify("client_1", "hemligt", _hash)
+    assert _calls == []
+    # Not cached
+    assert not _verifier.verify("client_1", "pillow", _hash)
+    assert not _verifier.verify("client_2", "hemligt", _hash)
+    assert len(_calls) == 2
+
+
+def test_assertion_key_cache():
+    _keyjar = KeyJar()
+    _keyjar.add_symmetric("client_1", "a shared secret for client_1", ["sig"])
+    _cache = AssertionKeyCache(_keyjar)
+
+    _keys = _cache.oct_keys("client_1")
+    assert len(_keys) == 1
+    assert _cache.oct_keys("client_1") is _keys
+
+    # Key rotation
+    _keyjar.add_symmetric("client_1", "another shared secret for client_1", ["sig"])
+    assert len(_cache.oct_keys("client_1")) == 2
+
+    _keys = _cache.oct_keys("client_1")
+    _cache.invalidate("client_1")
+    assert _cache.oct_keys("client_1") is not _keys
+
+
+def test_allowed_target_uris():
+    _endpoint = endpoint_context.endpoint["userinfo"]
+    _uris = _endpoint.allowed_target_uris()
+    assert _uris == {_endpoint.full_path, CONF["issuer"]}
+    assert _endpoint.allowed_target_uris() is _uris
+
+    _endpoint.allowed_targets.append("token")
+    try:
+        assert endpoint_context.endpoint["token"].full_path in _endpoint.allowed_target_uris()
+    finally:
+        _endpoint.allowed_targets.remove("token")
+    assert _endpoint.allowed_target_uris() == _uris
+
+
 def test_basic_auth():
     _token = "{}:{}".format(client_id, client_secret)
     token = as_unicode(base64.b64encode(as_bytes(_token)))
@@ -494,6 +569,18 @@ class TestVerify2():
         assert set(res.keys()) == {"method", "client_id"}
         assert res["method"] == "client_secret_post"
 
+    def test_verify_client_no_write(self):
+        _db = self.endpoint_context.cdb.db
+        request = {"client_id": client_id, "client_secret": client_secret}
+        verify_client(self.endpoint_context, request, endpoint="token")
+        assert _db.get(client_id)["auth_method"] == {"dict": "client_secret_post"}
+
+        # Same method again, nothing written
+        _writes = []
+        _db.set = lambda *args: _writes.append(args)
+        verify_client(self.endpoint_context, request, endpoint="token")
+        assert _writes == []
+
     def test_verify_client_client_secret_basic(self):
         _token = "{}:{}".format(client_id, client_secret)
         token = as_unicode(base64.b64encode(as_bytes(_token)))
@@ -541,3 +628,67 @@ class TestVerify2():
             endpoint="registration"
         )
         assert res == {}
+
+
+def test_applicable_methods():
+    assert applicable_methods({}, "Basic abc") == {"client_secret_basic"}
+    assert applicable_methods({}, "Bearer abc") == {"bearer_header"}
+    assert applicable_methods({"client_id": "a", "client_secret": "b"}) == {
+        "client_secret_post"
+    }
+    assert applicable_methods({"access_token": "a"}) == {"bearer_body"}
+
+    _header = as_unicode(base64.urlsafe_b64encode(b'{"alg":"RS256"}')).rstrip("=")
+    request = {"client_assertion": "{}.e30.c2ln".format(_header)}
+    assert applicable_methods(request) == {"private_key_jwt"}
+
+    request = {"client_assertion": "garbage"}
+    assert applicable_methods(request) == {"client_secret_jwt", "private_key_jwt"}
+
+
+class TestClientAuthnDispatcher():
+    @pytest.fixture(autouse=True)
+    def create_dispatcher(self):
+        self.endpoint_context = EndpointContext(CONF, keyjar=KEYJAR)
+        self.endpoint_context.cdb[client_id] = {"client_secret": client_secret}
+        self.dispatcher = self.endpoint_context.endpoint["token"].client_authn_dispatcher
+
+    def test_single_candidate(self):
+        request = {"client_id": client_id, "client_secret": client_secret}
+        _methods = self.dispatcher.candidates(request)
+        assert [m.tag for m in _methods] == ["client_secret_post"]
+
+    def test_registered_method_first(self):
+        self.endpoint_context.cdb[client_id] = {
+            "client_secret": client_secret,
+            "token_endpoint_auth_method": "client_secret_post",
+        }
+        _token = "{}:{}".format(client_id, client_secret)
+        authz_token = "Basic {}".format(as_unicode(base64.b64encode(as_bytes(_token))))
+        request = {"client_id": client_id, "client_secret": client_secret}
+        _methods = self.dispatcher.candidates(request, authz_token)
+        assert [m.tag for m in _methods] == ["client_secret_post", "client_secret_basic"]
+
+    def test_failures_counted(self, caplog):
+        request = {"client_id": client_id, "client_secret": "wrong"}
+        with caplog.at_level(logging.INFO, logger="oidcendpoint.client_authn"):
+            assert self.dispatcher.verify(request, endpoint="token") == {}
+        assert self.dispatcher.failures[("client_secret_post", "AuthnFailure")] == 1
+        # Counted, not logged
+        assert not caplog.records
+
+    def test_rebuilt(self):
+        _endpoint = self.endpoint_context.endpoint["token"]
+        _endpoint.client_authn_method = [None]
+        assert _endpoint.client_authn_dispatcher is not self.dispatcher
+        assert _endpoint.client_authn_dispatcher.allow_none
+
+    def test_rebuilt_changed_in_place(self):
+        _endpoint = self.endpoint_context.endpoint["token"]
+        assert not self.dispatcher.allow_none
+        _endpoint.client_authn_method.append(None)
+        try:
+            assert _endpoint.client_authn_dispatcher.allow_none
+        finally:
+            _endpoint.client_authn_method.remove(None)
+        assert not _endpoint.client_authn_dispatcher.allow_none
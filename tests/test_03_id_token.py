@@ -1,6 +1,7 @@
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from cryptojwt.jws import jws
@@ -9,6 +10,7 @@ from cryptojwt.key_jar import KeyJar
 from oidcendpoint.client_authn import verify_client
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.id_token import IDToken
+from oidcendpoint.id_token import JWTBatchSigner
 from oidcendpoint.id_token import get_sign_and_encrypt_algorithms
 from oidcendpoint.oidc import userinfo
 from oidcendpoint.oidc.authorization import Authorization
@@ -378,3 +380,103 @@ class TestEndpoint(object):
         res = _jwt.unpack(_token)
         assert "address" not in res
         assert "nickname" not in res
+
+    def test_client_profile(self):
+        session_info = {
+            "authn_req": AREQN,
+            "sub": "sub",
+            "authn_event": {
+                "authn_info": "loa2",
+                "authn_time": time.time(),
+                "uid": "diana"
+            },
+        }
+        _idtoken = self.endpoint_context.idtoken
+        _idtoken.enable_claims_per_client = True
+        req = {"client_id": "client_1"}
+        _idtoken.make(req, session_info)
+        _profile = _idtoken.client_profile("client_1")
+        assert _profile["claims"] == {}
+        # Nothing changed, the profile is reused
+        assert _idtoken.client_profile("client_1") is _profile
+
+        self.endpoint_context.cdb["client_1"]["id_token_claims"] = {
+            "address": None
+        }
+        _token = _idtoken.make(req, session_info)
+        assert _idtoken.client_profile("client_1")["claims"] == {"address": None}
+
+        client_keyjar = KeyJar()
+        _jwks = self.endpoint_context.keyjar.export_jwks()
+        client_keyjar.import_jwks(_jwks, self.endpoint_context.issuer)
+        _jwt = JWT(key_jar=client_keyjar, iss="client_1")
+        res = _jwt.unpack(_token)
+        assert "address" in res
+
+        # In place update of a nested value
+        self.endpoint_context.cdb["client_1"]["id_token_claims"]["email"] = None
+        assert _idtoken.client_profile("client_1")["claims"] == {
+            "address": None,
+            "email": None,
+        }
+
+        # Change of the providers defaults
+        _profile = _idtoken.client_profile("client_1")
+        self.endpoint_context.jwx_def["signing_alg"] = {"id_token": "ES256"}
+        try:
+            assert _idtoken.client_profile("client_1") is not _profile
+        finally:
+            del self.endpoint_context.jwx_def["signing_alg"]
+
+    def test_sid(self):
+        session_info = {
+            "authn_req": AREQN,
+            "sub": "sub",
+            "authn_event": {
+                "authn_info": "loa2",
+                "authn_time": time.time(),
+                "uid": "diana"
+            },
+        }
+        self.endpoint_context.provider_info["backchannel_logout_supported"] = True
+        self.endpoint_context.provider_info[
+            "backchannel_logout_session_supported"] = True
+        self.endpoint_context.cdb["client_1"][
+            "backchannel_logout_uri"] = "https://example.com/bc"
+
+        req = {"client_id": "client_1"}
+        _token = self.endpoint_context.idtoken.make(
+            req, session_info, sid="session_id"
+        )
+        client_keyjar = KeyJar()
+        _jwks = self.endpoint_context.keyjar.export_jwks()
+        client_keyjar.import_jwks(_jwks, self.endpoint_context.issuer)
+        _jwt = JWT(key_jar=client_keyjar, iss="client_1")
+        res = _jwt.unpack(_token)
+        assert res["sid"] == "session_id"
+
+    @pytest.mark.parametrize("workers", [0, 2])
+    def test_batch_signer(self, workers):
+        _executor = ThreadPoolExecutor(workers) if workers else None
+        _signer = JWTBatchSigner(
+            self.endpoint_context.keyjar, self.endpoint_context.issuer, "RS256",
+            lifetime=300, with_jti=True, executor=_executor
+        )
+        _tokens = _signer.sign_many(
+            [({"sub": "sub{}".format(i)}, "client_{}".format(i)) for i in range(4)]
+        )
+
+        client_keyjar = KeyJar()
+        _jwks = self.endpoint_context.keyjar.export_jwks()
+        client_keyjar.import_jwks(_jwks, self.endpoint_context.issuer)
+        _jtis = set()
+        for i, _token in enumerate(_tokens):
+            _jwt = JWT(key_jar=client_keyjar, iss="client_{}".format(i))
+            res = _jwt.unpack(_token)
+            assert res["sub"] == "sub{}".format(i)
+            assert res["aud"] == ["client_{}".format(i)]
+            assert res["exp"] - res["iat"] == 300
+            _jtis.add(res["jti"])
+        assert len(_jtis) == 4
+        if _executor:
+            _executor.shutdown()
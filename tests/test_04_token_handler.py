@@ -5,10 +5,16 @@ import random
 import time
 
 import pytest
+from oidcendpoint.token_handler import AEADCrypt
 from oidcendpoint.token_handler import Crypt
 from oidcendpoint.token_handler import DefaultToken
+from oidcendpoint.token_handler import SelfContainedToken
 from oidcendpoint.token_handler import TokenHandler
+from oidcendpoint.token_handler import UnknownToken
 from oidcendpoint.token_handler import is_expired
+from oidcendpoint.token_handler import pack_fields
+from oidcendpoint.token_handler import unpack_fields
+from oidcendpoint.util import lv_pack
 
 
 def test_is_expired():
@@ -60,6 +66,24 @@ class TestCrypt(object):
         assert db[plain[:-4]] == "foobar"
 
 
+def test_pack_fields():
+    _fields = ["abc", "", "T", "åäö"]
+    assert unpack_fields(pack_fields(*_fields)) == _fields
+    with pytest.raises(ValueError):
+        unpack_fields(pack_fields(*_fields)[:-1])
+
+
+def test_aead_crypt():
+    crypt = AEADCrypt("4-amino-1H-pyrimidine-2-one")
+    ctext = crypt.encrypt(b"Cytosine")
+    assert crypt.decrypt(ctext) == b"Cytosine"
+    # Same plain text, different cipher text
+    assert crypt.encrypt(b"Cytosine") != ctext
+
+    with pytest.raises(Exception):
+        crypt.decrypt(ctext[:-1] + bytes([ctext[-1] ^ 1]))
+
+
 class TestDefaultToken(object):
     @pytest.fixture(autouse=True)
     def setup_token_handler(self):
@@ -86,6 +110,22 @@ class TestDefaultToken(object):
         }
         assert _info["handler"] == self.th
 
+    def test_legacy_token(self):
+        _token = base64.b64encode(
+            self.th.legacy_crypt.encrypt(
+                lv_pack("0123456789", "A", "session_id", "-1").encode()
+            )
+        ).decode("utf-8")
+        _info = self.th.info(_token)
+        assert _info["sid"] == "session_id"
+        assert self.th.is_expired(_token) is False
+
+    def test_tampered_token(self):
+        _token = self.th("session_id")
+        _tampered = _token[:-2] + ("AA" if _token[-2:] != "AA" else "BB")
+        with pytest.raises(UnknownToken):
+            self.th.info(_tampered)
+
     def test_is_expired(self):
         _token = self.th("another_id")
         assert self.th.is_expired(_token) is False
@@ -94,6 +134,43 @@ class TestDefaultToken(object):
         assert self.th.is_expired(_token, when)
 
 
+class TestSelfContainedToken(object):
+    @pytest.fixture(autouse=True)
+    def setup_token_handler(self):
+        password = "The longer the better. Is this close to enough ?"
+        self.th = SelfContainedToken(password, typ="T", lifetime=3600)
+
+    def test_info(self):
+        _sinfo = {
+            "client_id": "client_1",
+            "sub": "subject",
+            "authn_req": {"scope": ["openid", "email"]},
+        }
+        _token = self.th("session_id", sinfo=_sinfo)
+        _info = self.th.info(_token)
+
+        assert _info["sid"] == "session_id"
+        assert _info["client_id"] == "client_1"
+        assert _info["sub"] == "subject"
+        assert _info["scope"] == ["openid", "email"]
+        assert _info["handler"] == self.th
+
+    def test_access_token_scope(self):
+        _sinfo = {
+            "client_id": "client_1",
+            "authn_req": {"scope": ["openid", "email"]},
+            "access_token_scope": ["openid"],
+        }
+        _info = self.th.info(self.th("session_id", sinfo=_sinfo))
+        assert _info["scope"] == ["openid"]
+        assert _info["sub"] == ""
+
+    def test_no_session_info(self):
+        _info = self.th.info(self.th("session_id"))
+        assert _info["client_id"] == ""
+        assert _info["scope"] == []
+
+
 class TestTokenHandler(object):
     @pytest.fixture(autouse=True)
     def setup_token_handler(self):
@@ -145,6 +222,22 @@ class TestTokenHandler(object):
         _token = self.handler["code"]("another_id")
         assert self.handler.type(_token) == "A"
 
+    def test_info_type_dispatch(self):
+        _token = self.handler["refresh_token"]("another_id")
+        _calls = []
+        for name, _handler in self.handler.handler.items():
+            _info = _handler.info
+
+            def _wrap(token, _info=_info, name=name):
+                _calls.append(name)
+                return _info(token)
+
+            _handler.info = _wrap
+
+        assert self.handler.info(_token)["type"] == "R"
+        # The code handler recognizes the token and points to the right one
+        assert _calls == ["code", "refresh_token"]
+
     def test_get_handler(self):
         _token = self.handler["code"]("another_id")
         th = self.handler.get_handler(_token)
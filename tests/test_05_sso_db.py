@@ -1,5 +1,9 @@
+import threading
+
 import pytest
 
+from oidcendpoint.in_memory_db import ConcurrentInMemoryDataBase
+from oidcendpoint.in_memory_db import InMemoryDataBase
 from oidcendpoint.shelve_db import ShelveDataBase
 from oidcendpoint.sso_db import SSODb
 
@@ -118,6 +122,62 @@ class TestSessionDB(object):
 
         assert set(res) == {"abcdefgh", "012346789"}
 
+    def test_map_same_sid2uid_twice(self):
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        self.sso_db.map_sid2uid("session id 2", "Lizz")
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 1", "session id 2"]
+
+        self.sso_db.remove_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 2"]
+
+    def test_list_valued_keys(self):
+        # As stored by older versions
+        self.sso_db._db.set("__uid2sid__Lizz", ["session id 1", "session id 2"])
+        self.sso_db._db.set("__sid2uid__session id 1", ["Lizz"])
+        self.sso_db._db.set("__sid2uid__session id 2", ["Lizz"])
+
+        assert self.sso_db.get_uid_by_sid("session id 1") == "Lizz"
+        self.sso_db.map_sid2uid("session id 3", "Lizz")
+        self.sso_db.remove_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 2", "session id 3"]
+
+    def test_remove_session_ids(self):
+        for n in range(3):
+            self.sso_db.map_sid2uid("session id {}".format(n), "Lizz")
+            self.sso_db.map_sid2sub("session id {}".format(n), "sub {}".format(n % 2))
+
+        self.sso_db.remove_session_ids(["session id 0", "session id 1", "unknown"])
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 2"]
+        assert self.sso_db.get_sids_by_sub("sub 0") == ["session id 2"]
+        assert self.sso_db.get_sids_by_sub("sub 1") is None
+        assert self.sso_db.get_uid_by_sid("session id 0") is None
+        assert self.sso_db.get_sub_by_sid("session id 1") is None
+
+
+    def test_map_sid2client(self):
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        self.sso_db.map_sid2sub("session id 1", "abcdefgh")
+        self.sso_db.map_sid2client("session id 1", "client", uid="Lizz", sub="abcdefgh")
+        self.sso_db.map_sid2uid("session id 2", "Lizz")
+        self.sso_db.map_sid2client("session id 2", "other", uid="Lizz")
+
+        assert self.sso_db.get_sids_by_uid_and_client_id("Lizz", "client") == ["session id 1"]
+        assert self.sso_db.get_sids_by_sub_and_client_id("abcdefgh", "client") == [
+            "session id 1"
+        ]
+        assert self.sso_db.get_sids_by_uid_and_client_id("Lizz", "unknown") is None
+        assert self.sso_db.get_client_ids_by_sids(["session id 2", "unknown"]) == [
+            "other", None
+        ]
+
+        self.sso_db.remove_session_id("session id 1")
+        assert self.sso_db.get_sids_by_uid_and_client_id("Lizz", "client") is None
+        assert self.sso_db.get_sids_by_sub_and_client_id("abcdefgh", "client") is None
+
+        self.sso_db.remove_uid("Lizz")
+        assert self.sso_db.get_sids_by_uid_and_client_id("Lizz", "other") is None
+
 
 class TestSessionShelveDB(object):
     @pytest.fixture(autouse=True)
@@ -252,3 +312,58 @@ class TestSessionShelveDB(object):
 
         assert set(res) == {"abcdefgh", "012346789"}
         self._reset()
+
+
+def test_concurrent_map_sid2uid():
+    sso_db = SSODb(ConcurrentInMemoryDataBase(shards=4))
+    assert sso_db._map.native
+
+    def _worker(n):
+        for i in range(50):
+            sso_db.map_sid2uid("session {} {}".format(n, i), "Lizz")
+        for i in range(0, 50, 2):
+            sso_db.remove_sid2uid("session {} {}".format(n, i), "Lizz")
+
+    threads = [threading.Thread(target=_worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # No updates lost
+    assert len(sso_db.get_sids_by_uid("Lizz")) == 8 * 25
+    assert sso_db.get_uid_by_sid("session 3 7") == "Lizz"
+
+
+@pytest.mark.parametrize("db", [None, ConcurrentInMemoryDataBase(shards=4)])
+def test_link_ttl(db):
+    sso_db = SSODb(db)
+    sso_db.map_sid2uid("session id 1", "Lizz", ttl=60)
+    sso_db.map_sid2client("session id 1", "client_1", uid="Lizz", ttl=60)
+    assert sso_db.get_sids_by_uid("Lizz") == ["session id 1"]
+    assert sso_db.get_sids_by_uid_and_client_id("Lizz", "client_1") == ["session id 1"]
+
+    # A negative time to live, as if the links had expired
+    sso_db.map_sid2uid("session id 2", "Lizz", ttl=-1)
+    assert sso_db.get_sids_by_uid("Lizz") == ["session id 1"]
+    assert sso_db.get_uid_by_sid("session id 2") is None
+
+    sso_db.touch("session id 1", -1)
+    assert sso_db.get_sids_by_uid("Lizz") is None
+    assert sso_db.get_uid_by_sid("session id 1") is None
+    assert sso_db.get_sids_by_uid_and_client_id("Lizz", "client_1") is None
+
+
+def test_remove_keeps_ttl():
+    _db = InMemoryDataBase()
+    sso_db = SSODb(_db)
+    sso_db.map_sid2uid("s1", "u", ttl=60)
+    sso_db.map_sid2uid("s2", "u", ttl=60)
+
+    sso_db.remove_session_id("s2")
+    assert sso_db.get_sids_by_uid("u") == ["s1"]
+    assert "__uid2sid__u" in _db.expiry.expires
+
+    # No empty sets are left behind
+    sso_db.remove_session_id("s1")
+    assert _db.keys() == {}.keys()
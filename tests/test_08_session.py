@@ -1,4 +1,5 @@
 import os
+import threading
 import time
 
 import pytest
@@ -8,6 +9,7 @@ from oidcendpoint import rndstr
 from oidcendpoint import token_handler
 from oidcendpoint.authn_event import create_authn_event
 from oidcendpoint.endpoint_context import EndpointContext
+from oidcendpoint.in_memory_db import ConcurrentInMemoryDataBase
 from oidcendpoint.in_memory_db import InMemoryDataBase
 from oidcendpoint.oidc.authorization import Authorization
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
@@ -16,6 +18,7 @@ from oidcendpoint.session import setup_session
 from oidcendpoint.sso_db import SSODb
 from oidcendpoint.token_handler import AccessCodeUsed
 from oidcendpoint.token_handler import ExpiredToken
+from oidcendpoint.token_handler import UnknownToken
 from oidcendpoint.token_handler import WrongTokenType
 from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
 from oidcendpoint.user_info import UserInfo
@@ -383,6 +386,305 @@ class TestSessionDB(object):
         assert self.sdb.is_valid("code", grant)
         assert self.sdb.handler.type(grant) == "A"
 
+    def test_cached_session_info(self):
+        ae1 = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+
+        info = self.sdb[sid]
+        assert sid in self.sdb._cache
+        # Changing the returned instance must not affect the cached one
+        info["client_id"] = "other"
+        info["authn_req"]["state"] = "other"
+        info2 = self.sdb[sid]
+        assert info2["client_id"] == "client_id"
+        assert info2["authn_req"]["state"] == "state000"
+
+        self.sdb.update(sid, client_id="client2")
+        assert self.sdb[sid]["client_id"] == "client2"
+
+        del self.sdb[sid]
+        assert sid not in self.sdb._cache
+
+    def test_token_index(self):
+        ae1 = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+        grant = self.sdb[sid]["code"]
+        assert self.sdb.get_sid_by_kv("token", grant) == sid
+
+        tokens = self.sdb.upgrade_to_token(grant, issue_refresh=True)
+        access_token = tokens["access_token"]
+        refresh_token = tokens["refresh_token"]
+        assert self.sdb.get_sid_by_kv("token", grant) is None
+        assert self.sdb.get_sid_by_token(access_token) == sid
+        assert self.sdb[refresh_token]["sid"] == sid
+
+        sinfo = self.sdb.refresh_token(refresh_token)
+        assert self.sdb.get_sid_by_kv("token", access_token) is None
+        assert self.sdb[sinfo["access_token"]]["sid"] == sid
+
+        self.sdb.revoke_session(token=refresh_token)
+        assert self.sdb.get_sid_by_kv("token", refresh_token) is None
+        assert self.sdb.get_sid_by_kv("token", sinfo["access_token"]) is None
+
+    def test_session_ttl(self):
+        assert self.sdb.session_ttl == 86400
+
+        ae1 = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+        self.sdb.do_sub(sid, "user", "client_salt")
+        assert self.sdb._db.expiry.expires[sid] <= time.time() + 86400
+
+        # Pretend the session has expired
+        self.sdb._db.expiry.add(sid, -1)
+        with pytest.raises(KeyError):
+            _ = self.sdb[sid]
+        assert self.sdb.match_session("user", client_id="client_id") is None
+        assert self.sdb.get_active_client_ids_for_uid("user") == []
+
+    def test_patch(self):
+        ae1 = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+
+        _info = self.sdb.patch(sid, remove=["code"], sub="sub")
+        assert "code" not in _info
+        assert _info["sub"] == "sub"
+        assert "code" not in self.sdb[sid]
+        assert self.sdb[sid]["sub"] == "sub"
+
+    def test_self_contained_tokens(self):
+        passwd = rndstr(24)
+        _th_args = {
+            "code": {"lifetime": 600, "password": passwd},
+            "token": {
+                "class": "oidcendpoint.token_handler.SelfContainedToken",
+                "kwargs": {"lifetime": 3600, "password": passwd},
+            },
+            "refresh": {"lifetime": 86400, "password": passwd},
+        }
+        sdb = SessionDB(
+            InMemoryDataBase(), token_handler.factory(None, **_th_args),
+            SSODb(), self.sdb.userinfo
+        )
+        assert sdb.self_contained
+
+        ae1 = create_authn_event("uid", "salt")
+        sid = sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+        sdb.do_sub(sid, "user", "client_salt")
+        _info = sdb.upgrade_to_token(
+            sdb[sid]["code"], issue_refresh=True, scope=["openid"]
+        )
+        access_token = _info["access_token"]
+
+        _tinfo = sdb.token_info(access_token)
+        assert _tinfo["client_id"] == "client_id"
+        assert _tinfo["sub"] == _info["sub"]
+        assert _tinfo["scope"] == ["openid"]
+        # Not a self-contained token
+        assert sdb.token_info(_info["refresh_token"]) is None
+
+        # Validation doesn't need the session
+        sdb._db.delete(sid)
+        assert sdb.is_token_valid(access_token)
+
+        sdb[sid] = _info
+        sdb.revoke_token(sid, "access_token")
+        assert not sdb.is_token_valid(access_token)
+        with pytest.raises(UnknownToken):
+            sdb.token_info(access_token)
+        # The deny list is internal book keeping
+        assert not [k for k in sdb.keys() if k.startswith("__revoked__")]
+
+    def test_concurrent_patch(self):
+        sdb = SessionDB(
+            ConcurrentInMemoryDataBase(), self.sdb.handler,
+            SSODb(ConcurrentInMemoryDataBase())
+        )
+        ae1 = create_authn_event("uid", "salt")
+        sid = sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+
+        def _worker(n):
+            for i in range(20):
+                sdb.patch(sid, **{"attr_{}_{}".format(n, i): i})
+
+        threads = [threading.Thread(target=_worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # No updates lost
+        _info = sdb[sid]
+        assert len([k for k in _info.keys() if k.startswith("attr_")]) == 80
+
+    @pytest.mark.parametrize("shards", [2, 16])
+    def test_concurrent_upgrade_to_token(self, shards):
+        sdb = SessionDB(
+            ConcurrentInMemoryDataBase(shards), self.sdb.handler,
+            SSODb(ConcurrentInMemoryDataBase(shards))
+        )
+        ae1 = create_authn_event("uid", "salt")
+        sids = [
+            sdb.create_authz_session(ae1, AREQ, client_id="client_id") for _ in range(400)
+        ]
+        grants = [sdb[sid]["code"] for sid in sids]
+
+        def _worker(n):
+            for grant in grants[n::4]:
+                sdb.upgrade_to_token(grant, issue_refresh=True)
+
+        threads = [
+            threading.Thread(target=_worker, args=(n,), daemon=True) for n in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+        # No deadlock
+        assert not [thread for thread in threads if thread.is_alive()]
+
+        for sid in sids:
+            _info = sdb[sid]
+            assert sdb.get_sid_by_token(_info["access_token"]) == sid
+            assert sdb.get_sid_by_token(_info["refresh_token"]) == sid
+
+    def test_transaction(self):
+        ae1 = create_authn_event("uid", "salt")
+        _writes = []
+        _set = self.sdb._db.set
+
+        def _count_set(key, value, **kwargs):
+            _writes.append(key)
+            _set(key, value, **kwargs)
+
+        self.sdb._db.set = _count_set
+
+        with self.sdb.transaction():
+            sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+            self.sdb.do_sub(sid, "user", "client_salt")
+            self.sdb.update(sid, permission="all")
+            # Updates are visible within the transaction
+            assert self.sdb[sid]["permission"] == "all"
+            assert sid in self.sdb.keys()
+            assert self.sdb._db.get(sid) is None
+
+        assert _writes.count(sid) == 1
+        _info = self.sdb[sid]
+        assert _info["permission"] == "all"
+        assert "sub" in _info
+
+    def test_transaction_rollback(self):
+        ae1 = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+
+        with pytest.raises(ValueError):
+            with self.sdb.transaction():
+                self.sdb.update(sid, permission="all")
+                raise ValueError()
+
+        assert "permission" not in self.sdb[sid]
+
+    def test_transaction_rollback_index(self):
+        ae1 = create_authn_event("uid", "salt")
+
+        with pytest.raises(ValueError):
+            with self.sdb.transaction():
+                sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+                sub = self.sdb.do_sub(sid, "uid", "client_salt")
+                _code = self.sdb[sid]["code"]
+                # The index is visible within the transaction
+                assert self.sdb.get_sid_by_kv("token", _code) == sid
+                raise ValueError()
+
+        assert self.sdb.get_sid_by_kv("token", _code) is None
+        assert self.sdb.get_sid_by_kv("state", AREQ["state"]) is None
+        # And so are the SSO links
+        assert self.sdb.sso_db.get_uid_by_sid(sid) is None
+        assert self.sdb.sso_db.get_sids_by_uid("uid") is None
+        assert self.sdb.sso_db.get_sids_by_sub(sub) is None
+
+    def test_transaction_rollback_sso_links(self):
+        ae1 = create_authn_event("uid", "salt")
+        _kept = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+        self.sdb.do_sub(_kept, "uid", "client_salt")
+
+        with pytest.raises(ValueError):
+            with self.sdb.transaction():
+                sid = self.sdb.create_authz_session(ae1, AREQ, client_id="client_id")
+                sub = self.sdb.do_sub(sid, "uid", "client_salt")
+                # Stored sessions keep their links
+                self.sdb.do_sub(_kept, "uid", "client_salt")
+                assert set(self.sdb.sso_db.get_sids_by_uid("uid")) == {_kept, sid}
+                raise ValueError()
+
+        assert self.sdb.sso_db.get_sids_by_uid("uid") == [_kept]
+        assert self.sdb.sso_db.get_sids_by_sub(sub) == [_kept]
+        assert self.sdb.sso_db.get_uid_by_sid(sid) is None
+        assert self.sdb.sso_db.get_sids_by_uid_and_client_id("uid", "client_id") == [_kept]
+
+    def _user_sessions(self, n):
+        sids = []
+        for i in range(n):
+            areq = AREQ.copy()
+            areq["state"] = "state{}".format(i)
+            ae = create_authn_event("user", "salt")
+            sid = self.sdb.create_authz_session(ae, areq, client_id="client{}".format(i))
+            self.sdb.do_sub(sid, "user", "client_salt")
+            sids.append(sid)
+        return sids
+
+    def test_get_many(self):
+        sids = self._user_sessions(2)
+        res = self.sdb.get_many([sids[0], "unknown", sids[1]])
+        assert res[0]["client_id"] == "client0"
+        assert res[1] is None
+        assert res[2]["client_id"] == "client1"
+
+    def test_iter_sessions_batched(self):
+        sids = self._user_sessions(5)
+        _fetches = []
+        _get_many = self.sdb._get_many
+
+        def _count_get_many(keys):
+            _fetches.append(len(keys))
+            return _get_many(keys)
+
+        self.sdb._get_many = _count_get_many
+        res = list(self.sdb.iter_sessions(iter(sids + ["unknown"]), batch_size=2))
+        assert [sid for sid, _ in res] == sids
+        assert all(_si["sid"] == sid for sid, _si in res)
+        assert _fetches == [2, 2, 2]
+
+    def test_delete_sessions(self):
+        sids = self._user_sessions(3)
+        grant = self.sdb[sids[0]]["code"]
+
+        self.sdb.delete_sessions(sids[:2] + ["unknown"])
+        assert self.sdb.get_many(sids)[:2] == [None, None]
+        assert self.sdb[sids[2]]["client_id"] == "client2"
+        assert self.sdb.get_sid_by_kv("token", grant) is None
+        assert self.sdb.get_sid_by_kv("state", "state0") is None
+        assert self.sdb.get_sid_by_kv("state", "state2") == sids[2]
+        assert self.sdb.sso_db.get_sids_by_uid("user") == [sids[2]]
+        assert self.sdb.get_active_client_ids_for_uid("user") == ["client2"]
+
+    def test_client_session_index(self):
+        sids = self._user_sessions(3)
+        sub = self.sdb[sids[1]]["sub"]
+
+        def _no_decode(sid, info):
+            raise AssertionError("Session read")
+
+        self.sdb._decode = _no_decode
+        assert self.sdb.match_session("user", client_id="client1") == sids[1]
+        assert self.sdb.get_sid_by_sub_and_client_id(sub, "client2") == sids[2]
+        assert self.sdb.match_session("user", client_id="unknown") is None
+
+    def test_revoke_uid(self):
+        sids = self._user_sessions(3)
+        self.sdb.revoke_uid("user")
+        assert all(self.sdb.is_session_revoked(sid) for sid in sids)
+        assert self.sdb.sso_db.get_sids_by_uid("user") is None
+
 
 KEYDEFS = [
     {"type": "RSA", "key": "", "use": ["sig"]},
@@ -0,0 +1,171 @@
+import pytest
+
+from oidcendpoint import rndstr
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.redis_db import RedisDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.sso_db import SSODb
+from oidcmsg.oidc import AuthorizationRequest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+AREQ = AuthorizationRequest(
+    response_type="code",
+    client_id="client1",
+    redirect_uri="http://example.com/authz",
+    scope=["openid"],
+    state="state000",
+)
+
+
+class TestRedisDataBase(object):
+    @pytest.fixture(autouse=True)
+    def create_db(self):
+        self.server = fakeredis.FakeServer()
+        self.db = RedisDataBase(
+            prefix="test:", client=fakeredis.FakeRedis(server=self.server)
+        )
+
+    def test_set_get(self):
+        self.db.set("foo", ["bar"])
+        assert self.db.get("foo") == ["bar"]
+        assert self.db["foo"] == ["bar"]
+        assert "foo" in self.db
+        assert self.db.get("xyz") is None
+        assert "xyz" not in self.db
+
+    def test_delete(self):
+        self.db["foo"] = "bar"
+        del self.db["foo"]
+        assert self.db.get("foo") is None
+        # Deleting something that isn't there is not an error
+        self.db.delete("foo")
+
+    def test_keys_and_clear(self):
+        _other = RedisDataBase(
+            prefix="other:", client=fakeredis.FakeRedis(server=self.server)
+        )
+        _other.set("foo", "bar")
+        self.db.set("a", 1)
+        self.db.set("b", 2)
+        assert set(self.db.keys()) == {"a", "b"}
+
+        self.db.clear()
+        assert list(self.db.keys()) == []
+        assert _other.get("foo") == "bar"
+
+    def test_many(self):
+        self.db.set_many({"a": 1, "b": [2]})
+        assert self.db.get_many(["a", "b", "c"]) == [1, [2], None]
+        self.db.delete_many(["a", "b"])
+        assert self.db.get_many(["a", "b"]) == [None, None]
+
+    def test_add(self):
+        assert self.db.add("foo", "bar", ttl=60)
+        assert not self.db.add("foo", "xyz")
+        assert self.db.get("foo") == "bar"
+
+    def test_ttl(self):
+        self.db.set("foo", "bar", ttl=60)
+        _ttl = self.db.db.ttl("test:foo")
+        assert 0 < _ttl <= 60
+
+        _db = RedisDataBase(
+            ttl=30, client=fakeredis.FakeRedis(server=self.server)
+        )
+        _db.set("xyz", "abc")
+        assert 0 < _db.db.ttl("xyz") <= 30
+
+
+    def test_set_ttl_extended(self):
+        self.db.add_member("set", "a", ttl=600)
+        self.db.add_member("set", "b", ttl=60)
+        # Not shortened by a member that expires earlier
+        assert 540 < self.db.db.ttl("test:set") <= 600
+
+        self.db.add_member("set", "c", ttl=1200)
+        assert 1140 < self.db.db.ttl("test:set") <= 1200
+
+        # A member that never expires makes the set never expire
+        self.db.add_member("set", "d")
+        self.db.add_member("set", "e", ttl=60)
+        assert self.db.db.ttl("test:set") == -1
+        # Ordered by expiration time
+        assert self.db.members("set") == ["b", "e", "a", "c", "d"]
+
+
+class TestRedisSSODb(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        _db = RedisDataBase(client=fakeredis.FakeRedis())
+        self.sso_db = SSODb(_db)
+
+    def test_map_sid2uid(self):
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 1"]
+        assert self.sso_db.get_uid_by_sid("session id 1") == "Lizz"
+
+    def test_native_sets(self):
+        assert self.sso_db._map.native
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        self.sso_db.map_sid2uid("session id 2", "Lizz")
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 1", "session id 2"]
+
+        self.sso_db.remove_sid2uid("session id 1", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 2"]
+        self.sso_db.remove_sid2uid("session id 2", "Lizz")
+        assert self.sso_db.get_sids_by_uid("Lizz") is None
+
+    def test_get_subs_by_uid(self):
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        self.sso_db.map_sid2sub("session id 1", "abcdefgh")
+        self.sso_db.map_sid2uid("session id 2", "Lizz")
+        self.sso_db.map_sid2sub("session id 2", "012346789")
+
+        assert self.sso_db.get_subs_by_uid("Lizz") == {"abcdefgh", "012346789"}
+
+    def test_remove_session_id(self):
+        self.sso_db.map_sid2uid("session id 1", "Lizz")
+        self.sso_db.map_sid2sub("session id 1", "abcdefgh")
+        self.sso_db.remove_session_id("session id 1")
+        assert self.sso_db.get_uid_by_sid("session id 1") is None
+        assert self.sso_db.get_sids_by_uid("Lizz") is None
+
+    def test_remove_session_ids(self):
+        for n in range(3):
+            self.sso_db.map_sid2uid("session id {}".format(n), "Lizz")
+        self.sso_db.remove_session_ids(["session id 0", "session id 2"])
+        assert self.sso_db.get_sids_by_uid("Lizz") == ["session id 1"]
+        assert self.sso_db.get_uid_by_sid("session id 2") is None
+
+
+def test_shared_session_db():
+    server = fakeredis.FakeServer()
+    passwd = rndstr(24)
+    _th_args = {
+        "code": {"lifetime": 600, "password": passwd},
+        "token": {"lifetime": 3600, "password": passwd},
+    }
+
+    def _worker():
+        _db = RedisDataBase(prefix="sdb:", client=fakeredis.FakeRedis(server=server))
+        _sso_db = SSODb(
+            RedisDataBase(prefix="sso:", client=fakeredis.FakeRedis(server=server))
+        )
+        return SessionDB(_db, token_handler.factory(None, **_th_args), _sso_db)
+
+    worker1 = _worker()
+    worker2 = _worker()
+
+    ae = create_authn_event("uid", "salt")
+    sid = worker1.create_authz_session(ae, AREQ, client_id="client1")
+    worker1.do_sub(sid, "uid", "client_salt")
+
+    code = worker2[sid]["code"]
+    assert worker2[code]["sid"] == sid
+    assert worker2.sso_db.get_uid_by_sid(sid) == "uid"
+
+    worker2.update(sid, permission="all")
+    assert worker1[sid]["permission"] == "all"
@@ -0,0 +1,157 @@
+import threading
+import time
+
+import pytest
+import requests
+import responses
+
+from oidcendpoint.http_cache import CachingHTTPClient
+from oidcendpoint.http_cache import parse_cache_control
+
+URL = "https://rp.example.com/request"
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('max-age=60, no-cache, private="x"') == {
+        "max-age": "60",
+        "no-cache": None,
+        "private": "x",
+    }
+
+
+class TestCachingHTTPClient(object):
+    @pytest.fixture(autouse=True)
+    def create_client(self):
+        self.httpc = CachingHTTPClient(negative_ttl=30)
+
+    def test_max_age(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, body="doc", headers={"Cache-Control": "max-age=60"})
+            assert self.httpc.get(URL).text == "doc"
+            assert self.httpc.get(URL).text == "doc"
+            assert len(rsps.calls) == 1
+
+    def test_no_freshness_info(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, body="doc")
+            self.httpc.get(URL)
+            self.httpc.get(URL)
+            assert len(rsps.calls) == 2
+
+    def test_no_store(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                "GET", URL, body="doc",
+                headers={"Cache-Control": "no-store, max-age=60"}
+            )
+            self.httpc.get(URL)
+            self.httpc.get(URL)
+            assert len(rsps.calls) == 2
+
+    def test_etag_revalidation(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, body="doc", headers={"ETag": '"v1"'})
+            rsps.add("GET", URL, status=304, headers={"Cache-Control": "max-age=60"})
+            assert self.httpc.get(URL).text == "doc"
+            _resp = self.httpc.get(URL)
+            assert _resp.status_code == 200
+            assert _resp.text == "doc"
+            assert rsps.calls[1].request.headers["If-None-Match"] == '"v1"'
+            # Fresh now
+            self.httpc.get(URL)
+            assert len(rsps.calls) == 2
+
+    def test_negative_caching(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, status=404)
+            assert self.httpc.get(URL).status_code == 404
+            assert self.httpc.get(URL).status_code == 404
+            assert len(rsps.calls) == 1
+
+    def test_connection_error(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, body=requests.ConnectionError("down"))
+            with pytest.raises(requests.ConnectionError) as err1:
+                self.httpc.get(URL)
+            with pytest.raises(requests.ConnectionError) as err2:
+                self.httpc.get(URL)
+            assert len(rsps.calls) == 1
+            # Not the same instance raised twice
+            assert err1.value is not err2.value
+
+    def test_response_attributes(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                "GET", URL, json={"foo": "bar"},
+                headers={"Cache-Control": "max-age=60"}
+            )
+            self.httpc.get(URL)
+            _resp = self.httpc.get(URL)
+            assert len(rsps.calls) == 1
+        assert _resp.ok
+        assert _resp.json() == {"foo": "bar"}
+        assert _resp.content == b'{"foo": "bar"}'
+        _resp.raise_for_status()
+
+    def test_cached_per_arguments(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", URL, body="doc", headers={"Cache-Control": "max-age=60"})
+            self.httpc.get(URL, timeout=5)
+            self.httpc.get(URL, timeout=10)
+            assert len(rsps.calls) == 1
+            self.httpc.get(URL, headers={"Authorization": "Bearer token"})
+            self.httpc.get(URL, verify=False)
+            assert len(rsps.calls) == 3
+            self.httpc.get(URL, verify=False)
+            assert len(rsps.calls) == 3
+
+    def test_size_limits(self):
+        self.httpc.max_entries = 2
+        self.httpc.max_body_size = 10
+        with responses.RequestsMock() as rsps:
+            for i in range(3):
+                rsps.add(
+                    "GET", "{}/{}".format(URL, i), body="doc",
+                    headers={"Cache-Control": "max-age=60"}
+                )
+            rsps.add(
+                "GET", "{}/big".format(URL), body="x" * 11,
+                headers={"Cache-Control": "max-age=60"}
+            )
+            for i in range(3):
+                self.httpc.get("{}/{}".format(URL, i))
+            self.httpc.get("{}/big".format(URL))
+
+        assert list(self.httpc._cache.keys()) == ["{}/1".format(URL), "{}/2".format(URL)]
+
+    def test_single_flight(self):
+        _calls = []
+
+        class SlowClient(object):
+            def get(self, url, **kwargs):
+                _calls.append(url)
+                time.sleep(0.2)
+                _resp = requests.models.Response()
+                _resp.status_code = 200
+                _resp._content = b"doc"
+                return _resp
+
+        httpc = CachingHTTPClient(SlowClient())
+        _results = []
+
+        def _fetch():
+            _results.append(httpc.get(URL))
+
+        threads = [threading.Thread(target=_fetch) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(_calls) == 1
+        assert len(_results) == 4
+
+    def test_pass_through(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add("POST", URL, body="OK")
+            assert self.httpc.post(URL, data="x").text == "OK"
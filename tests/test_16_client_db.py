@@ -0,0 +1,95 @@
+import pytest
+
+from oidcendpoint.client_db import ClientDatabase
+from oidcendpoint.shelve_db import ShelveDataBase
+
+
+class CountingDataBase(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, key, default=None):
+        self.reads += 1
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        dict.__setitem__(self, key, value)
+
+
+class TestClientDatabase(object):
+    @pytest.fixture(autouse=True)
+    def create_db(self):
+        self.backend = CountingDataBase()
+        self.cdb = ClientDatabase(self.backend, cache_size=2, cache_ttl=60)
+
+    def test_set_get(self):
+        self.cdb["client_1"] = {"client_secret": "hemligt"}
+        assert self.cdb["client_1"] == {"client_secret": "hemligt"}
+        assert "client_1" in self.cdb
+        assert "client_2" not in self.cdb
+        assert self.cdb.get("client_2") is None
+        with pytest.raises(KeyError):
+            self.cdb["client_2"]
+
+    def test_read_through(self):
+        self.backend["client_1"] = {"client_secret": "hemligt"}
+        for _ in range(3):
+            assert self.cdb["client_1"]["client_secret"] == "hemligt"
+        assert self.backend.reads == 1
+
+    def test_cache_ttl(self):
+        self.cdb.cache_ttl = 0
+        self.cdb["client_1"] = {}
+        self.cdb["client_1"]
+        self.cdb["client_1"]
+        assert self.backend.reads == 2
+
+    def test_cache_size(self):
+        for i in range(3):
+            self.cdb["client_{}".format(i)] = {}
+        assert list(self.cdb._cache.keys()) == ["client_1", "client_2"]
+
+    def test_write_through(self):
+        self.cdb["client_1"] = {"client_secret": "hemligt"}
+        self.cdb["client_1"]["client_name"] = "Foo"
+        assert self.backend["client_1"] == {"client_secret": "hemligt", "client_name": "Foo"}
+        assert type(self.backend["client_1"]) is dict
+
+        _cinfo = self.cdb["client_1"]
+        del _cinfo["client_secret"]
+        _cinfo.update({"contacts": ["ops@example.com"]})
+        assert _cinfo.pop("unknown", None) is None
+        assert self.backend["client_1"] == {
+            "client_name": "Foo",
+            "contacts": ["ops@example.com"]
+        }
+        assert self.cdb["client_1"] == self.backend["client_1"]
+
+    def test_registration_access_token(self):
+        self.cdb["client_1"] = {"registration_access_token": "1234567890"}
+        self.cdb.registration_access_token["1234567890"] = "client_1"
+
+        assert self.cdb.registration_access_token["1234567890"] == "client_1"
+        assert "1234567890" in self.cdb.registration_access_token
+        assert self.cdb.keys() == ["client_1"]
+
+        del self.cdb["client_1"]
+        assert "1234567890" not in self.cdb.registration_access_token
+        assert self.cdb.keys() == []
+
+
+def test_shelve_backend(tmpdir):
+    filename = str(tmpdir.join("client_db"))
+    worker1 = ClientDatabase(ShelveDataBase(filename), cache_ttl=0)
+    worker1["client_1"] = {"client_secret": "hemligt"}
+    worker1.registration_access_token["1234567890"] = "client_1"
+    worker1.close()
+
+    worker2 = ClientDatabase(ShelveDataBase(filename))
+    assert worker2["client_1"] == {"client_secret": "hemligt"}
+    assert worker2.registration_access_token["1234567890"] == "client_1"
+    worker2.clear()
+    worker2.close()
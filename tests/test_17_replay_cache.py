@@ -0,0 +1,74 @@
+import time
+
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.replay_cache import ReplayCache
+
+
+def test_seen():
+    _cache = ReplayCache()
+    _exp = time.time() + 300
+    assert _cache.seen("client:1", _exp) is False
+    assert _cache.seen("client:1", _exp) is True
+    assert _cache.seen("client:2", _exp) is False
+
+
+def test_no_exp():
+    _cache = ReplayCache()
+    assert _cache.seen("client:1") is False
+    assert _cache.seen("client:1") is True
+
+
+def test_expired_buckets_dropped():
+    _cache = ReplayCache(skew=0, bucket_size=1)
+    _exp = time.time() + 600
+    _cache.seen("client:1", time.time() + 0.5)
+    _cache.seen("client:2", _exp)
+    assert len(_cache) == 2
+
+    time.sleep(1.1)
+    _cache.seen("client:3", _exp)
+    assert len(_cache) == 2
+    assert _cache.seen("client:2", _exp) is True
+
+
+def test_expired_not_remembered():
+    _cache = ReplayCache(skew=0)
+    assert _cache.seen("client:1", time.time() - 10) is False
+    assert len(_cache) == 0
+
+
+def test_shared_backend():
+    _db = InMemoryDataBase()
+    worker1 = ReplayCache(_db)
+    worker2 = ReplayCache(_db)
+    _exp = time.time() + 300
+
+    assert worker1.seen("client:1", _exp) is False
+    assert worker2.seen("client:1", _exp) is True
+    assert worker2.seen("client:2", _exp) is False
+    assert worker1.seen("client:2", _exp) is True
+
+
+def test_lifetime_clamped():
+    _cache = ReplayCache(skew=0, bucket_size=1, max_lifetime=1)
+    _exp = time.time() + 3600
+    assert _cache.too_long_lived(_exp)
+    assert not _cache.too_long_lived(time.time() + 0.5)
+    _cache.seen("client:1", _exp)
+    assert len(_cache) == 1
+
+    time.sleep(2.1)
+    _cache.seen("client:2", time.time() + 0.5)
+    assert len(_cache) == 1
+
+
+def test_max_entries():
+    _cache = ReplayCache(max_entries=2, bucket_size=1)
+    _now = time.time()
+    _cache.seen("client:1", _now + 100)
+    _cache.seen("client:2", _now + 200)
+    _cache.seen("client:3", _now + 300)
+    assert len(_cache) == 2
+    # The one expiring first was dropped
+    assert _cache.seen("client:1", _now + 100) is False
+    assert _cache.seen("client:3", _now + 300) is True
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+from oidcendpoint.aio import AsyncDataBase
+from oidcendpoint.aio import AsyncHTTPClient
+from oidcendpoint.in_memory_db import ConcurrentInMemoryDataBase
+from oidcendpoint.in_memory_db import InMemoryDataBase
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_async_database():
+    _db = AsyncDataBase(InMemoryDataBase())
+
+    async def _use():
+        await _db.set("foo", "bar")
+        await _db.set("xyz", 1, ttl=60)
+        assert await _db.get("foo") == "bar"
+        assert await _db.get_many(["foo", "unknown", "xyz"]) == ["bar", None, 1]
+        await _db.delete("foo")
+        return await _db.keys()
+
+    try:
+        assert list(run(_use())) == ["xyz"]
+        # Not thread safe, so used from one thread at a time
+        assert _db.executor._max_workers == 1
+    finally:
+        _db.shutdown()
+
+
+def test_async_database_thread_safe():
+    _db = AsyncDataBase(ConcurrentInMemoryDataBase(), max_workers=4)
+    try:
+        assert _db.executor._max_workers == 4
+    finally:
+        _db.shutdown()
+
+
+class BlockingClient(object):
+    def __init__(self):
+        self.threads = set()
+
+    def get(self, url, **kwargs):
+        self.threads.add(threading.get_ident())
+        return url, kwargs
+
+
+def test_async_http_client():
+    _httpc = BlockingClient()
+    _client = AsyncHTTPClient(_httpc, max_workers=2)
+
+    async def _fetch():
+        return await asyncio.gather(
+            *[_client.get("https://rp.example.com/{}".format(n), timeout=5) for n in range(4)]
+        )
+
+    try:
+        res = run(_fetch())
+    finally:
+        _client.shutdown()
+
+    assert res[3] == ("https://rp.example.com/3", {"timeout": 5})
+    # Not run in the event loop's thread
+    assert threading.get_ident() not in _httpc.threads
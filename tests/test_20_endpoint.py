@@ -1,3 +1,4 @@
+import asyncio
 import json
 from urllib.parse import urlparse
 
@@ -160,3 +161,26 @@ class TestEndpoint(object):
         assert parse_res.path == "/cb_i"
         umsg = Message().from_urlencoded(parse_res.fragment)
         assert set(umsg.keys()) == set(EXAMPLE_MSG.keys())
+
+    def test_async_pipeline(self):
+        self.endpoint.request_format = "urlencoded"
+        self.endpoint.response_placement = "body"
+        self.endpoint.response_format = "json"
+
+        async def _pipeline():
+            req = await self.endpoint.async_parse_request(REQ.to_urlencoded())
+            assert await self.endpoint.async_process_request(req) == {}
+            return req, await self.endpoint.async_do_response(EXAMPLE_MSG, req)
+
+        loop = asyncio.new_event_loop()
+        try:
+            req, msg = loop.run_until_complete(_pipeline())
+        finally:
+            loop.close()
+
+        assert req == REQ
+        assert set(json.loads(msg["response"]).keys()) == set(EXAMPLE_MSG.keys())
+        # The default databases aren't thread safe
+        assert not self.endpoint_context.thread_safe
+        assert self.endpoint_context.executor._max_workers == 1
+        self.endpoint_context.shutdown()
@@ -1,6 +1,7 @@
 import json
 
 import pytest
+from cryptojwt.key_jar import build_keyjar
 
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
@@ -85,3 +86,39 @@ class TestEndpoint(object):
             'birthdate'
         }
         assert ("Content-type", "application/json") in msg["http_headers"]
+
+    def test_etag(self):
+        args = self.endpoint.process_request()
+        msg = self.endpoint.do_response(**args)
+        _etag = dict(msg["http_headers"])["ETag"]
+        assert "response_code" not in msg
+
+        # encoded once
+        msg2 = self.endpoint.do_response(**args)
+        assert msg2["response"] is msg["response"]
+
+        args = self.endpoint.process_request(if_none_match=_etag)
+        msg = self.endpoint.do_response(**args)
+        assert msg["response_code"] == 304
+        assert msg["response"] == ""
+        assert ("ETag", _etag) in msg["http_headers"]
+
+        self.endpoint_context.provider_info["foo"] = "bar"
+        self.endpoint.invalidate()
+        msg = self.endpoint.do_response(**args)
+        assert "response_code" not in msg
+        assert json.loads(msg["response"])["foo"] == "bar"
+        assert dict(msg["http_headers"])["ETag"] != _etag
+
+    def test_jwks_response(self):
+        msg = self.endpoint_context.jwks_response()
+        _etag = dict(msg["http_headers"])["ETag"]
+        assert len(json.loads(msg["response"])["keys"]) == 2
+
+        msg = self.endpoint_context.jwks_response(if_none_match=_etag)
+        assert msg["response_code"] == 304
+
+        # new keys, new document
+        self.endpoint_context.keyjar = build_keyjar(KEYDEFS)
+        msg = self.endpoint_context.jwks_response(if_none_match=_etag)
+        assert "response_code" not in msg
@@ -4,6 +4,7 @@ import json
 import pytest
 import responses
 
+from oidcendpoint.client_authn import check_secret
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.id_token import IDToken
 from oidcendpoint.oidc.authorization import Authorization
@@ -134,6 +135,15 @@ class TestEndpoint(object):
         assert isinstance(_reg_resp, RegistrationResponse)
         assert "client_id" in _reg_resp and "client_secret" in _reg_resp
 
+    def test_client_secret_hashed(self):
+        self.endpoint.kwargs["hash_client_secret"] = True
+        _req = self.endpoint.parse_request(CLI_REQ.to_json())
+        _resp = self.endpoint.process_request(request=_req)
+        _reg_resp = _resp["response_args"]
+        _cinfo = self.endpoint.endpoint_context.cdb[_reg_resp["client_id"]]
+        assert "client_secret" not in _cinfo
+        assert check_secret(_reg_resp["client_secret"], _cinfo["client_secret_hash"])
+
     def test_do_response(self):
         _req = self.endpoint.parse_request(CLI_REQ.to_json())
         _resp = self.endpoint.process_request(request=_req)
@@ -16,6 +16,7 @@ from oidcendpoint.common.authorization import create_authn_response
 from oidcendpoint.common.authorization import get_uri
 from oidcendpoint.common.authorization import inputs
 from oidcendpoint.common.authorization import join_query
+from oidcendpoint.common.authorization import uri_matcher
 from oidcendpoint.common.authorization import verify_uri
 from oidcendpoint.cookie import CookieDealer
 from oidcendpoint.endpoint_context import EndpointContext
@@ -338,6 +339,72 @@ class TestEndpoint(object):
         with pytest.raises(ValueError):
             verify_uri(_ec, request, "redirect_uri", "client_id")
 
+    def test_verify_uri_same_base(self):
+        _ec = self.endpoint.endpoint_context
+        _ec.cdb["client_id"] = {
+            "redirect_uris": [
+                ("https://rp.example.com/cb", {"foo": ["bar"]}),
+                ("https://rp.example.com/cb", {"foo": ["kex"]}),
+            ]
+        }
+
+        request = {"redirect_uri": "https://rp.example.com/cb?foo=kex"}
+        verify_uri(_ec, request, "redirect_uri", "client_id")
+
+    def test_uri_matcher_recompiled(self):
+        _ec = self.endpoint.endpoint_context
+        _ec.cdb["client_id"] = {"redirect_uris": [("https://rp.example.com/cb", {})]}
+
+        request = {"redirect_uri": "https://rp.example.com/cb"}
+        verify_uri(_ec, request, "redirect_uri", "client_id")
+        _matcher = uri_matcher(_ec, "client_id", "redirect_uri")
+        verify_uri(_ec, request, "redirect_uri", "client_id")
+        assert uri_matcher(_ec, "client_id", "redirect_uri") is _matcher
+
+        # Registration changed
+        _ec.cdb["client_id"] = {
+            "redirect_uris": [("https://rp.example.com/other", {})]
+        }
+        with pytest.raises(RedirectURIError):
+            verify_uri(_ec, request, "redirect_uri", "client_id")
+        assert uri_matcher(_ec, "client_id", "redirect_uri") is not _matcher
+
+    def test_uri_matcher_client_written(self):
+        _ec = self.endpoint.endpoint_context
+        _ec.cdb["client_id"] = {"redirect_uris": [("https://rp.example.com/cb", {})]}
+        request = {"redirect_uri": "https://rp.example.com/cb"}
+        verify_uri(_ec, request, "redirect_uri", "client_id")
+        _matcher = _ec.uri_matchers.get(
+            ("client_id", "redirect_uri"), _ec.cdb.get_item("client_id")
+        )
+        assert _matcher is not None
+
+        # Not written, the same matcher is used
+        verify_uri(_ec, request, "redirect_uri", "client_id")
+        assert uri_matcher(_ec, "client_id", "redirect_uri") is _matcher
+
+        _cinfo = _ec.cdb["client_id"]
+        _cinfo["redirect_uris"] = [("https://rp.example.com/other", {})]
+        verify_uri(
+            _ec, {"redirect_uri": "https://rp.example.com/other"}, "redirect_uri",
+            "client_id"
+        )
+        with pytest.raises(RedirectURIError):
+            verify_uri(_ec, request, "redirect_uri", "client_id")
+
+        del _ec.cdb["client_id"]
+        with pytest.raises(KeyError):
+            uri_matcher(_ec, "client_id", "redirect_uri")
+        assert len(_ec.uri_matchers) == 0
+
+    def test_uri_matchers_bounded(self):
+        _ec = self.endpoint.endpoint_context
+        _ec.uri_matchers.max_size = 2
+        for _cid in ["client_1", "client_2", "client_3"]:
+            _ec.cdb[_cid] = {"redirect_uris": [("https://rp.example.com/cb", {})]}
+            verify_uri(_ec, {"redirect_uri": "https://rp.example.com/cb"}, "redirect_uri", _cid)
+        assert len(_ec.uri_matchers) == 2
+
     def test_get_uri(self):
         _ec = self.endpoint.endpoint_context
         _ec.cdb["client_id"] = {"redirect_uris": [("https://rp.example.com/cb", {})]}
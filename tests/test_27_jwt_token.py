@@ -11,12 +11,14 @@ from oidcendpoint import user_info
 from oidcendpoint.client_authn import verify_client
 from oidcendpoint.endpoint_context import EndpointContext
 from oidcendpoint.id_token import IDToken
+from oidcendpoint.jwt_token import JWTToken
 from oidcendpoint.oidc.authorization import Authorization
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
 from oidcendpoint.oidc.registration import Registration
 from oidcendpoint.oidc.session import Session
 from oidcendpoint.oidc.token import AccessToken
 from oidcendpoint.session import setup_session
+from oidcendpoint.token_handler import UnknownToken
 from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
 
 KEYDEFS = [
@@ -223,3 +225,23 @@ class TestEndpoint(object):
                 handler.is_expired(_dic["access_token"], utc_time_sans_frac() + 4000)
                 is True
         )
+
+    def test_key_rotation(self):
+        keyjar = init_key_jar(key_defs=KEYDEFS, owner=ISSUER)
+        handler = JWTToken(
+            "T", keyjar=keyjar, issuer=ISSUER, ec=self.endpoint.endpoint_context
+        )
+        token = handler("sid", {}, {"sub": "sub"}, aud=None, client_id="client_1")
+        assert handler.info(token)["sid"] == "sid"
+        # Verified once
+        assert token in handler._payloads
+        assert handler.is_expired(token) is False
+
+        # Replace my keys
+        _new = init_key_jar(key_defs=KEYDEFS, owner=ISSUER)
+        keyjar[ISSUER] = _new[ISSUER]
+        with pytest.raises(UnknownToken):
+            handler.info(token)
+
+        token = handler("sid", {}, {"sub": "sub"}, aud=None, client_id="client_1")
+        assert handler.info(token)["sid"] == "sid"
@@ -1,6 +1,7 @@
 import copy
 import json
 import os
+import time
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
@@ -16,6 +17,7 @@ from oidcendpoint.oidc import userinfo
 from oidcendpoint.oidc.authorization import Authorization
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
 from oidcendpoint.oidc.registration import Registration
+from oidcendpoint.oidc.session import BackChannelLogoutDispatcher
 from oidcendpoint.oidc.session import Session
 from oidcendpoint.oidc.session import do_front_channel_logout_iframe
 from oidcendpoint.oidc.token import AccessToken
@@ -531,6 +533,120 @@ class TestEndpoint(object):
             res = self.session_endpoint.do_verified_logout(_sid, "client_1")
             assert res == []
 
+    def test_do_verified_logout_retry(self):
+        _dispatcher = self.session_endpoint.logout_dispatcher
+        with responses.RequestsMock() as rsps:
+            rsps.add("POST", "https://example.com/bc_logout",
+                     body="Busy", status=503)
+
+            self._code_auth("1234567")
+            _cdb = self.session_endpoint.endpoint_context.cdb
+            _cdb["client_1"]["backchannel_logout_uri"] = "https://example.com/bc_logout"
+            _cdb["client_1"]["client_id"] = "client_1"
+
+            _sid = self._get_sid()
+
+            res = self.session_endpoint.do_verified_logout(_sid, "client_1")
+            assert res == []
+
+        assert _dispatcher.metrics["client_1"]["failed"] == 1
+        assert _dispatcher.metrics["client_1"]["queued"] == 1
+        # Not due yet
+        assert _dispatcher.retry() == 0
+
+        with responses.RequestsMock() as rsps:
+            rsps.add("POST", "https://example.com/bc_logout",
+                     body="OK", status=200)
+            assert _dispatcher.retry(when=time.time() + 3600) == 1
+
+        assert _dispatcher.metrics["client_1"]["delivered"] == 1
+        assert _dispatcher.queued() == []
+
+    def test_logout_dispatcher_parallel(self):
+        _dispatcher = self.session_endpoint.logout_dispatcher
+        _dispatcher.max_attempts = 1
+        with responses.RequestsMock() as rsps:
+            for _cid in ["client_1", "client_2", "client_3"]:
+                rsps.add("POST", "https://example.com/{}".format(_cid),
+                         body="OK", status=200)
+            rsps.add("POST", "https://example.com/client_4",
+                     body=ConnectionError("down"))
+
+            _dispatcher.deliver(
+                {
+                    _cid: ("https://example.com/{}".format(_cid), "token")
+                    for _cid in ["client_1", "client_2", "client_3", "client_4"]
+                }
+            )
+
+        for _cid in ["client_1", "client_2", "client_3"]:
+            assert _dispatcher.metrics[_cid]["delivered"] == 1
+        assert _dispatcher.metrics["client_4"]["failed"] == 1
+        # Only one attempt allowed
+        assert _dispatcher.metrics["client_4"]["dropped"] == 1
+        assert _dispatcher.queued() == []
+
+    def test_logout_retry_claimed_once(self):
+        _dispatcher = self.session_endpoint.logout_dispatcher
+        _dispatcher.enqueue("client_1", "https://example.com/bc_logout", "token")
+        assert len(_dispatcher.queued()) == 1
+
+        # Another worker sharing the retry queue
+        _other = BackChannelLogoutDispatcher(self.session_endpoint.endpoint_context)
+        with responses.RequestsMock() as rsps:
+            rsps.add("POST", "https://example.com/bc_logout",
+                     body="OK", status=200)
+            assert _other.retry(when=time.time() + 3600) == 1
+            assert _dispatcher.retry(when=time.time() + 3600) == 0
+
+            assert _other.metrics["client_1"]["delivered"] == 1
+            assert _dispatcher.queued() == []
+            # Queued deliveries are not sessions
+            assert self.session_endpoint.endpoint_context.sdb.keys() == []
+
+            _dispatcher.deliver(
+                {"client_1": ("https://example.com/bc_logout", "token"),
+                 "client_2": ("https://example.com/bc_logout", "token")}
+            )
+
+        self.session_endpoint.close()
+        assert _dispatcher._executor is None
+
+    def test_logout_retry_in_background(self):
+        _dispatcher = self.session_endpoint.logout_dispatcher
+        # Off by default, logouts don't wait for other RPs' retries
+        assert _dispatcher.retry_batch == 0
+
+        _dispatcher.backoff = 0
+        _dispatcher.enqueue("client_1", "https://example.com/bc_logout", "token")
+        with responses.RequestsMock() as rsps:
+            rsps.add("POST", "https://example.com/bc_logout",
+                     body="OK", status=200)
+            assert _dispatcher.retry_in_background(limit=10).result(timeout=10) == 1
+
+        assert _dispatcher.metrics["client_1"]["delivered"] == 1
+        assert _dispatcher.queued() == []
+        self.session_endpoint.close()
+
+    def test_back_channel_logouts(self):
+        self._code_auth("1234567")
+
+        _specs = []
+        for _cid in ["client_1", "client_2", "client_3"]:
+            _cinfo = copy.copy(self.session_endpoint.endpoint_context.cdb["client_1"])
+            _cinfo["backchannel_logout_uri"] = "https://example.com/{}".format(_cid)
+            _cinfo["client_id"] = _cid
+            _specs.append((_cinfo, "username", "sid_{}".format(_cid)))
+        self.session_endpoint.signing_workers = 2
+
+        res = self.session_endpoint.do_back_channel_logouts(_specs)
+        assert set(res.keys()) == {"client_1", "client_2", "client_3"}
+        for _cid, (_uri, _sjwt) in res.items():
+            assert _uri == "https://example.com/{}".format(_cid)
+            _jwt = self.session_endpoint.unpack_signed_jwt(_sjwt, "RS256")
+            assert _jwt["sid"] == "sid_{}".format(_cid)
+            assert _jwt["aud"] == [_cid]
+
     def test_logout_from_client_unknow_sid(self):
         self._code_auth("1234567")
         self._code_auth2("abcdefg")
@@ -89,81 +89,86 @@ def full_path(local_file):
     return os.path.join(BASEDIR, local_file)
 
 
-@pytest.mark.parametrize("jwt_token", [True, False])
-class TestEndpoint:
-    @pytest.fixture(autouse=True)
-    def create_endpoint(self, jwt_token):
-        conf = {
-            "issuer": "https://example.com/",
-            "password": "mycket hemligt",
-            "token_expires_in": 600,
-            "grant_expires_in": 300,
-            "refresh_token_expires_in": 86400,
-            "verify_ssl": False,
-            "capabilities": CAPABILITIES,
-            "jwks": {"uri_path": "jwks.json", "key_defs": KEYDEFS},
-            "token_handler_args": {
-                "jwks_def": {
-                    # These keys are used for encrypting the access code, the
-                    # refresh token and the access token(when it's not a JWT),
-                    # I don't think these should be configurable.
-                    # Should these keys be stored somewhere?
-                    "read_only": False,
-                    "key_defs": [
-                        {"type": "oct", "bytes": 24, "use": ["enc"],
-                         "kid": "code"},
-                        {"type": "oct", "bytes": 24, "use": ["enc"],
-                         "kid": "refresh"},
-                        {"type": "oct", "bytes": 24, "use": ["enc"],
-                         "kid": "token"},
-                    ],
-                },
-                "code": {"lifetime": 600},
-                "token": {"lifetime": 3600},
-                "refresh": {"lifetime": 86400},
+def endpoint_conf():
+    conf = {
+        "issuer": "https://example.com/",
+        "password": "mycket hemligt",
+        "token_expires_in": 600,
+        "grant_expires_in": 300,
+        "refresh_token_expires_in": 86400,
+        "verify_ssl": False,
+        "capabilities": CAPABILITIES,
+        "jwks": {"uri_path": "jwks.json", "key_defs": KEYDEFS},
+        "token_handler_args": {
+            "jwks_def": {
+                # These keys are used for encrypting the access code, the
+                # refresh token and the access token(when it's not a JWT),
+                # I don't think these should be configurable.
+                # Should these keys be stored somewhere?
+                "read_only": False,
+                "key_defs": [
+                    {"type": "oct", "bytes": 24, "use": ["enc"],
+                     "kid": "code"},
+                    {"type": "oct", "bytes": 24, "use": ["enc"],
+                     "kid": "refresh"},
+                    {"type": "oct", "bytes": 24, "use": ["enc"],
+                     "kid": "token"},
+                ],
             },
-            "endpoint": {
-                "authorization": {
-                    "path": "{}/authorization",
-                    "class": Authorization,
-                    "kwargs": {},
-                },
-                "introspection": {
-                    "path": "{}/intro",
-                    "class": Introspection,
-                    "kwargs": {
-                        "release": ["username"],
-                        "client_authn_method": ["client_secret_post"],
-                    },
-                },
-                "token": {
-                    "path": "token",
-                    "class": TokenCoop,
-                    "kwargs": {
-                        "client_authn_method": [
-                            "client_secret_basic",
-                            "client_secret_post",
-                            "client_secret_jwt",
-                            "private_key_jwt",
-                        ]
-                    },
-                },
+            "code": {"lifetime": 600},
+            "token": {"lifetime": 3600},
+            "refresh": {"lifetime": 86400},
+        },
+        "endpoint": {
+            "authorization": {
+                "path": "{}/authorization",
+                "class": Authorization,
+                "kwargs": {},
             },
-            "authentication": {
-                "anon": {
-                    "acr": INTERNETPROTOCOLPASSWORD,
-                    "class": "oidcendpoint.user_authn.user.NoAuthn",
-                    "kwargs": {"user": "diana"},
-                }
+            "introspection": {
+                "path": "{}/intro",
+                "class": Introspection,
+                "kwargs": {
+                    "release": ["username"],
+                    "client_authn_method": ["client_secret_post"],
+                },
             },
-            "userinfo": {
-                "path": "{}/userinfo",
-                "class": UserInfo,
-                "kwargs": {"db_file": full_path("users.json")},
+            "token": {
+                "path": "token",
+                "class": TokenCoop,
+                "kwargs": {
+                    "client_authn_method": [
+                        "client_secret_basic",
+                        "client_secret_post",
+                        "client_secret_jwt",
+                        "private_key_jwt",
+                    ]
+                },
             },
-            "client_authn": verify_client,
-            "template_dir": "template",
-        }
+        },
+        "authentication": {
+            "anon": {
+                "acr": INTERNETPROTOCOLPASSWORD,
+                "class": "oidcendpoint.user_authn.user.NoAuthn",
+                "kwargs": {"user": "diana"},
+            }
+        },
+        "userinfo": {
+            "path": "{}/userinfo",
+            "class": UserInfo,
+            "kwargs": {"db_file": full_path("users.json")},
+        },
+        "client_authn": verify_client,
+        "template_dir": "template",
+    }
+    return conf
+
+
+@pytest.mark.parametrize("jwt_token", [True, False])
+class TestEndpoint:
+    @pytest.fixture(autouse=True)
+    def create_endpoint(self, jwt_token):
+        conf = endpoint_conf()
         if jwt_token:
             conf["token_handler_args"]["token"] = {
                 "class": "oidcendpoint.jwt_token.JWTToken",
@@ -366,3 +371,56 @@ class TestEndpoint:
         )
         _resp = self.introspection_endpoint.process_request(_req)
         assert _resp["response_args"]["active"] is False
+
+
+class TestSelfContainedToken:
+    @pytest.fixture(autouse=True)
+    def create_endpoint(self):
+        conf = endpoint_conf()
+        conf["token_handler_args"]["token"] = {
+            "class": "oidcendpoint.token_handler.SelfContainedToken",
+            "kwargs": {"lifetime": 3600},
+        }
+        endpoint_context = EndpointContext(conf)
+        endpoint_context.cdb["client_1"] = {
+            "client_secret": "hemligt",
+            "redirect_uris": [("https://example.com/cb", None)],
+            "client_salt": "salted",
+            "token_endpoint_auth_method": "client_secret_post",
+            "response_types": ["code", "token", "code id_token", "id_token"],
+        }
+        self.introspection_endpoint = endpoint_context.endpoint["introspection"]
+        self.token_endpoint = endpoint_context.endpoint["token"]
+
+    def _introspect(self, token):
+        _context = self.introspection_endpoint.endpoint_context
+        _req = self.introspection_endpoint.parse_request(
+            {
+                "token": token,
+                "client_id": "client_1",
+                "client_secret": _context.cdb["client_1"]["client_secret"],
+            }
+        )
+        return self.introspection_endpoint.process_request(_req)["response_args"]
+
+    def test_access_token(self):
+        _token = TestEndpoint._create_at(self, "diana")
+        _sdb = self.introspection_endpoint.endpoint_context.sdb
+        _sid = _sdb.get_sid_by_token(_token)
+
+        # The answer comes from the token alone
+        _sdb._db.delete(_sid)
+        _resp_args = self._introspect(_token)
+        assert _resp_args["active"]
+        assert _resp_args["client_id"] == "client_1"
+        assert _resp_args["scope"] == "openid"
+        assert "sub" in _resp_args
+        assert "exp" in _resp_args
+
+    def test_revoked_access_token(self):
+        _token = TestEndpoint._create_at(self, "diana")
+        _sdb = self.introspection_endpoint.endpoint_context.sdb
+        _sdb.revoke_session(token=_token)
+
+        assert self._introspect(_token)["active"] is False
+        assert _sdb.is_token_valid(_token) is False
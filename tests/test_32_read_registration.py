@@ -134,3 +134,21 @@ class TestEndpoint(object):
         _endp_response = self.registration_api_endpoint.do_response(_info)
         assert set(_endp_response.keys()) == {"response", "http_headers"}
         assert ("Content-type", "application/json") in _endp_response["http_headers"]
+
+    def test_read_hashed_client_secret(self):
+        self.registration_endpoint.kwargs["hash_client_secret"] = True
+        _req = self.registration_endpoint.parse_request(CLI_REQ.to_json())
+        _resp = self.registration_endpoint.process_request(request=_req)
+        assert "client_secret" in _resp["response_args"]
+
+        _api_req = self.registration_api_endpoint.parse_request(
+            "client_id={}".format(_resp["response_args"]["client_id"]),
+            auth="Bearer {}".format(
+                _resp["response_args"]["registration_access_token"]
+            ),
+        )
+        _info = self.registration_api_endpoint.process_request(request=_api_req)
+        # Only a hash of the client secret is kept
+        _args = _resp["response_args"].to_dict()
+        del _args["client_secret"]
+        assert _info["response_args"].to_dict() == _args
@@ -1,4 +1,5 @@
 import io
+import time
 
 import pytest
 import yaml
@@ -252,6 +253,12 @@ class TestEndpoint(object):
         _msg = Message().from_urlencoded(AUTHN_REQUEST)
         assert _resp["return_uri"] == _msg["redirect_uri"]
 
+        # The pushed request is only kept for as long as the request_uri is valid
+        _par_db = self.pushed_authorization_endpoint.endpoint_context.par_db
+        _request_uri = _resp["http_response"]["request_uri"]
+        _shard = _par_db.shards[_par_db._index(_request_uri)]
+        assert _shard.expiry.expires[_request_uri] <= time.time() + 3600
+
         # And now for the authorization request with the OP provided request_uri
 
         _msg["request_uri"] = _resp["http_response"]["request_uri"]